@@ -6,20 +6,22 @@ from rules import TransitionRules
 class Cell:
     """
     Represents a single cell in a grid for the Cellular Automata simulation.
-    Holds the current state of the cell and a dictionary of its neighbors.
+    Holds the current state of the cell and a mapping of its neighbors
+    (direction -> cell, a topology.Neighbors view when the cell is in a grid).
     The cell's next state is determined based on its current state and the states
     of its neighbors according to defined transition rules.
     """
 
-    def __init__(self, state, neighbors: dict = None):
+    def __init__(self, state, neighbors=None):
         self.state = state
         self.neighbors = neighbors if neighbors is not None else {}
 
-    def set_neighbors(self, neighbors: dict):
+    def set_neighbors(self, neighbors):
         self.neighbors = neighbors
 
-    def update_state(self):
-        rules = TransitionRules(self)
+    def update_state(self, rules=None):
+        # rules: the rules to apply, by default all the enabled rules
+        rules = TransitionRules(self, rules)
         with rules:
             return rules.apply_rules()
 
@@ -0,0 +1,170 @@
+"""
+This module holds the allocation tracking mode: the memory allocated by the phases of
+the simulation (Grid.next_day, PygameSimulationGUI.draw), by source line, and the
+garbage collector's pauses, written to a file as JSON Lines.
+
+It is opt-in (headless.py / main.py --allocations FILE): tracemalloc slows every
+allocation down, and the snapshots are taken around every `every`-th phase only.
+
+For each tracked phase a line holds:
+- net_bytes / net_blocks: what the phase allocated and still holds at its end
+    (e.g. the new States of a day), with the top source lines
+- peak_bytes: the highest traced memory during the phase above its start,
+    which includes the temporary objects freed before its end (the churn)
+- gc: the collections during the phase, their pause times and collected objects
+The last line is a summary per phase, and per source line over every phase.
+
+Example:
+    python headless.py --days 50 --allocations allocations.jsonl --allocations-every 5
+"""
+import gc
+import json
+import os
+import tracemalloc
+from contextlib import contextmanager
+from time import perf_counter
+
+# Frames of these files are not the simulation's allocations
+IGNORED_FILES = (tracemalloc.__file__, __file__)
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def _short_path(file_name):
+    # The simulation's files relative to their directory, the others in full
+    if file_name.startswith(SOURCE_DIRECTORY + os.sep):
+        return os.path.relpath(file_name, SOURCE_DIRECTORY)
+    return file_name
+
+
+class AllocationTracker:
+    """
+    Tracks the allocations of the phases run with phase(name), writing each tracked
+    phase to path. Call close() to write the summary and stop tracing.
+    """
+
+    def __init__(self, path, every=1, top=15, frames=1):
+        self.path = path
+        self.every = every
+        self.top = top
+        self.file = open(path, 'w', encoding='utf-8')
+        self.counts = {}  # phase -> phases run
+        self.totals = {}  # phase -> summed fields of the tracked phases
+        self.lines = {}  # (phase, file, line) -> [bytes, blocks]
+        self.current = None  # gc statistics of the tracked phase running
+        self.gc_outside = {'collections': 0, 'pause': 0.0}
+        self.gc_start = None
+        tracemalloc.start(frames)
+        gc.callbacks.append(self._gc_callback)
+
+    def _gc_callback(self, phase, info):
+        if phase == 'start':
+            self.gc_start = perf_counter()
+            return
+        if self.gc_start is None:
+            return
+        pause = perf_counter() - self.gc_start
+        self.gc_start = None
+        statistics = self.current if self.current is not None else self.gc_outside
+        statistics['collections'] += 1
+        statistics['pause'] += pause
+        if 'max_pause' in statistics:
+            statistics['max_pause'] = max(statistics['max_pause'], pause)
+            statistics['collected'] += info.get('collected', 0)
+            statistics['generations'][info['generation']] += 1
+
+    @staticmethod
+    def _snapshot():
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces([tracemalloc.Filter(False, file_name)
+                                       for file_name in IGNORED_FILES])
+
+    @contextmanager
+    def phase(self, name):
+        """Runs the body as the phase name, tracked every `every` times."""
+        count = self.counts[name] = self.counts.get(name, 0) + 1
+        if (count - 1) % self.every or self.current is not None:
+            yield
+            return
+        self.current = {'collections': 0, 'pause': 0.0, 'max_pause': 0.0, 'collected': 0,
+                        'generations': [0, 0, 0]}
+        before = self._snapshot()
+        start_memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            after = self._snapshot()
+            gc_statistics, self.current = self.current, None
+            self._record(name, count, elapsed, peak - start_memory,
+                         after.compare_to(before, 'lineno'), gc_statistics)
+
+    def _record(self, name, count, elapsed, peak, differences, gc_statistics):
+        net_bytes = sum(difference.size_diff for difference in differences)
+        net_blocks = sum(difference.count_diff for difference in differences)
+        top = []
+        for difference in sorted(differences, key=lambda difference: difference.size_diff,
+                                 reverse=True)[:self.top]:
+            if difference.size_diff <= 0:
+                break
+            frame = difference.traceback[0]
+            top.append({'file': _short_path(frame.filename), 'line': frame.lineno,
+                        'bytes': difference.size_diff, 'blocks': difference.count_diff})
+        for difference in differences:
+            frame = difference.traceback[0]
+            line = self.lines.setdefault((name, _short_path(frame.filename), frame.lineno), [0, 0])
+            line[0] += difference.size_diff
+            line[1] += difference.count_diff
+        record = {'phase': name, 'index': count, 'elapsed_ms': elapsed * 1000,
+                  'net_bytes': net_bytes, 'net_blocks': net_blocks, 'peak_bytes': peak,
+                  'gc': {'collections': gc_statistics['collections'],
+                         'generations': gc_statistics['generations'],
+                         'collected': gc_statistics['collected'],
+                         'pause_ms': gc_statistics['pause'] * 1000,
+                         'max_pause_ms': gc_statistics['max_pause'] * 1000},
+                  'top': top}
+        totals = self.totals.setdefault(name, {'tracked': 0, 'net_bytes': 0, 'net_blocks': 0,
+                                               'peak_bytes': 0, 'gc_collections': 0,
+                                               'gc_pause_ms': 0.0})
+        totals['tracked'] += 1
+        totals['net_bytes'] += net_bytes
+        totals['net_blocks'] += net_blocks
+        totals['peak_bytes'] = max(totals['peak_bytes'], peak)
+        totals['gc_collections'] += gc_statistics['collections']
+        totals['gc_pause_ms'] += gc_statistics['pause'] * 1000
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def summary(self):
+        lines = {}
+        for (name, file_name, line), (size, blocks) in self.lines.items():
+            lines.setdefault(name, []).append(
+                {'file': file_name, 'line': line, 'bytes': size, 'blocks': blocks})
+        for name in lines:
+            lines[name] = sorted(lines[name], key=lambda line: line['bytes'], reverse=True)[:self.top]
+        return {'phases': self.totals, 'lines': lines,
+                'gc_outside_phases': {'collections': self.gc_outside['collections'],
+                                      'pause_ms': self.gc_outside['pause'] * 1000}}
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.write(json.dumps({'summary': self.summary()}) + '\n')
+        self.file.close()
+        gc.callbacks.remove(self._gc_callback)
+        tracemalloc.stop()
+
+
+def format_summary(summary):
+    rows = []
+    for name, totals in summary['phases'].items():
+        tracked = totals['tracked']
+        rows.append(f"{name}: {tracked} tracked, {totals['net_bytes'] / tracked:.0f} bytes and "
+                    f"{totals['net_blocks'] / tracked:.0f} blocks held per phase, peak "
+                    f"{totals['peak_bytes']} bytes, {totals['gc_collections']} collections "
+                    f"({totals['gc_pause_ms']:.2f} ms)")
+        for line in summary['lines'].get(name, [])[:5]:
+            rows.append(f"    {line['file']}:{line['line']}: {line['bytes']} bytes, {line['blocks']} blocks")
+    return '\n'.join(rows)
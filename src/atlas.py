@@ -0,0 +1,136 @@
+"""
+This module holds the image atlas of the GUI: the PNGs of a directory (gradient_images)
+packed into one image, so the GUI starts with a single image to read and decode
+instead of one per landscape type and gradient (which matters most for the web build,
+where every file is fetched).
+
+The landscape images are stored at most LANDSCAPE_MAX_PIXELS wide and high: the GUI
+never draws them larger, and the originals are about 1000 pixels wide.
+
+The atlas is <directory>/atlas.png, with the place of every image in <directory>/atlas.json.
+Atlas.load reads an image from it when it holds the image, else from its own file, and
+the atlas image is only decoded when the first image is loaded. An atlas older than
+any of the images it holds is not used at all, so it never serves outdated images.
+
+The atlas of docs/gradient_images is committed, built after a first start of the GUI
+so that it also holds the gradients the GUI draws at startup (rebuild it when an
+image changes, the web build bundles it with the images).
+
+Example (once, and again after adding images to the directory):
+    python atlas.py                     # the directory of find_images_directory
+    python atlas.py gradient_images
+"""
+import argparse
+import json
+import os
+import sys
+from state import Landscape
+
+ATLAS_NAME = 'atlas'
+IMAGES_DIRECTORY = 'gradient_images'
+ATLAS_WIDTH = 1024
+LANDSCAPE_MAX_PIXELS = 256  # the GUI draws them at most 0.6 * viewport.MAX_CELL_PIXELS wide
+
+
+def find_images_directory(name=IMAGES_DIRECTORY):
+    """
+    The directory of the GUI's images: name in the working directory when there is one
+    (the web build bundles it with the sources), else the repository's docs/<name>.
+    """
+    if os.path.isdir(name):
+        return name
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'docs', name)
+
+
+class Atlas:
+    """The images of a directory, from its atlas when built (see the module docstring)."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.image_path = os.path.join(directory, f'{ATLAS_NAME}.png')
+        self.rects = {}  # image path -> (x, y, width, height) in the atlas
+        self.surface = None
+        index_path = os.path.join(directory, f'{ATLAS_NAME}.json')
+        if os.path.exists(index_path) and os.path.exists(self.image_path):
+            with open(index_path, encoding='utf-8') as index_file:
+                rects = {os.path.join(directory, name): tuple(rect)
+                         for name, rect in json.load(index_file).items()}
+            # not used at all when one of its images changed after it was built
+            built = min(os.path.getmtime(index_path), os.path.getmtime(self.image_path))
+            stale = [path for path in rects if os.path.exists(path) and os.path.getmtime(path) > built]
+            if stale:
+                print(f'Ignoring {self.image_path}, older than {", ".join(stale)}: '
+                      f'rebuild it with python atlas.py {directory}')
+            else:
+                self.rects = rects
+
+    def __contains__(self, path):
+        return path in self.rects
+
+    def exists(self, path):
+        return path in self.rects or os.path.exists(path)
+
+    def load(self, path):
+        """The image of path (a pygame Surface, not converted)."""
+        import pygame
+        rect = self.rects.get(path)
+        if rect is None:
+            return pygame.image.load(path)
+        if self.surface is None:
+            self.surface = pygame.image.load(self.image_path)
+        return self.surface.subsurface(rect)
+
+
+def build_atlas(directory):
+    """Packs the PNGs of directory into its atlas, returns the number of images."""
+    import pygame
+    landscape_names = {f'{land_type.name}.png' for land_type in Landscape}
+    images = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.png') or name == f'{ATLAS_NAME}.png':
+            continue
+        image = pygame.image.load(os.path.join(directory, name))
+        width, height = image.get_size()
+        if name in landscape_names and max(width, height) > LANDSCAPE_MAX_PIXELS:
+            scale = LANDSCAPE_MAX_PIXELS / max(width, height)
+            image = pygame.transform.smoothscale(
+                image.convert_alpha(), (max(1, round(width * scale)), max(1, round(height * scale))))
+        images[name] = image
+    # shelves of images, the tallest first
+    atlas_width = max([ATLAS_WIDTH] + [image.get_width() for image in images.values()])
+    rects = {}
+    x = y = shelf_height = 0
+    for name, image in sorted(images.items(), key=lambda item: -item[1].get_height()):
+        width, height = image.get_size()
+        if x + width > atlas_width:
+            x, y = 0, y + shelf_height
+            shelf_height = 0
+        rects[name] = (x, y, width, height)
+        x += width
+        shelf_height = max(shelf_height, height)
+    atlas = pygame.Surface((atlas_width, max(1, y + shelf_height)), pygame.SRCALPHA)
+    for name, image in images.items():
+        atlas.blit(image, rects[name][:2], special_flags=pygame.BLEND_RGBA_MAX)  # copied as is
+    pygame.image.save(atlas, os.path.join(directory, f'{ATLAS_NAME}.png'))
+    with open(os.path.join(directory, f'{ATLAS_NAME}.json'), 'w', encoding='utf-8') as index_file:
+        json.dump(rects, index_file, indent=1, sort_keys=True)
+    return len(images)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack the images of a directory into its atlas')
+    parser.add_argument('directory', nargs='?', help='the images directory, see find_images_directory')
+    args = parser.parse_args(argv)
+    if args.directory is None:
+        args.directory = find_images_directory()
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))  # needed to convert the images
+    count = build_atlas(args.directory)
+    print(f'{count} images packed into {os.path.join(args.directory, ATLAS_NAME)}.png')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
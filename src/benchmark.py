@@ -0,0 +1,247 @@
+"""
+Reproducible benchmarks for the simulation.
+Suites:
+- step: Grid.next_day across grid sizes, rule subsets and engines
+- statistics: Grid.calculate_statistics
+- csv: export_state_to_csv and load_initial_conditions_csv
+- render: the GUI's draw_grid into an offscreen surface (needs pygame, runs on SDL's dummy driver)
+Every world is generated from a fixed seed. Results are saved as JSON, and can be
+compared against a baseline file: a benchmark slower than the baseline by more
+than the threshold is reported as a regression (and the exit status is 1).
+
+Example:
+    python benchmark.py --sizes 6 32 128 --save baseline.json
+    python benchmark.py --sizes 6 32 128 --compare baseline.json --threshold 0.1
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from time import perf_counter
+from engines import ENGINES, REFERENCE_ENGINE
+from grid import Grid, random_initial_conditions
+from rules import TransitionRules
+
+SUITES = ('step', 'statistics', 'csv', 'render')
+DEFAULT_SIZES = (6, 32, 128)
+# Rule subsets by name prefix, None keeps the rules as they are
+RULE_SUBSETS = {
+    'default': None,
+    'wind': ('WIND',),
+    'no_land': ('WIND', 'CLOUDS', 'RAIN', 'AIR', 'TEMP'),
+}
+
+
+def build_world(size, seed, engine=REFERENCE_ENGINE):
+    world = Grid(size, size, engine=engine)
+    world.apply_initial_conditions_csv(
+        initial_conditions=random_initial_conditions(size, size, seed))
+    return world
+
+
+@contextmanager
+def rule_subset(name):
+    prefixes = RULE_SUBSETS[name]
+    enabled = [rule['enabled'] for rule in TransitionRules.rules]
+    try:
+        if prefixes is not None:
+            for rule in TransitionRules.rules:
+                rule['enabled'] = rule['enabled'] and rule['name'].upper().startswith(prefixes)
+        yield
+    finally:
+        for rule, was_enabled in zip(TransitionRules.rules, enabled):
+            rule['enabled'] = was_enabled
+
+
+def measure(function, repeat, setup=None):
+    """Runs function repeat times (after setup, which is not timed)."""
+    times = []
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = perf_counter()
+        function(argument)
+        times.append(perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times),
+            'max': max(times), 'repeat': repeat}
+
+
+def bench_step(sizes, subsets, days, repeat, seed, engines=(REFERENCE_ENGINE,)):
+    results = {}
+    for engine in engines:
+        # The reference engine keeps the original names, so older baselines still compare
+        prefix = 'step' if engine == REFERENCE_ENGINE else f'step[{engine}]'
+        for subset in subsets:
+            with rule_subset(subset):
+                for size in sizes:
+                    def step(world):
+                        for _ in range(days):
+                            world.next_day()
+                    results[f'{prefix}/{subset}/{size}x{size}'] = measure(
+                        step, repeat, lambda: build_world(size, seed, engine))
+    return results
+
+
+def bench_statistics(sizes, repeat, seed):
+    results = {}
+    for size in sizes:
+        world = build_world(size, seed)
+        results[f'statistics/{size}x{size}'] = measure(
+            lambda _: world.calculate_statistics(), repeat)
+    return results
+
+
+def write_conditions_csv(world, file_path):
+    # Same format as enums.csv, so it can be read by load_initial_conditions_csv
+    with open(file_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['x', 'y', 'land_type', 'temperature', 'wind_speed',
+                         'wind_direction', 'rainfall', 'air_pollution', 'clouds'])
+        for x, row in enumerate(world.grid):
+            for y, cell in enumerate(row):
+                state = cell.state
+                writer.writerow([x, y, state.land_type.name, state.temperature.name,
+                                 state.wind_speed.name, state.wind_direction.name,
+                                 state.rainfall.name, state.air_pollution.name,
+                                 'Yes' if state.clouds else 'No'])
+
+
+def bench_csv(sizes, repeat, seed):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            world = build_world(size, seed)
+            export_path = os.path.join(directory, 'exported.csv')
+            conditions_path = os.path.join(directory, 'conditions.csv')
+            write_conditions_csv(world, conditions_path)
+            results[f'csv_export/{size}x{size}'] = measure(
+                lambda _: world.export_state_to_csv(export_path), repeat)
+            results[f'csv_load/{size}x{size}'] = measure(
+                lambda _: world.load_initial_conditions_csv(conditions_path), repeat)
+    return results
+
+
+def bench_render(sizes, repeat, seed):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    try:
+        import pygame
+        import main
+    except ImportError as e:
+        print(f'Skipping the render suite: {e}')
+        return {}
+    pygame.init()
+    results = {}
+    try:
+        for size in sizes:
+            world = build_world(size, seed)
+            gui = main.PygameSimulationGUI(world)
+            surface = pygame.Surface((main.GRID_WIDTH, gui.screen.get_height()))
+            # The first draw creates the gradient images, which is not what we measure
+            gui.draw_grid(surface)
+            random.seed(seed)  # the ice and rain effects are random
+            results[f'render/{size}x{size}'] = measure(lambda _: gui.draw_grid(surface), repeat)
+    except (pygame.error, OSError) as e:
+        # e.g. no display, or the images of the GUI are missing
+        print(f'Skipping the rest of the render suite: {e}')
+    return results
+
+
+def run(args, results):
+    """Runs the suites of args, adding the results of each one as it finishes."""
+    if 'step' in args.suites:
+        results.update(bench_step(args.sizes, args.subsets, args.days, args.repeat, args.seed,
+                                  args.engines))
+    if 'statistics' in args.suites:
+        results.update(bench_statistics(args.sizes, args.repeat, args.seed))
+    if 'csv' in args.suites:
+        results.update(bench_csv(args.sizes, args.repeat, args.seed))
+    if 'render' in args.suites:
+        results.update(bench_render(args.sizes, args.repeat, args.seed))
+
+
+def new_report(args):
+    return {
+        'meta': {
+            'timestamp': time.time(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'days': args.days,
+            'engines': args.engines,
+        },
+        'results': {},
+    }
+
+
+def compare(current, baseline, threshold):
+    """Returns the names of the benchmarks slower than the baseline by more than threshold."""
+    regressions = []
+    print(f"{'benchmark':<36}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['median']
+        after = result['median']
+        change = after / before - 1 if before else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<36}{before * 1000:>10.2f}ms{after * 1000:>10.2f}ms{change:>+10.1%}{flag}')
+    return regressions
+
+
+def print_results(report):
+    print(f"{'benchmark':<36}{'min':>12}{'median':>12}")
+    for name, result in report['results'].items():
+        print(f"{name:<36}{result['min'] * 1000:>10.2f}ms{result['median'] * 1000:>10.2f}ms")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Simulation benchmarks')
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=list(SUITES))
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(DEFAULT_SIZES),
+                        help='grid sizes (the grids are size x size), e.g. 6 32 128 1024')
+    parser.add_argument('--subsets', nargs='+', choices=list(RULE_SUBSETS), default=['default'],
+                        help='rule subsets for the step suite')
+    parser.add_argument('--engines', nargs='+', choices=sorted(ENGINES), default=[REFERENCE_ENGINE],
+                        help='stepping engines for the step suite')
+    parser.add_argument('--days', type=int, default=1, help='days per step measurement')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='save the results as JSON to this file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression (0.1 = 10%%)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = new_report(args)
+    try:
+        run(args, report['results'])
+    finally:
+        # the suites that finished are saved even if a later one fails
+        print_results(report)
+        if args.save:
+            with open(args.save, 'w') as json_file:
+                json.dump(report, json_file, indent=2)
+    if args.compare:
+        with open(args.compare) as json_file:
+            baseline = json.load(json_file)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s) beyond {args.threshold:.0%}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
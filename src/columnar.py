@@ -0,0 +1,176 @@
+"""
+This module holds the columnar exporter: the daily statistics series, and optionally
+the history of selected cell attributes, written as typed columns instead of text.
+
+Every column is a NumPy .npy file (format version 1.0), written with the standard
+library only: the values are appended in blocks of days, and the header's shape is
+rewritten after each block (the header is padded for it), so the file is always a
+valid array of the days written so far. Analysts load a column with
+    numpy.load('out/statistics/avg_temperature.npy')
+or, without NumPy, read_npy in this module.
+
+Layout of the export directory:
+- statistics/<name>.npy: one float64 value per day (int32 for day), see STATISTICS_COLUMNS
+- cells/<attribute>.npy: uint8, one row per day of the attribute's value (State.pack) of each cell
+- cells.npy: the flat indices (row * cols + col) of the cells of the histories
+- meta.json: the world's shape and the columns
+
+Example:
+    python headless.py --days 36500 --columnar out --columnar-cells temperature land_type
+"""
+import array
+import ast
+import json
+import os
+import sys
+from state import STATE_FIELDS
+
+MAGIC = b'\x93NUMPY\x01\x00'
+HEADER_SIZE = 256  # magic, header length and the padded header, room for any shape
+# array typecodes of the numpy dtypes written
+TYPECODES = {'<f8': 'd', '<i4': 'i', '<i8': 'q', '|u1': 'B'}
+# name -> (dtype, Grid attribute or z-score list)
+STATISTICS_COLUMNS = {
+    'day': ('<i4', None),
+    'avg_temperature': ('<f8', 'avg_temperature'),
+    'avg_wind_speed': ('<f8', 'avg_wind_speed'),
+    'avg_rainfall': ('<f8', 'avg_rainfall'),
+    'avg_pollution': ('<f8', 'avg_pollution'),
+    'std_dev_temperature': ('<f8', 'std_dev_temperature'),
+    'std_dev_wind_speed': ('<f8', 'std_dev_wind_speed'),
+    'std_dev_rainfall': ('<f8', 'std_dev_rainfall'),
+    'std_dev_pollution': ('<f8', 'std_dev_pollution'),
+    'z_score_temperature': ('<f8', 'z_score_temperature'),
+    'z_score_wind_speed': ('<f8', 'z_score_wind_speed'),
+    'z_score_rainfall': ('<f8', 'z_score_rainfall'),
+    'z_score_pollution': ('<f8', 'z_score_pollution'),
+}
+
+
+def _header(dtype, shape):
+    header = repr({'descr': dtype, 'fortran_order': False, 'shape': tuple(shape)}).encode('latin1')
+    length = HEADER_SIZE - len(MAGIC) - 2
+    if len(header) + 1 > length:
+        raise ValueError(f'The shape {shape} does not fit in the header')
+    # padded with spaces, ends with a newline
+    header = header + b' ' * (length - len(header) - 1) + b'\n'
+    return MAGIC + length.to_bytes(2, 'little') + header
+
+
+class NpyColumn:
+    """
+    A .npy file of dtype with rows of row_shape, appended to. The rows are buffered
+    until flush(), which writes them and updates the header.
+    """
+
+    def __init__(self, path, dtype, row_shape=()):
+        self.path = path
+        self.dtype = dtype
+        self.row_shape = tuple(row_shape)
+        self.row_size = 1
+        for size in self.row_shape:
+            self.row_size *= size
+        self.rows = 0
+        self.buffer = array.array(TYPECODES[dtype])
+        with open(path, 'wb') as npy_file:
+            npy_file.write(_header(dtype, (0, *self.row_shape)))
+
+    def append(self, values):
+        """Appends one row (a single value when row_shape is ())."""
+        if self.row_shape:
+            if len(values) != self.row_size:
+                raise ValueError(f'{self.path}: expected {self.row_size} values, got {len(values)}')
+            self.buffer.extend(values)
+        else:
+            self.buffer.append(values)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = self.buffer
+        if sys.byteorder == 'big' and data.itemsize > 1:
+            data = array.array(data.typecode, data)
+            data.byteswap()
+        self.rows += len(self.buffer) // self.row_size
+        with open(self.path, 'r+b') as npy_file:
+            npy_file.seek(0, os.SEEK_END)
+            npy_file.write(data.tobytes())
+            npy_file.seek(0)
+            npy_file.write(_header(self.dtype, (self.rows, *self.row_shape)))
+        self.buffer = array.array(self.buffer.typecode)
+
+
+def read_npy(path):
+    """Returns (array.array of the values, shape) of a .npy file written by NpyColumn."""
+    with open(path, 'rb') as npy_file:
+        if npy_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a .npy file of version 1.0')
+        length = int.from_bytes(npy_file.read(2), 'little')
+        header = ast.literal_eval(npy_file.read(length).decode('latin1'))
+        values = array.array(TYPECODES[header['descr']])
+        values.frombytes(npy_file.read())
+    if sys.byteorder == 'big' and values.itemsize > 1:
+        values.byteswap()
+    return values, header['shape']
+
+
+class ColumnarExporter:
+    """
+    Appends the statistics of every recorded day to the columns in directory, and the
+    history of cell_attributes (State attributes) of cells (flat indices, all by default).
+    Columns are written every block_days days, and on close().
+    """
+
+    def __init__(self, directory, world, cell_attributes=(), cells=None, block_days=30):
+        for attribute in cell_attributes:
+            if attribute not in STATE_FIELDS:
+                raise ValueError(f'Unknown attribute {attribute}, expected one of {STATE_FIELDS}')
+        self.directory = directory
+        self.block_days = block_days
+        self.pending_days = 0
+        self.cells = list(range(world.rows * world.cols)) if cells is None else list(cells)
+        self.attribute_indices = [STATE_FIELDS.index(attribute) for attribute in cell_attributes]
+        os.makedirs(os.path.join(directory, 'statistics'), exist_ok=True)
+        self.statistics = {name: NpyColumn(os.path.join(directory, 'statistics', f'{name}.npy'), dtype)
+                           for name, (dtype, _) in STATISTICS_COLUMNS.items()}
+        self.histories = []
+        if cell_attributes:
+            os.makedirs(os.path.join(directory, 'cells'), exist_ok=True)
+            self.histories = [NpyColumn(os.path.join(directory, 'cells', f'{attribute}.npy'), '|u1',
+                                        (len(self.cells),))
+                              for attribute in cell_attributes]
+            index = NpyColumn(os.path.join(directory, 'cells.npy'), '<i8')
+            for cell in self.cells:
+                index.append(cell)
+            index.flush()
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as meta_file:
+            json.dump({'rows': world.rows, 'cols': world.cols,
+                       'statistics': list(STATISTICS_COLUMNS),
+                       'cell_attributes': list(cell_attributes)}, meta_file, indent=2)
+
+    def record(self, world):
+        """Records the world's current day (call it after every next_day)."""
+        for name, (_, attribute) in STATISTICS_COLUMNS.items():
+            if attribute is None:
+                value = world.days - 1
+            elif attribute.startswith('z_score'):
+                value = getattr(world, attribute)[-1]
+            else:
+                value = getattr(world, attribute)
+            self.statistics[name].append(value)
+        if self.histories:
+            cells = world.cells
+            packed = [cells[index].state.pack() for index in self.cells]
+            for column, attribute_index in zip(self.histories, self.attribute_indices):
+                column.append([values[attribute_index] for values in packed])
+        self.pending_days += 1
+        if self.pending_days >= self.block_days:
+            self.flush()
+
+    def flush(self):
+        for column in (*self.statistics.values(), *self.histories):
+            column.flush()
+        self.pending_days = 0
+
+    def close(self):
+        self.flush()
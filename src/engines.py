@@ -0,0 +1,201 @@
+"""
+This module holds the stepping engines: how Grid.next_day computes the new states.
+An engine has a compute_states(grid, metrics=None) method returning the new state
+of every cell (row major), computed from the current day. The grid commits them.
+
+Engines are registered by name (see register_engine), and chosen with Grid(engine=...):
+- object: the reference engine, CA.Cell.update_state for every cell.
+- fast: the same rules, applied on flat lists of states without deep copies,
+    without the rules the rule optimizer proved redundant. The default engine.
+- quadtree: the grid as a hash-consed quadtree, every distinct region is computed
+    once (see quadtree.py). Experimental, for large and mostly uniform worlds.
+Grid(verify=True) wraps the engine in a VerifyingEngine, which runs the reference
+engine side by side and raises EngineDivergence at the first differing cell.
+"""
+from time import perf_counter
+from rules import TransitionRules
+from state import STATE_FIELDS
+from topology import NEIGHBOR_DIRECTIONS, NEIGHBOR_COUNT
+from neighborhood import Neighborhood
+import transport
+from quadtree import QuadtreeWorld, Universe
+
+REFERENCE_ENGINE = 'object'
+DEFAULT_ENGINE = 'fast'
+ENGINES = {}
+
+
+def register_engine(name):
+    def decorator(engine_class):
+        engine_class.name = name
+        ENGINES[name] = engine_class
+        return engine_class
+    return decorator
+
+
+def get_engine(name):
+    """Returns a new instance of the engine registered under name."""
+    if name not in ENGINES:
+        raise ValueError(f"Unknown engine {name}, expected one of {sorted(ENGINES)}")
+    return ENGINES[name]()
+
+
+class EngineDivergence(Exception):
+    """Raised when an engine disagrees with the reference engine."""
+
+    def __init__(self, divergence):
+        self.divergence = divergence
+        super().__init__(
+            'Engine {engine} diverged at cell ({row}, {col}): {attribute} is {actual}, '
+            'expected {expected}'.format(**divergence))
+
+
+def first_divergence(expected_states, actual_states, cols):
+    """
+    Compares two row major lists of states, returns the first differing
+    cell and attribute as a dictionary, or None if they are the same.
+    """
+    for index, (expected, actual) in enumerate(zip(expected_states, actual_states)):
+        expected_packed, actual_packed = expected.pack(), actual.pack()
+        if expected_packed != actual_packed:
+            for field, expected_value, actual_value in zip(STATE_FIELDS, expected_packed, actual_packed):
+                if expected_value != actual_value:
+                    row, col = divmod(index, cols)
+                    return {'row': row, 'col': col, 'attribute': field,
+                            'expected': getattr(expected, field), 'actual': getattr(actual, field)}
+    return None
+
+
+@register_engine('object')
+class ObjectEngine:
+    """The reference engine: every cell is updated through CA.Cell.update_state."""
+
+    def compute_states(self, grid, metrics=None):
+        # The rules of the categories due on this day (see scheduler.py)
+        scheduled = TransitionRules.scheduled(grid.skipped_categories(), grid.rule_mask)
+        if metrics is None:
+            return [cell.update_state(scheduled) for row in grid.grid for cell in row]
+
+        # Same as above, timing the neighborhood setup and the rules evaluation
+        new_states = []
+        setup_time = evaluation_time = 0.0
+        for row in grid.grid:
+            for cell in row:
+                start = perf_counter()
+                rules = TransitionRules(cell, scheduled)
+                with rules:
+                    setup_end = perf_counter()
+                    new_states.append(rules.apply_rules())
+                    evaluation_end = perf_counter()
+                setup_time += setup_end - start
+                evaluation_time += evaluation_end - setup_end
+        metrics.record('neighbor_setup', setup_time)
+        metrics.record('rule_evaluation', evaluation_time)
+        return new_states
+
+
+@register_engine('fast')
+class FastEngine:
+    """
+    Applies the same rules as the reference engine, but:
+    - the rules are collected once per day instead of once per cell,
+        without the redundant ones (see TransitionRules.active),
+    - each cell only evaluates the rules of its dispatch bucket (see TransitionRules.dispatch_table),
+    - the neighbors' states are shared instead of deep copied
+        (the rules only ever write to the center of the neighborhood),
+    - the neighbors are read straight from the grid's neighbor table,
+    - the wind and pollution transport is computed for the whole grid beforehand (see transport.py),
+    - the center is a shallow copy (the State attributes are immutable enums).
+    """
+
+    def compute_states(self, grid, metrics=None):
+        return self.step([cell.state for cell in grid.cells], grid.neighbor_table,
+                         grid.skipped_categories(), metrics, grid.rule_mask)
+
+    def step(self, states, table, skip=frozenset(), metrics=None, mask=None):
+        """
+        The new states of states (a flat list), with their neighbors in table
+        (as topology.neighbor_table), the rule categories in skip not being applied,
+        and the rules enabled by mask (see TransitionRules.active).
+        """
+        if TransitionRules.profiler is not None:
+            # Every scheduled rule is evaluated while profiling (see TransitionRules.active)
+            rules = TransitionRules.active(skip, mask)
+            apply = lambda neighborhood: TransitionRules.apply(neighborhood, rules)
+        else:
+            apply = TransitionRules.dispatch_table(skip, mask).apply
+        directions = tuple(enumerate(NEIGHBOR_DIRECTIONS))
+        caches = transport.seed_caches(states, table)
+        new_states = []
+        setup_time = evaluation_time = 0.0
+        for index, state in enumerate(states):
+            if metrics is not None:
+                start = perf_counter()
+            base = index * NEIGHBOR_COUNT
+            neighborhood = Neighborhood()
+            for offset, direction in directions:
+                neighbor = table[base + offset]
+                if neighbor >= 0:
+                    neighborhood[direction] = states[neighbor]
+            neighborhood['center'] = state.copy()
+            neighborhood.cache = caches[index]
+            if metrics is not None:
+                setup_end = perf_counter()
+                new_states.append(apply(neighborhood))
+                setup_time += setup_end - start
+                evaluation_time += perf_counter() - setup_end
+            else:
+                new_states.append(apply(neighborhood))
+        if metrics is not None:
+            metrics.record('neighbor_setup', setup_time)
+            metrics.record('rule_evaluation', evaluation_time)
+        return new_states
+
+
+@register_engine('quadtree')
+class QuadtreeEngine:
+    """
+    Steps the grid as a quadtree world (see quadtree.py). The universe is kept
+    from day to day, so the regions computed on earlier days are not computed again.
+    """
+
+    def __init__(self):
+        self.universe = Universe()
+
+    def compute_states(self, grid, metrics=None):
+        start = perf_counter()
+        world = QuadtreeWorld.from_states(grid.rows, grid.cols, [cell.state for cell in grid.cells],
+                                          boundary=grid.boundary, update_periods=grid.update_periods,
+                                          universe=self.universe)
+        world.days = grid.days
+        world.rule_mask = grid.rule_mask
+        setup_end = perf_counter()
+        world.next_day()
+        evaluation_end = perf_counter()
+        new_states = world.states()
+        if metrics is not None:
+            metrics.record('neighbor_setup', setup_end - start + perf_counter() - evaluation_end)
+            metrics.record('rule_evaluation', evaluation_end - setup_end)
+        return new_states
+
+
+class VerifyingEngine:
+    """
+    Runs an engine and the reference engine on the same day, and raises
+    EngineDivergence if any cell differs. Returns the engine's states otherwise.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.reference = get_engine(REFERENCE_ENGINE)
+        self.name = f'verify:{engine.name}'
+
+    def compute_states(self, grid, metrics=None):
+        expected = self.reference.compute_states(grid)
+        actual = self.engine.compute_states(grid, metrics)
+        divergence = first_divergence(expected, actual, grid.cols)
+        if divergence is not None:
+            divergence['engine'] = self.engine.name
+            divergence['day'] = grid.days
+            raise EngineDivergence(divergence)
+        return actual
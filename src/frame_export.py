@@ -0,0 +1,270 @@
+"""
+This module holds the frame exporter: every N-th day of a run rendered with the GUI's
+drawing code (main.py) on an offscreen surface, and written as a PNG sequence or an
+animated GIF, e.g. for the animations of multi-year runs.
+
+The world is stepped in the calling process, which only packs the states of the days
+to export (State.pack, see history.py). The frames are drawn and encoded by a pool of
+worker processes (pygame under SDL's dummy video driver), so rendering and encoding
+overlap with the stepping. At most 2 frames per worker are pending: if the workers
+fall behind, the run waits for them instead of growing the queue.
+
+- a directory: one PNG per frame, frame_<number>.png
+- a .gif file: an animated GIF, written with the standard library only. The frames
+    are mapped to a fixed 256 colors palette (3 bits of red and green, 2 of blue) by
+    SDL, and LZW encoded by the workers; the GIF is appended to in the frames order.
+
+The images are read as in the GUI (see atlas.find_images_directory): gradient_images
+in the working directory, else the repository's docs/gradient_images.
+
+Example:
+    python headless.py --days 3650 --frames out.gif --frames-every 10
+    python headless.py --days 3650 --frames frames --frames-every 5 --frames-size 1000
+"""
+import collections
+import concurrent.futures
+import os
+import random
+import struct
+from history import pack_states, unpack_states
+
+# red: 3 bits, green: 3 bits, blue: 2 bits
+GIF_PALETTE = [((index >> 5) * 255 // 7, ((index >> 2) & 7) * 255 // 7, (index & 3) * 255 // 3)
+               for index in range(256)]
+GIF_MIN_CODE_SIZE = 8
+GIF_MAX_CODES = 4096
+
+# The renderer of each worker process, set by _init_worker
+renderer = None
+
+
+def lzw_encode(indices, min_code_size=GIF_MIN_CODE_SIZE):
+    """The GIF LZW code stream of palette indices (bytes), without the sub-blocks."""
+    clear_code = 1 << min_code_size
+    end_code = clear_code + 1
+    output = bytearray()
+    table = {}
+    next_code = end_code + 1
+    code_size = min_code_size + 1
+    bits = clear_code  # the codes are packed least significant bit first
+    bit_count = code_size
+    prefix = indices[0]
+    for index in indices[1:]:
+        key = prefix << 8 | index
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        bits |= prefix << bit_count
+        bit_count += code_size
+        while bit_count >= 8:
+            output.append(bits & 0xFF)
+            bits >>= 8
+            bit_count -= 8
+        table[key] = next_code
+        next_code += 1
+        if next_code > 1 << code_size and code_size < 12:
+            code_size += 1
+        if next_code == GIF_MAX_CODES:
+            # the table is full: start a new one
+            bits |= clear_code << bit_count
+            bit_count += code_size
+            table = {}
+            next_code = end_code + 1
+            code_size = min_code_size + 1
+        prefix = index
+    for code in (prefix, end_code):
+        bits |= code << bit_count
+        bit_count += code_size
+        if code == prefix and next_code + 1 > 1 << code_size and code_size < 12:
+            # the decoder adds its last entry after reading the prefix
+            code_size += 1
+    while bit_count > 0:
+        output.append(bits & 0xFF)
+        bits >>= 8
+        bit_count -= 8
+    return bytes(output)
+
+
+def gif_sub_blocks(data):
+    blocks = bytearray()
+    for offset in range(0, len(data), 255):
+        chunk = data[offset:offset + 255]
+        blocks.append(len(chunk))
+        blocks += chunk
+    blocks.append(0)
+    return bytes(blocks)
+
+
+def encode_gif_frame(indices, width, height, delay):
+    """A GIF image (graphic control extension, descriptor and data), delay in 1/100 s."""
+    return (struct.pack('<BBBBHBB', 0x21, 0xF9, 4, 0, delay, 0, 0)
+            + struct.pack('<BHHHHB', 0x2C, 0, 0, width, height, 0)
+            + bytes([GIF_MIN_CODE_SIZE]) + gif_sub_blocks(lzw_encode(indices)))
+
+
+class GifWriter:
+    """An animated GIF (looping forever) of width x height frames, written as they come."""
+
+    def __init__(self, file_path, width, height):
+        self.file = open(file_path, 'wb')
+        self.file.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0xF7, 0, 0))
+        self.file.write(bytes(value for color in GIF_PALETTE for value in color))
+        self.file.write(b'\x21\xFF\x0BNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    def write(self, frame):
+        self.file.write(frame)
+
+    def close(self):
+        self.file.write(b'\x3B')
+        self.file.close()
+
+
+class FrameRenderer:
+    """
+    Draws worlds of rows x cols cells in a width x height surface, with the GUI's
+    cell drawing (PygameSimulationGUI.draw_world). Needs pygame and a display mode set.
+    """
+
+    def __init__(self, rows, cols, width, height):
+        import pygame
+        import main
+        from grid import Grid
+        from ui_cache import TextCache
+        from viewport import Viewport, MipmapPyramid
+        self.pygame = pygame
+        self.gui = main.PygameSimulationGUI
+        self.world = Grid(rows, cols)
+        self.viewport = Viewport(rows, cols, width, height)
+        self.mipmap = MipmapPyramid(self.world)
+        self.surface = pygame.Surface((width, height))
+        self.palette_surface = pygame.Surface((width, height), depth=8)
+        self.palette_surface.set_palette(GIF_PALETTE)
+        self.text_cache = TextCache()
+        self.font_path = main.FONT_PATH
+        self.days_per_year = main.DAYS_PER_YEAR
+        # the state the borrowed drawing methods use
+        self.landscape_images = {}
+        self.scaled_images = {}
+        self.cell_images = self.load_images()
+        self.states = {}  # packed state -> the shared State
+
+    def load_images(self):
+        return self.gui.load_images(self)
+
+    def draw_grid_cells(self, surface, world, viewport):
+        self.gui.draw_grid_cells(self, surface, world, viewport)
+
+    def draw_grid_blocks(self, surface, level, viewport, mipmap):
+        self.gui.draw_grid_blocks(self, surface, level, viewport, mipmap)
+
+    def render(self, day, packed):
+        """Draws the packed states (pack_states) of a day, returns the surface."""
+        world = self.world
+        world.commit_states(unpack_states(packed, self.states))
+        self.mipmap.update(world.changed_cells)
+        random.seed(day)  # the ice and rain effects are random, the same day looks the same
+        surface = self.surface
+        surface.fill((0, 0, 0))
+        self.gui.draw_world(self, surface, world, self.viewport, self.mipmap)
+        years, days = divmod(day, self.days_per_year)
+        label = self.text_cache.render(f'Year: {years}, Day: {days}', 20, (255, 255, 255), self.font_path)
+        surface.fill((0, 0, 0), label.get_rect().move(10, 10).inflate(12, 8))
+        surface.blit(label, (10, 10))
+        return surface
+
+    def palette_indices(self, surface):
+        """The GIF_PALETTE indices of the pixels of surface, row major."""
+        self.palette_surface.blit(surface, (0, 0))
+        return self.pygame.image.tobytes(self.palette_surface, 'P')
+
+
+def check_assets():
+    """
+    Raises the errors a worker would fail with (pygame, the GUI's images or font
+    missing), as a pool whose initializer fails only reports BrokenProcessPool.
+    """
+    import main
+    missing = [path for path in main.landscape_image_paths().values() if not main.images.exists(path)]
+    if not os.path.exists(main.FONT_PATH):
+        missing.append(main.FONT_PATH)
+    if missing:
+        raise FileNotFoundError(f"The GUI's assets are missing: {', '.join(missing)}")
+
+
+def _init_worker(rows, cols, width, height):
+    global renderer
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+    import pygame
+    pygame.init()
+    pygame.display.set_mode((1, 1))  # needed to convert the images
+    renderer = FrameRenderer(rows, cols, width, height)
+
+
+def _render_png(day, packed, file_path):
+    renderer.pygame.image.save(renderer.render(day, packed), file_path)
+    return file_path
+
+
+def _render_gif(day, packed, delay):
+    surface = renderer.render(day, packed)
+    return encode_gif_frame(renderer.palette_indices(surface), *surface.get_size(), delay)
+
+
+class FrameExporter:
+    """
+    Exports every `every`-th day of a world to path (a directory for PNGs, or a .gif),
+    in size x size frames (fps frames per second for a GIF). record() must be called
+    once per day, close() at the end of the run.
+    """
+
+    def __init__(self, path, world, every=1, size=800, fps=10, workers=None):
+        if every < 1:
+            raise ValueError('Frames must be at least 1 day apart')
+        check_assets()
+        self.path = path
+        self.every = every
+        self.gif = path.lower().endswith('.gif')
+        self.delay = max(1, round(100 / fps))
+        if self.gif:
+            self.writer = GifWriter(path, size, size)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.writer = None
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            self.workers, initializer=_init_worker, initargs=(world.rows, world.cols, size, size))
+        self.pending = collections.deque()
+        self.frames = 0  # frames written
+
+    def record(self, world):
+        day = world.days - 1
+        if day % self.every:
+            return
+        packed = pack_states(cell.state for cell in world.cells)
+        number = self.frames + len(self.pending)
+        if self.gif:
+            future = self.pool.submit(_render_gif, day, packed, self.delay)
+        else:
+            future = self.pool.submit(_render_png, day, packed,
+                                      os.path.join(self.path, f'frame_{number:05d}.png'))
+        self.pending.append(future)
+        while self.pending and (self.pending[0].done() or len(self.pending) > 2 * self.workers):
+            self._write(self.pending.popleft())
+
+    def _write(self, future):
+        result = future.result()  # raises the worker's error, if any
+        if self.writer is not None:
+            self.writer.write(result)
+        self.frames += 1
+
+    def close(self):
+        """Waits for the pending frames, and finishes the file."""
+        while self.pending:
+            self._write(self.pending.popleft())
+        self.pool.shutdown()
+        if self.writer is not None:
+            self.writer.close()
+        print(f'{self.frames} frames written to {self.path}')
@@ -3,10 +3,24 @@ This module holds the space defining the automation's lauout
 """
 import copy
 import csv
+import os
+import random
 from CA import Cell
+from rules import TransitionRules
+from engines import get_engine, VerifyingEngine, DEFAULT_ENGINE
+from topology import Neighbors, neighbor_table
+from scheduler import skipped_categories, validate_periods
+from snapshots import Snapshot, write_csv
+from spatial_index import SpatialIndex
 from state import State, Landscape, WindDirection, WindSpeed, Temperature, Rain, AirQuality
 
 
+# (absolute path, modification time, rows, cols) of an initial conditions file ->
+# (Snapshot, spatial index, state_totals) of a new world with its conditions applied,
+# see Grid.reset
+pristine_worlds = {}
+
+
 def get_wind_direction_arrow(wind_direction):
     direction_arrows = {
         WindDirection.NORTH: '↑',
@@ -32,13 +46,74 @@ def get_pollution_color(pollution_level):
         return 'red'
 
 
-class Grid:
-    def __init__(self, rows, cols):
-        self.rows = rows
-        self.cols = cols
-        self.grid = [[Cell(State(Landscape.LAND))
-                      for _ in range(cols)] for _ in range(rows)]
-        self.set_neighbors_for_cells()
+def random_initial_conditions(rows, cols, seed=0):
+    """
+    Returns reproducible random initial conditions for a rows x cols world,
+    in the format of load_initial_conditions_csv (for apply_initial_conditions_csv).
+    """
+    rnd = random.Random(seed)
+    # Mountains have no image in the GUI, and no rule creates them
+    land_types = [land_type for land_type in Landscape if land_type != Landscape.MOUNTAIN]
+    wind_directions = [direction for direction in WindDirection if direction != WindDirection.NONE]
+    temperatures = [temperature for temperature in Temperature if temperature <= Temperature.HELL]
+    conditions = []
+    for x in range(rows):
+        for y in range(cols):
+            state = State(rnd.choice(land_types),
+                          rnd.choice(temperatures),
+                          rnd.choice(list(WindSpeed)),
+                          rnd.choice(wind_directions),
+                          rnd.choice(list(Rain)),
+                          rnd.random() < 0.3,
+                          rnd.choice(list(AirQuality)))
+            conditions.append({'x': x, 'y': y, 'cell': Cell(state)})
+    return conditions
+
+
+def state_totals(states):
+    """
+    Returns (cells, sums, sums of squares) of the temperature, wind speed, rainfall
+    and pollution values of states. Totals of parts of a world add up (see merge_totals).
+    """
+    cells = temperature = wind_speed = rainfall = pollution = 0
+    temp_squared = wind_squared = rain_squared = pollution_squared = 0
+    for state in states:
+        cells += 1
+        value = state.temperature.value
+        temperature += value
+        temp_squared += value * value
+        value = state.wind_speed.value
+        wind_speed += value
+        wind_squared += value * value
+        value = state.rainfall.value
+        rainfall += value
+        rain_squared += value * value
+        value = state.air_pollution.value
+        pollution += value
+        pollution_squared += value * value
+    return (cells, (temperature, wind_speed, rainfall, pollution),
+            (temp_squared, wind_squared, rain_squared, pollution_squared))
+
+
+def merge_totals(totals):
+    """The state_totals of a world, from the state_totals of its parts."""
+    totals = list(totals)
+    return (sum(part[0] for part in totals),
+            tuple(map(sum, zip(*(part[1] for part in totals)))),
+            tuple(map(sum, zip(*(part[2] for part in totals)))))
+
+
+Z_SCORES = ('z_score_temperature', 'z_score_wind_speed', 'z_score_rainfall', 'z_score_pollution')
+
+
+class GridStatistics:
+    """
+    The daily statistics of a world: averages, standard deviations and z-scores
+    of the temperature, wind speed, rainfall and pollution.
+    Used by Grid, and by the worlds that don't hold all their cells (see sharding.py).
+    """
+
+    def reset_statistics(self):
         self.statistics = {
             'temperature': [],
             'wind_speed': [],
@@ -49,50 +124,24 @@ class Grid:
         self.z_score_wind_speed = []
         self.z_score_rainfall = []
         self.z_score_pollution = []
-        self.days = 1  # number of days passed - samples for statistics
-        self.calculate_statistics()
-
-    def get_average_temperature(self):
-        return 'gen. avg. temp = {:0.2f} '.format(self.avg_temperature) + \
-            '| {} |\n'.format(Temperature(round(self.avg_temperature)).name) + \
-            '| z-score = {:0.2f} '.format(self.z_score_temperature[-1]) + \
-            '| dev. = {:0.2f} |'.format(self.std_dev_temperature)
-
-    def get_average_wind_speed(self):
-        return 'avg. wind speed {:0.2f} '.format(self.avg_wind_speed) + \
-            '| {} |\n'.format(WindSpeed(round(self.avg_wind_speed)).name) + \
-            '| z-score = {:0.2f} |'.format(self.z_score_wind_speed[-1]) + \
-            '| dev. = {:0.2f} |'.format(self.std_dev_wind_speed)
-
-    def get_average_rainfall(self):
-        return '{:0.2f} '.format(self.avg_rainfall) + \
-            '| {} |\n'.format(Rain(round(self.avg_rainfall)).name) + \
-            '| z-score = {:0.2f} |'.format(self.z_score_rainfall[-1]) + \
-            '| dev. = {:0.2f} |'.format(self.std_dev_rainfall)
-
-    def get_average_pollution(self):
-        return 'avg. Pollution = {:0.2f}'.format(self.avg_pollution) + \
-            '| {} |\n'.format(AirQuality(round(self.avg_pollution)).name) + \
-            '| z-score = {:0.2f} |'.format(self.z_score_pollution[-1]) + \
-            '| dev. = {:0.2f} |'.format(self.std_dev_pollution)
-
-    def calculate_statistics(self):
-        total_temperature, total_wind_speed, total_rainfall, total_pollution = 0.0, 0.0, 0.0, 0.0
-        temp_squared, wind_squared, rain_squared, pollution_squared = 0.0, 0.0, 0.0, 0.0
-        num_cells = self.rows * self.cols
-
-        for row in self.grid:
-            for cell in row:
-                total_temperature += cell.state.temperature.value
-                total_wind_speed += cell.state.wind_speed.value
-                total_rainfall += cell.state.rainfall.value
-                total_pollution += cell.state.air_pollution.value
-
-                temp_squared += cell.state.temperature.value ** 2
-                wind_squared += cell.state.wind_speed.value ** 2
-                rain_squared += cell.state.rainfall.value ** 2
-                pollution_squared += cell.state.air_pollution.value ** 2
 
+    def statistics_history(self, samples=None):
+        """Copies of the daily statistics lists (their first samples days), by name."""
+        history = {name: values[:samples] for name, values in self.statistics.items()}
+        for name in Z_SCORES:
+            history[name] = getattr(self, name)[:samples]
+        return history
+
+    def set_statistics_history(self, history):
+        """Replaces the daily statistics lists with copies of a statistics_history."""
+        self.statistics = {name: list(history[name]) for name in self.statistics}
+        for name in Z_SCORES:
+            setattr(self, name, list(history[name]))
+
+    def record_statistics(self, totals):
+        """Records the statistics of a day from the world's state_totals."""
+        num_cells, (total_temperature, total_wind_speed, total_rainfall, total_pollution), \
+            (temp_squared, wind_squared, rain_squared, pollution_squared) = totals
         self.avg_temperature = total_temperature / num_cells
         self.avg_wind_speed = total_wind_speed / num_cells
         self.avg_rainfall = total_rainfall / num_cells
@@ -130,40 +179,167 @@ class Grid:
         self.z_score_pollution.append(
             self.avg_pollution - self.std_dev_pollution / self.days)
 
-    def set_neighbors_for_cells(self):
-        directions = {
-            (-1, -1): WindDirection.NORTHWEST,
-            (-1, 0): WindDirection.NORTH,
-            (-1, 1): WindDirection.NORTHEAST,
-            (0, -1): WindDirection.WEST,
-            (0, 1): WindDirection.EAST,
-            (1, -1): WindDirection.SOUTHWEST,
-            (1, 0): WindDirection.SOUTH,
-            (1, 1): WindDirection.SOUTHEAST
-        }
+    def get_average_temperature(self):
+        return 'gen. avg. temp = {:0.2f} '.format(self.avg_temperature) + \
+            '| {} |\n'.format(Temperature(round(self.avg_temperature)).name) + \
+            '| z-score = {:0.2f} '.format(self.z_score_temperature[-1]) + \
+            '| dev. = {:0.2f} |'.format(self.std_dev_temperature)
 
-        for x in range(self.rows):
-            for y in range(self.cols):
-                neighbors = {}
-                for dx, dy in directions.keys():
-                    nx, ny = x + dx, y + dy
-                    if 0 <= nx < self.rows and 0 <= ny < self.cols:
-                        neighbors[directions[(dx, dy)]] = self.grid[nx][ny]
-                self.grid[x][y].set_neighbors(neighbors)
+    def get_average_wind_speed(self):
+        return 'avg. wind speed {:0.2f} '.format(self.avg_wind_speed) + \
+            '| {} |\n'.format(WindSpeed(round(self.avg_wind_speed)).name) + \
+            '| z-score = {:0.2f} |'.format(self.z_score_wind_speed[-1]) + \
+            '| dev. = {:0.2f} |'.format(self.std_dev_wind_speed)
 
-    def next_day(self):
-        new_grid = [[None for _ in range(self.cols)] for _ in range(self.rows)]
+    def get_average_rainfall(self):
+        return '{:0.2f} '.format(self.avg_rainfall) + \
+            '| {} |\n'.format(Rain(round(self.avg_rainfall)).name) + \
+            '| z-score = {:0.2f} |'.format(self.z_score_rainfall[-1]) + \
+            '| dev. = {:0.2f} |'.format(self.std_dev_rainfall)
+
+    def get_average_pollution(self):
+        return 'avg. Pollution = {:0.2f}'.format(self.avg_pollution) + \
+            '| {} |\n'.format(AirQuality(round(self.avg_pollution)).name) + \
+            '| z-score = {:0.2f} |'.format(self.z_score_pollution[-1]) + \
+            '| dev. = {:0.2f} |'.format(self.std_dev_pollution)
 
-        for row in range(self.rows):
-            for col in range(self.cols):
-                cell = copy.deepcopy(self.grid[row][col])
-                cell.state = cell.update_state()
 
-                new_grid[row][col] = cell
-        self.days = self.days + 1
-        self.grid = new_grid
+class Grid(GridStatistics):
+    def __init__(self, rows, cols, engine=DEFAULT_ENGINE, verify=False, boundary='clamp',
+                 update_periods=None):
+        self.rows = rows
+        self.cols = cols
+        # neighbor index table of the grid's shape and boundary mode (see topology.py)
+        self.boundary = boundary
+        self.neighbor_table = neighbor_table(rows, cols, boundary)
+        # rule category -> update period in days (see scheduler.py), every day by default
+        self.update_periods = validate_periods(dict(update_periods or {}))
+        # engine computing the next day (see engines.py), with verify=True
+        # the reference engine runs side by side and any divergence raises EngineDivergence
+        self.engine = get_engine(engine)
+        if verify:
+            self.engine = VerifyingEngine(self.engine)
+        # own enabled flags of the rules (a tuple of one flag per rule of TransitionRules),
+        # None for the rules' own flags, see set_rule_enabled
+        self.rule_mask = None
+        self.grid = [[Cell(State(Landscape.LAND))
+                      for _ in range(cols)] for _ in range(rows)]
+        # the number of worlds sharing the cells (see fork), shared by them
+        self.cell_owners = [1]
+        self.set_neighbors_for_cells()
+        self.reset_statistics()
+        self.days = 1  # number of days passed - samples for statistics
+        # flat indices (row * cols + col) of the cells changed by the last day,
+        # None when the whole grid was replaced
+        self.changed_cells = None
+        self.metrics = None  # set to a metrics.PhaseMetrics to time the phases of next_day
         self.calculate_statistics()
 
+    def calculate_statistics(self):
+        self.record_statistics(state_totals(cell.state for row in self.grid for cell in row))
+
+    def set_neighbors_for_cells(self):
+        # The cells in row major order, indexed by the neighbor table
+        self.cells = [cell for row in self.grid for cell in row]
+        for index, cell in enumerate(self.cells):
+            cell.set_neighbors(Neighbors(self.cells, self.neighbor_table, index))
+        # the cells by land type, temperature and pollution (see spatial_index.py),
+        # kept up to date by commit_states
+        self.index = SpatialIndex(cell.state for cell in self.cells)
+
+    def fork(self):
+        """
+        A branch of the world, stepped on its own from the current day, e.g. with
+        another rule mask (see set_rule_enabled). The branch shares the cells, their
+        States and the spatial index with the world until either of them changes its
+        cells, which then copies them (copy-on-write), so forking only copies the
+        statistics history.
+        """
+        branch = copy.copy(self)
+        self.cell_owners[0] += 1
+        branch.set_statistics_history(self.statistics_history())
+        branch.update_periods = dict(self.update_periods)
+        branch.metrics = None
+        return branch
+
+    def own_cells(self):
+        """
+        Copies the cells shared with forks of the world, before they are changed. The
+        copies are new Cells: Cell references taken before (e.g. grid[row][col]) are
+        left to the forks, so hold on to (row, col) and look the cell up instead.
+        """
+        if self.cell_owners[0] == 1:
+            return
+        self.cell_owners[0] -= 1
+        self.cell_owners = [1]
+        self.grid = [[Cell(cell.state) for cell in row] for row in self.grid]
+        self.set_neighbors_for_cells()
+
+    def rule_enabled(self, rule):
+        """Whether rule (one of TransitionRules.rules) is enabled in this world."""
+        if self.rule_mask is None:
+            return rule['enabled']
+        return self.rule_mask[self._rule_index(rule)]
+
+    def set_rule_enabled(self, rule, enabled):
+        """
+        Enables or disables rule (one of TransitionRules.rules) in this world only,
+        the other worlds keep the rule's own flag.
+        """
+        mask = TransitionRules.enabled_flags(self.rule_mask)
+        mask[self._rule_index(rule)] = enabled
+        self.rule_mask = tuple(mask)
+
+    @staticmethod
+    def _rule_index(rule):
+        for index, candidate in enumerate(TransitionRules.rules):
+            if candidate is rule:
+                return index
+        raise ValueError(f"Unknown rule {rule.get('name')}")
+
+    def skipped_categories(self):
+        """The rule categories not updated on the coming day."""
+        return skipped_categories(self.update_periods, self.days - 1)
+
+    def next_day(self):
+        # All the new states are computed from the current day before any is committed,
+        # so every cell sees its neighbors' states of the same day
+        metrics = self.metrics
+        new_states = self.engine.compute_states(self, metrics)
+        if metrics is None:
+            self.commit_states(new_states)
+            self.days = self.days + 1
+            self.calculate_statistics()
+            return
+
+        # Same as above, timing each phase
+        with metrics.phase('state_commit'):
+            self.commit_states(new_states)
+        self.days = self.days + 1
+        with metrics.phase('calculate_statistics'):
+            self.calculate_statistics()
+
+    def commit_states(self, new_states):
+        """
+        Sets the new states (row major) on the cells, records which cells changed,
+        and moves them in the spatial index.
+        Unchanged cells keep their current State object. States are never changed
+        in place, so the snapshots of earlier days can share them.
+        """
+        self.own_cells()
+        changed_cells = []
+        spatial_index = self.index
+        index = 0
+        for row in self.grid:
+            for cell in row:
+                state = new_states[index]
+                if state.pack() != cell.state.pack():
+                    spatial_index.move(index, cell.state, state)
+                    cell.state = state
+                    changed_cells.append(index)
+                index += 1
+        self.changed_cells = changed_cells
+
     def apply_initial_conditions_csv(self, initial_conditions_file=None,
                                      initial_conditions=None):
         if initial_conditions_file is not None:
@@ -173,6 +349,7 @@ class Grid:
             raise ValueError(
                 "Must provide either initial_conditions_file or initial_conditions")
 
+        self.own_cells()
         for condition in initial_conditions:
             try:
                 x, y = condition['x'], condition['y']
@@ -186,47 +363,71 @@ class Grid:
             except Exception as e:
                 print(
                     f"Unexpected error applying initial conditions for cell at ({x}, {y}): {e}")
+        self.changed_cells = None
         self.set_neighbors_for_cells()
         self.calculate_statistics()
 
+    def snapshot(self):
+        """The states of the current day (see snapshots.py), cheap to take."""
+        return Snapshot(self.rows, self.cols, self.days - 1,
+                        [cell.state for row in self.grid for cell in row])
+
+    def restore(self, snapshot, statistics=None):
+        """
+        Sets the world to the states and day of a snapshot (e.g. from history.py).
+        The statistics of the snapshot's day are added to statistics (a
+        statistics_history of the days before it) when given, else to the current ones.
+        """
+        self.own_cells()
+        for cell, state in zip(self.cells, snapshot.states):
+            cell.state = state
+        self.index.rebuild(snapshot.states)
+        self.days = snapshot.day + 1
+        self.changed_cells = None
+        if statistics is not None:
+            self.set_statistics_history(statistics)
+        self.calculate_statistics()
+
     def export_state_to_csv(self, file_path):
-        with open(file_path, 'w', newline='') as csvfile:
-            fieldnames = ['x', 'y', 'land_type', 'temperature',
-                          'wind_speed', 'rainfall', 'air_pollution']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            for x in range(self.rows):
-                for y in range(self.cols):
-                    cell = self.grid[x][y]
-                    writer.writerow({
-                        'x': x, 'y': y,
-                        'land_type': cell.state.land_type.name,
-                        'temperature': cell.state.temperature.value,
-                        'wind_speed': cell.state.wind_speed.name,
-                        'rainfall': cell.state.rainfall.value,
-                        'air_pollution': cell.state.air_pollution.value
-                    })
+        # Blocks until written, see snapshots.BackgroundWriter to write in the background
+        write_csv(self.snapshot(), file_path)
 
     def __str__(self):
         return '\n\n'.join([f"Row {i}\n" + '\n'.join([str(cell) for cell in row])
                             for i, row in enumerate(self.grid, start=1)])
 
-    def reset(self):
+    def reset(self, initial_conditions_file='enums.csv'):
+        """
+        Sets the world back to its first day, with the conditions of the file applied.
+        The first reset with a file builds the world from it; the next ones copy
+        the cached states, spatial index and statistics totals of that world (until
+        the file changes), without parsing the file or rebuilding the cells again.
+        """
+        key = (os.path.abspath(initial_conditions_file),
+               os.stat(initial_conditions_file).st_mtime_ns, self.rows, self.cols)
+        self.reset_statistics()
+        pristine = pristine_worlds.get(key)
+        if pristine is not None:
+            snapshot, index, totals = pristine
+            self.own_cells()  # the cells shared with forks are left to them
+            for cell, state in zip(self.cells, snapshot.states):
+                cell.state = state
+            self.index = index.copy()
+            self.days = 1
+            self.changed_cells = None
+            self.record_statistics(totals)
+            return
+        # a new grid, the cells shared with forks are left to them
+        self.cell_owners[0] -= 1
+        self.cell_owners = [1]
         self.grid = [[Cell(State(Landscape.LAND))
                       for _ in range(self.cols)] for _ in range(self.rows)]
-        self.set_neighbors_for_cells()
-        self.statistics = {
-            'temperature': [],
-            'wind_speed': [],
-            'rainfall': [],
-            'pollution': []
-        }
-        self.z_score_temperature = []
-        self.z_score_wind_speed = []
-        self.z_score_rainfall = []
-        self.z_score_pollution = []
         self.days = 1
-        self.apply_initial_conditions_csv('enums.csv')
+        self.apply_initial_conditions_csv(initial_conditions_file)
+        for stale in [cached for cached in pristine_worlds if cached[0] == key[0]]:
+            del pristine_worlds[stale]  # of an older version of the file
+        snapshot = self.snapshot()
+        pristine_worlds[key] = (snapshot, self.index.copy(), state_totals(snapshot.states))
 
     def load_initial_conditions_csv(self, file_path='enums.csv'):
         conditions = []
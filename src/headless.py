@@ -0,0 +1,145 @@
+"""
+Headless simulation runner, for long production runs without the GUI.
+Example:
+    python headless.py --rows 6 --cols 6 --conditions enums.csv --days 3650 \\
+        --metrics metrics.prom --metrics-format prometheus --metrics-interval 10
+    python headless.py --days 3650 --autosave 365 --export-format binary
+    python headless.py --days 36500 --columnar out --columnar-cells temperature land_type
+    python headless.py --days 50 --allocations allocations.jsonl
+    python headless.py --days 3650 --periods LAND=7 TEMP=2
+    python headless.py --days 3650 --frames out.gif --frames-every 10
+While it runs, kill -USR1 <pid> profiles the next --profile-days days (see profile_capture.py).
+"""
+import argparse
+from engines import ENGINES, DEFAULT_ENGINE
+from grid import Grid
+from metrics import PhaseMetrics
+from topology import BOUNDARIES
+from scheduler import parse_period
+from snapshots import FORMATS, Autosave, BackgroundWriter
+from columnar import ColumnarExporter
+from allocations import AllocationTracker, format_summary
+from profile_capture import ProfileCapture
+from frame_export import FrameExporter
+from state import STATE_FIELDS
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the simulation without the GUI')
+    parser.add_argument('--rows', type=int, default=6)
+    parser.add_argument('--cols', type=int, default=6)
+    parser.add_argument('--conditions', default='enums.csv',
+                        help='initial conditions csv file (empty for an all LAND world)')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--boundary', choices=BOUNDARIES, default='clamp',
+                        help='what the cells at the edges of the grid see past the edge')
+    parser.add_argument('--periods', nargs='*', type=parse_period, default=[], metavar='CATEGORY=DAYS',
+                        help='update period of rule categories, e.g. LAND=7 TEMP=2 (see scheduler.py)')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default=DEFAULT_ENGINE)
+    parser.add_argument('--verify', action='store_true',
+                        help='run the reference engine side by side, stop at the first divergence')
+    parser.add_argument('--autosave', type=int, metavar='DAYS',
+                        help='save a snapshot every DAYS days, in the background')
+    parser.add_argument('--autosave-dir', default='autosave')
+    parser.add_argument('--export-format', choices=FORMATS, default='csv',
+                        help='format of the exports and autosaves (see snapshots.py)')
+    parser.add_argument('--columnar', metavar='DIR',
+                        help='write the daily statistics as .npy columns to DIR (see columnar.py)')
+    parser.add_argument('--columnar-cells', nargs='*', choices=STATE_FIELDS, default=[],
+                        metavar='ATTRIBUTE', help='also write the history of these cell attributes')
+    parser.add_argument('--allocations', metavar='FILE',
+                        help='track the allocations and GC pauses of the phases into FILE (slow)')
+    parser.add_argument('--allocations-every', type=int, default=1, metavar='N',
+                        help='track every N-th phase only')
+    parser.add_argument('--profile-days', type=int, default=10,
+                        help='days profiled when SIGUSR1 is received (see profile_capture.py)')
+    parser.add_argument('--profile-prefix', default='profile')
+    parser.add_argument('--frames', metavar='PATH',
+                        help='render the days to PATH, a directory of PNGs or a .gif (see frame_export.py)')
+    parser.add_argument('--frames-every', type=int, default=1, metavar='N', help='render every N-th day')
+    parser.add_argument('--frames-size', type=int, default=800, metavar='PIXELS')
+    parser.add_argument('--frames-fps', type=float, default=10.0, help='frames per second of a GIF')
+    parser.add_argument('--frames-workers', type=int, help='rendering processes, one per CPU by default')
+    parser.add_argument('--metrics', help='export phase timing metrics to this file')
+    parser.add_argument('--metrics-format', choices=['jsonl', 'prometheus'], default='jsonl')
+    parser.add_argument('--metrics-interval', type=float, default=60.0,
+                        help='seconds between metrics exports')
+    return parser.parse_args(argv)
+
+
+def build_world(args):
+    world = Grid(args.rows, args.cols, engine=args.engine, verify=args.verify,
+                 boundary=args.boundary, update_periods=dict(args.periods))
+    if args.conditions:
+        world.apply_initial_conditions_csv(args.conditions)
+    if args.metrics:
+        world.metrics = PhaseMetrics(export_path=args.metrics, export_format=args.metrics_format,
+                                     export_interval=args.metrics_interval)
+    return world
+
+
+def run(world, days, autosave=None, columnar=None, allocations=None, capture=None, frames=None):
+    for _ in range(days):
+        if capture is not None:
+            capture.step()
+        if allocations is not None:
+            with allocations.phase('next_day'):
+                world.next_day()
+        else:
+            world.next_day()
+        if autosave is not None:
+            autosave.maybe_save(world)
+        if columnar is not None:
+            columnar.record(world)
+        if frames is not None:
+            frames.record(world)
+        if world.metrics is not None:
+            world.metrics.maybe_export()
+    if world.metrics is not None:
+        world.metrics.export()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    world = build_world(args)
+    autosave = None
+    if args.autosave:
+        autosave = Autosave(BackgroundWriter(), args.autosave, args.autosave_dir, args.export_format)
+    columnar = None
+    if args.columnar:
+        columnar = ColumnarExporter(args.columnar, world, args.columnar_cells)
+        columnar.record(world)  # the initial day
+    allocations = None
+    if args.allocations:
+        allocations = AllocationTracker(args.allocations, every=args.allocations_every)
+    frames = None
+    if args.frames:
+        frames = FrameExporter(args.frames, world, args.frames_every, args.frames_size,
+                               args.frames_fps, args.frames_workers)
+        frames.record(world)  # the initial day
+    capture = ProfileCapture(args.profile_prefix, args.profile_days)
+    if not capture.install_signal_handler():
+        capture = None
+    run(world, args.days, autosave, columnar, allocations, capture, frames)
+    if frames is not None:
+        frames.close()
+    if capture is not None and capture.profiler is not None:
+        capture.stop()  # the run ended during a capture
+    if allocations is not None:
+        allocations.close()
+        print(format_summary(allocations.summary()))
+    if columnar is not None:
+        columnar.close()
+    if autosave is not None:
+        autosave.writer.close()
+        for file_path, error in autosave.writer.errors:
+            print(f'Autosave of {file_path} failed: {error}')
+    print(f'Day {world.days}')
+    print(world.get_average_temperature())
+    print(world.get_average_wind_speed())
+    print(world.get_average_rainfall())
+    print(world.get_average_pollution())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+This module holds the in-memory history of a world, to go back to any recent day
+without resetting and replaying the simulation.
+
+Every day recorded is either a keyframe, all the packed states (State.pack, one byte
+per attribute), or a delta: the packed states of the cells the day changed (the
+grid's changed_cells). A keyframe is stored every `keyframe_every` days, so going
+to a day applies at most keyframe_every - 1 deltas to a keyframe.
+
+The history keeps within budget bytes: the oldest keyframe and its deltas are
+dropped first, the latest keyframe is always kept. Going back to a day and stepping
+from it drops the days after it (a new timeline starts).
+
+Example:
+    history = History(world, keyframe_every=30, budget=64 * 1024 * 1024)
+    world.next_day(); history.record(world)
+    history.restore(world, history.first_day)
+"""
+import array
+from snapshots import Snapshot
+from state import State, STATE_FIELDS
+
+STATE_SIZE = len(STATE_FIELDS)
+
+
+def pack_states(states):
+    return bytes(value for state in states for value in state.pack())
+
+
+def unpack_states(packed, shared):
+    """The States of packed states, shared (packed state -> State) between the calls."""
+    states = []
+    for offset in range(0, len(packed), STATE_SIZE):
+        key = bytes(packed[offset:offset + STATE_SIZE])
+        state = shared.get(key)
+        if state is None:
+            state = shared[key] = State.unpack(key)
+        states.append(state)
+    return states
+
+
+class History:
+    """The recent days of a world, as keyframes and deltas (see the module docstring)."""
+
+    def __init__(self, world, keyframe_every=30, budget=64 * 1024 * 1024):
+        if keyframe_every < 1:
+            raise ValueError('Keyframes must be at least 1 day apart')
+        self.rows = world.rows
+        self.cols = world.cols
+        self.keyframe_every = keyframe_every
+        self.budget = budget
+        # segments of [keyframe, deltas...], oldest first; an entry is
+        # (day, statistics samples, packed states) for a keyframe,
+        # (day, statistics samples, array of cell indices, their packed states) for a delta
+        self.segments = []
+        self.size = 0  # bytes of the stored states and indices
+        self.states = {}  # packed state -> the shared State, for the restored days
+        # the world's statistics lists of the last day, while a day of the past is shown
+        self.saved_statistics = None
+        self.record(world)
+
+    @property
+    def first_day(self):
+        return self.segments[0][0][0]
+
+    @property
+    def last_day(self):
+        return self.segments[-1][-1][0]
+
+    def __contains__(self, day):
+        return bool(self.segments) and self.first_day <= day <= self.last_day
+
+    @staticmethod
+    def _entry_size(entry):
+        if len(entry) == 3:
+            return len(entry[2])
+        return len(entry[3]) + entry[2].itemsize * len(entry[2])
+
+    def record(self, world):
+        """Records the world's current day, call it after every next_day."""
+        day = world.days - 1
+        samples = len(world.statistics['temperature'])
+        self.saved_statistics = None
+        if self.segments and day <= self.last_day:
+            self.truncate(day - 1)  # stepping from a day of the past
+        changed = world.changed_cells
+        last = self.segments[-1] if self.segments else None
+        # a delta larger than a keyframe is stored as a keyframe
+        if last is None or changed is None or last[-1][0] != day - 1 \
+                or len(last) >= self.keyframe_every \
+                or len(changed) * (STATE_SIZE + 4) >= len(world.cells) * STATE_SIZE:
+            entry = (day, samples, pack_states(cell.state for cell in world.cells))
+            self.segments.append([entry])
+        else:
+            cells = world.cells
+            entry = (day, samples, array.array('I', changed),
+                     pack_states(cells[index].state for index in changed))
+            last.append(entry)
+        self.size += self._entry_size(entry)
+        while self.size > self.budget and len(self.segments) > 1:
+            self.size -= sum(self._entry_size(entry) for entry in self.segments.pop(0))
+
+    def truncate(self, day):
+        """Drops the days after day."""
+        while self.segments and self.last_day > day:
+            segment = self.segments[-1]
+            self.size -= self._entry_size(segment.pop())
+            if not segment:
+                self.segments.pop()
+
+    def _find(self, day):
+        for segment in reversed(self.segments):
+            if segment[0][0] <= day:
+                return segment
+        raise KeyError(f'Day {day} is not in the history')
+
+    def packed(self, day):
+        """(packed states, statistics samples) of a recorded day."""
+        if day not in self:
+            raise KeyError(f'Day {day} is not in the history (days {self.first_day} to {self.last_day})')
+        segment = self._find(day)
+        _, samples, keyframe = segment[0]
+        packed = bytearray(keyframe)
+        for entry in segment[1:]:
+            if entry[0] > day:
+                break
+            _, samples, indices, data = entry
+            for i, index in enumerate(indices):
+                packed[index * STATE_SIZE:(index + 1) * STATE_SIZE] = \
+                    data[i * STATE_SIZE:(i + 1) * STATE_SIZE]
+        return packed, samples
+
+    def snapshot(self, day):
+        """The Snapshot of a recorded day (see snapshots.py)."""
+        packed, _ = self.packed(day)
+        return self._snapshot(day, packed)
+
+    def _snapshot(self, day, packed):
+        return Snapshot(self.rows, self.cols, day, unpack_states(packed, self.states))
+
+    def restore(self, world, day):
+        """Sets the world back (or forward) to a recorded day, statistics included."""
+        packed, samples = self.packed(day)
+        if self.saved_statistics is None:
+            self.saved_statistics = world.statistics_history()
+        # the statistics of the days before it, the day's own are recomputed
+        world.restore(self._snapshot(day, packed), {name: values[:samples - 1]
+                                           for name, values in self.saved_statistics.items()})
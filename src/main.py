@@ -1,6 +1,8 @@
 """
 This file contains the main simulation loop and the PygameSimulationGUI class.
 """
+from time import perf_counter
+STARTED = perf_counter()  # for the time to the first frame, before the imports
 import pygame
 import sys
 import asyncio
@@ -9,10 +11,49 @@ from grid import Grid
 from state import *
 from CA import *
 from rules import TransitionRules
+from viewport import Viewport, MipmapPyramid
+from ui_cache import TextCache, Layer
 import random
 import os
+import argparse
+from metrics import PhaseMetrics
+from engines import ENGINES, DEFAULT_ENGINE
+from topology import BOUNDARIES
+from scheduler import parse_period
+from snapshots import FORMATS, EXTENSIONS, Autosave, BackgroundWriter
+from profile_capture import ProfileCapture
+from history import History
+from sharding import parse_address
+from atlas import Atlas, find_images_directory
 
 DAYS_PER_YEAR = 365
+ZOOM_STEP = 1.25
+PAN_STEP = 50
+# cells smaller than this are drawn without the landscape images and effects
+MIN_DETAILED_CELL_PIXELS = 24
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Roboto-Regular.ttf')
+
+# Screen areas of the GUI layers: the grid on the left, the panels on the right
+GRID_WIDTH = 800
+STATS_PANEL = (800, 0, 600, 300)
+CONTROLS_PANEL = (800, 300, 600, 50)
+CHECKBOX_PANEL_TOP = 350
+# The timeline slider, at the bottom of the stats panel (in the panel's coordinates)
+TIMELINE = (10, STATS_PANEL[3] - 22, STATS_PANEL[2] - 20, 12)
+RULE_PROFILE_FILE = 'rule_profile'
+PROFILE_CAPTURE_FRAMES = 120
+
+# Loaded gradient images by (path, size), so they are read from disk only once
+gradient_cache = {}
+# The landscape and gradient images, from the prebuilt atlas of gradient_images when
+# there is one (see atlas.py), else from their own files
+images = Atlas(find_images_directory())
+
+
+def landscape_image_paths():
+    return {land_type: os.path.join(images.directory, f'{land_type.name}.png')
+            for land_type in [Landscape.SEA, Landscape.LAND, Landscape.ICE, Landscape.FOREST, Landscape.CITY]}
+
 
 def hex_to_rgb(hex_color):
     hex_color = hex_color.lstrip('#')  # Remove '#' at the start of the string
@@ -71,15 +112,37 @@ def draw_rain(screen, rect, intensity, direction):
         end_pos = (start_pos[0] + direction_vector[0] * length, start_pos[1] + direction_vector[1] * length)
         pygame.draw.line(screen, rain_color, start_pos, end_pos, thickness)
 
+def blit_gradient_image(screen, rect, gradient_path):
+    key = (gradient_path, rect.size)
+    if key not in gradient_cache:
+        gradient_image = images.load(gradient_path)
+        if gradient_image.get_size() != rect.size:
+            # The image was saved for another size (e.g. before zooming)
+            gradient_image = pygame.transform.scale(gradient_image, rect.size)
+        gradient_cache[key] = gradient_image
+    screen.blit(gradient_cache[key], rect)
+
+
+def save_gradient_image(surface, gradient_path):
+    # Written under a temporary name first, so a renderer in another process
+    # (see frame_export.py) never loads a half written image
+    temporary_path = f"{gradient_path[:-4]}_{os.getpid()}.png"
+    pygame.image.save(surface, temporary_path)
+    os.replace(temporary_path, gradient_path)
+
+
 def draw_3d_rect_stripes(screen, rect, color_hex):
+    gradient_name = f"{color_hex}_gradient_stripes.png"
+    gradient_path = os.path.join(images.directory, gradient_name)
+    if (gradient_path, rect.size) in gradient_cache:
+        screen.blit(gradient_cache[(gradient_path, rect.size)], rect)
+        return
+
     color = hex_to_rgb(color_hex)
     darker_color = [max(0, c - 50) for c in color]
     lighter_color = [min(255, c + 50) for c in color]
 
-    gradient_name = f"{color_hex}_gradient_stripes.png"
-    gradient_path = os.path.join("gradient_images", gradient_name)
-
-    if not os.path.exists(gradient_path):
+    if not images.exists(gradient_path):
         # Create surfaces for the darker and lighter colors
         darker_surface = pygame.Surface((rect.width, rect.height))
         lighter_surface = pygame.Surface((rect.width, rect.height))
@@ -102,21 +165,23 @@ def draw_3d_rect_stripes(screen, rect, color_hex):
             gradient_surface.blit(line_surface, (0, y))  # Blit the line surface onto the gradient surface
 
         # Save the gradient surface as an image
-        pygame.image.save(gradient_surface, gradient_path)
+        save_gradient_image(gradient_surface, gradient_path)
 
     # Load the gradient image and draw it onto the screen
-    gradient_image = pygame.image.load(gradient_path)
-    screen.blit(gradient_image, rect)
+    blit_gradient_image(screen, rect, gradient_path)
 
 def draw_3d_rect(screen, rect, color_hex):
+    gradient_name = f"{color_hex}_gradient.png"
+    gradient_path = os.path.join(images.directory, gradient_name)
+    if (gradient_path, rect.size) in gradient_cache:
+        screen.blit(gradient_cache[(gradient_path, rect.size)], rect)
+        return
+
     color = hex_to_rgb(color_hex)
     darker_color = [max(0, c - 100) for c in color]  # Increase the difference for a stronger 3D effect
     lighter_color = [min(255, c + 100) for c in color]  # Increase the difference for a stronger 3D effect
 
-    gradient_name = f"{color_hex}_gradient.png"
-    gradient_path = os.path.join("gradient_images", gradient_name)
-
-    if not os.path.exists(gradient_path):
+    if not images.exists(gradient_path):
         # Create a gradient surface
         gradient_surface = pygame.Surface((rect.width, rect.height), pygame.SRCALPHA)
         # color it with the darker color
@@ -143,11 +208,10 @@ def draw_3d_rect(screen, rect, color_hex):
                 gradient_surface.set_at((x, y), color)  # Set the pixel color on the gradient surface
 
         # Save the gradient surface as an image
-        pygame.image.save(gradient_surface, gradient_path)
+        save_gradient_image(gradient_surface, gradient_path)
 
     # Load the gradient image and draw it onto the screen
-    gradient_image = pygame.image.load(gradient_path)
-    screen.blit(gradient_image, rect)
+    blit_gradient_image(screen, rect, gradient_path)
 
 
 class PygameSimulationGUI:
@@ -159,20 +223,34 @@ class PygameSimulationGUI:
 
         # Initialize world and GUI state
         self.world = world
-        self.dirty = True
+        self.world_version = 0  # bumped whenever the world changes
         self.is_simulation_running = False
         self.days = 0
         self.years = 0
-        self.clean_checkboxes = True
 
         # Initialize stats and tooltips
-        self.stats_history = [[], [], [], []]  # Initialize to empty lists
-        self.tooltip_font = pygame.font.Font('Roboto-Regular.ttf', 13)
-        self.hovered_cell = None
-        self.scroll_offset = 0
+        # (day of the year, value) of the statistics of the shown year, up to the shown day
+        self.stats_history = [[], [], [], []]
+        self.text_cache = TextCache()
+        self.hovered_cell = None  # (world, row, col), the cell is looked up when drawn
+        self.tooltip = (None, None)  # (key, surface) of the last rendered tooltip
+        self.tooltip_rect = None  # where the tooltip was drawn on the screen
+        self.dirty_rects = []  # the areas of the screen changed by the last draw
+
+        # Initialize the camera over the grid and its level of detail pyramid
+        self.viewport = Viewport(world.rows, world.cols, GRID_WIDTH, height)
+        self.mipmap = MipmapPyramid(world)
+        self.panning = False
+        # A fork of the world shown on the right half of the grid area (F), with its
+        # own rule checkboxes, its camera follows the world's
+        self.branch = None
+        self.branch_viewport = None
+        self.branch_mipmap = None
 
         # Initialize images
-        self.cell_images = self.load_images()
+        self.landscape_images = {}
+        self.scaled_images = {}
+        self.cell_images = None  # loaded on the first detailed draw, see draw_grid_cells
 
         # Initialize buttons
         button_spacing = 150
@@ -189,12 +267,54 @@ class PygameSimulationGUI:
         # Initialize checkboxes
         self.rule_checkboxes = self.setup_rules_checkboxes()
 
+        # Initialize the layers, composed into one frame surface
+        self.grid_layer = Layer((0, 0, GRID_WIDTH, height), self.draw_grid)
+        self.stats_layer = Layer(STATS_PANEL, self.draw_date)
+        self.controls_layer = Layer(CONTROLS_PANEL, self.draw_buttons)
+        self.checkbox_layer = Layer(
+            (GRID_WIDTH, CHECKBOX_PANEL_TOP, width - GRID_WIDTH, height - CHECKBOX_PANEL_TOP),
+            self.draw_checkboxes)
+        self.layers = [self.grid_layer, self.stats_layer,
+                       self.controls_layer, self.checkbox_layer]
+        self.frame = pygame.Surface((width, height))
+        self.metrics = None  # set to a metrics.PhaseMetrics to time the draw functions
+
+        # Exports are written in the background (see snapshots.py)
+        self.writer = BackgroundWriter()
+        # what went wrong with the last export or autosave, shown in the status text
+        self.export_status = None
+        self.writer_errors_seen = 0
+        self.writer_dropped_seen = 0
+        self.export_format = 'csv'
+        self.autosave = None  # set to a snapshots.Autosave using self.writer
+        self.allocations = None  # set to an allocations.AllocationTracker to track next_day and draw
+        self.capture = ProfileCapture(count=PROFILE_CAPTURE_FRAMES)  # F9 profiles the next frames
+        # The recent days, to go back to with the timeline (see history.py)
+        self.history = History(world)
+        self.scrubbing = False
+        # set to a stream.StreamClient to show a server's world instead of stepping it here
+        self.stream = None
+        self.music = None  # path of the music, started after the first frame
+        self.first_frame_seconds = None  # from the start of the program
+        self.startup_check = False  # quit after the first frame
+        self.update_stats_history()
+
     def reset(self):
+        if self.stream is not None:
+            return  # the server owns the world
+        if self.branch is not None:
+            self.toggle_branch()
         self.world.reset()
+        self.history = History(self.world, self.history.keyframe_every, self.history.budget)
+        self.world_version += 1
+        self.mipmap.update(self.world.changed_cells)
         self.days = 0
         self.years = 0
+        self.update_stats_history()
 
     def get_status_text(self):
+        if self.export_status is not None:
+            return f"Year: {self.years}, Day: {self.days} - {self.export_status}"
         return f"Year: {self.years}, Day: {self.days}"
 
     async def toggle_simulation(self):
@@ -204,9 +324,130 @@ class PygameSimulationGUI:
             self.next_day()
 
     def next_day(self):
-        self.dirty = True
-        self.world.next_day()
+        if self.stream is not None:
+            return  # the days come from the server, see apply_stream
+        if self.allocations is not None:
+            with self.allocations.phase('next_day'):
+                self.world.next_day()
+        else:
+            self.world.next_day()
+        self.history.record(self.world)
+        if self.branch is not None:
+            self.branch.next_day()
+            self.branch_mipmap.update(self.branch.changed_cells)
+        self.world_version += 1
+        self.mipmap.update(self.world.changed_cells)
         self.update_date()
+        self.update_stats_history()
+        if self.autosave is not None:
+            self.autosave.maybe_save(self.world)
+
+    def toggle_branch(self):
+        # Forks the world, shown side by side with it, or drops the fork
+        if self.stream is not None:
+            return
+        world, height = self.world, self.screen.get_height()
+        half = GRID_WIDTH // 2
+        if self.branch is None:
+            self.branch = world.fork()
+            self.viewport = Viewport(world.rows, world.cols, half, height)
+            self.branch_viewport = Viewport(world.rows, world.cols, GRID_WIDTH - half, height, x=half)
+            self.branch_mipmap = MipmapPyramid(self.branch)
+        else:
+            self.branch = self.branch_viewport = self.branch_mipmap = None
+            self.viewport = Viewport(world.rows, world.cols, GRID_WIDTH, height)
+        for checkbox in self.rule_checkboxes:
+            checkbox['checked'] = self.rules_world().rule_enabled(checkbox['rule'])
+        self.hovered_cell = None
+        self.world_version += 1
+
+    def rules_world(self):
+        # The world of the rule checkboxes: the branch when there is one
+        return self.branch if self.branch is not None else self.world
+
+    def locate(self, pos):
+        """
+        (world, position) of a screen position: the branch's side is mapped onto the
+        world's viewport, as both show the same cells.
+        """
+        if self.branch is not None and self.branch_viewport.contains(pos):
+            return self.branch, (pos[0] - self.branch_viewport.x + self.viewport.x, pos[1])
+        return self.world, pos
+
+    def go_to_day(self, day):
+        # Shows a day of the history, stepping on from it drops the days after it
+        if self.stream is not None:
+            return
+        history = self.history
+        day = max(history.first_day, min(day, history.last_day))
+        if day == self.world.days - 1:
+            return
+        self.is_simulation_running = False
+        if self.branch is not None:
+            self.toggle_branch()
+        history.restore(self.world, day)
+        self.world_version += 1
+        self.mipmap.update(self.world.changed_cells)
+        self.years, self.days = divmod(day, DAYS_PER_YEAR)
+        self.update_stats_history()
+
+    def timeline_rect(self):
+        x, y, width, height = TIMELINE
+        return pygame.Rect(STATS_PANEL[0] + x, STATS_PANEL[1] + y, width, height)
+
+    def scrub(self, pos):
+        # The day under the mouse on the timeline
+        rect = self.timeline_rect()
+        history = self.history
+        fraction = min(max((pos[0] - rect.x) / rect.width, 0.0), 1.0)
+        self.go_to_day(history.first_day + round(fraction * (history.last_day - history.first_day)))
+
+    def draw_timeline(self, surface):
+        history = self.history
+        rect = pygame.Rect(TIMELINE)
+        pygame.draw.rect(surface, (40, 40, 60), rect)
+        span = max(history.last_day - history.first_day, 1)
+        knob_x = rect.x + (self.world.days - 1 - history.first_day) / span * rect.width
+        pygame.draw.rect(surface, (255, 255, 255), pygame.Rect(knob_x - 3, rect.y - 3, 6, rect.height + 6))
+        label = self.text_cache.render(f'days {history.first_day} - {history.last_day}', 13,
+                                       (255, 255, 255), FONT_PATH)
+        surface.blit(label, (rect.right - label.get_width(), rect.y - label.get_height() - 4))
+
+    def apply_stream(self):
+        # Applies the days received from the server since the last frame
+        messages = self.stream.poll()
+        if not messages:
+            return
+        changed = set()
+        for message in messages:
+            self.stream.apply(self.world, message)
+            if changed is not None and self.world.changed_cells is not None:
+                changed.update(self.world.changed_cells)
+            else:
+                changed = None
+        self.world_version += 1
+        self.mipmap.update(None if changed is None else sorted(changed))
+        self.years, self.days = divmod(self.world.days - 1, DAYS_PER_YEAR)
+        self.update_stats_history()
+
+    def export(self):
+        # Only takes the snapshot, the file is written by the writer's thread
+        if self.writer.submit(self.world.snapshot(), f'exported_state.{EXTENSIONS[self.export_format]}',
+                              self.export_format):
+            self.export_status = None
+        self.check_writer()
+
+    def check_writer(self):
+        # Shows the exports and autosaves dropped or failed since the last check
+        writer = self.writer
+        if len(writer.errors) > self.writer_errors_seen:
+            self.writer_errors_seen = len(writer.errors)
+            file_path, error = writer.errors[-1]
+            print(f'Export of {file_path} failed: {error}')
+            self.export_status = f'{os.path.basename(file_path)} failed ({type(error).__name__})'
+        elif writer.dropped > self.writer_dropped_seen:
+            self.writer_dropped_seen = writer.dropped
+            self.export_status = 'export dropped, the writer is busy'
 
     def update_date(self):
         self.days += 1
@@ -214,40 +455,45 @@ class PygameSimulationGUI:
             self.years += 1
             self.days = 0
 
-    def draw_buttons(self):
-        pygame.draw.rect(self.screen, (0, 128, 0), self.start_button)
-        pygame.draw.rect(self.screen, (128, 0, 0), self.next_day_button)
-        pygame.draw.rect(self.screen, (0, 0, 128), self.export_button)
-        pygame.draw.rect(self.screen, (128, 128, 0), self.reset_button)
+    def draw_buttons(self, surface):
+        origin = (-CONTROLS_PANEL[0], -CONTROLS_PANEL[1])
+        pygame.draw.rect(surface, (0, 128, 0), self.start_button.move(origin))
+        pygame.draw.rect(surface, (128, 0, 0), self.next_day_button.move(origin))
+        pygame.draw.rect(surface, (0, 0, 128), self.export_button.move(origin))
+        pygame.draw.rect(surface, (128, 128, 0), self.reset_button.move(origin))
 
-        font = pygame.font.Font(None, 36)
+        white = (255, 255, 255)
         start_text = "Pause" if self.is_simulation_running else "Start"
-        start_surface = font.render(start_text, True, (255, 255, 255))
-        next_day_surface = font.render("Next Day", True, (255, 255, 255))
-        export_surface = font.render("Export", True, (255, 255, 255))
-        reset_surface = font.render("Reset", True, (255, 255, 255))
-        # Set up buttons
+        start_surface = self.text_cache.render(start_text, 36, white)
+        next_day_surface = self.text_cache.render("Next Day", 36, white)
+        export_surface = self.text_cache.render("Export", 36, white)
+        reset_surface = self.text_cache.render("Reset", 36, white)
+        # Set up buttons (in the panel's coordinates)
         button_spacing = 150
         button_width = 150
         button_height = 50
-        base_x = 800
-        base_y = 300
+        base_x = 0
+        base_y = 0
 
-        self.screen.blit(start_surface, (base_x + button_width / 2 - start_surface.get_width() /
+        surface.blit(start_surface, (base_x + button_width / 2 - start_surface.get_width() /
                          2, base_y + button_height / 2 - start_surface.get_height() / 2))
-        self.screen.blit(next_day_surface, (base_x + button_spacing + button_width / 2 -
+        surface.blit(next_day_surface, (base_x + button_spacing + button_width / 2 -
                          next_day_surface.get_width() / 2, base_y + button_height / 2 - next_day_surface.get_height() / 2))
-        self.screen.blit(export_surface, (base_x + 2 * button_spacing + button_width / 2 -
+        surface.blit(export_surface, (base_x + 2 * button_spacing + button_width / 2 -
                          export_surface.get_width() / 2, base_y + button_height / 2 - export_surface.get_height() / 2))
-        self.screen.blit(reset_surface, (base_x + 3 * button_spacing + button_width / 2 -
+        surface.blit(reset_surface, (base_x + 3 * button_spacing + button_width / 2 -
                          reset_surface.get_width() / 2, base_y + button_height / 2 - reset_surface.get_height() / 2))
 
     def load_images(self):
-        cell_width, cell_height = 800 / self.world.cols, self.screen.get_height() / self.world.rows
+        """Returns the landscape images scaled for the current cell size (cached per size)."""
+        cell_width, cell_height = int(self.viewport.cell_width), int(self.viewport.cell_height)
+        if (cell_width, cell_height) in self.scaled_images:
+            return self.scaled_images[(cell_width, cell_height)]
         cell_images = {}
-        for land_type in [Landscape.SEA, Landscape.LAND, Landscape.ICE, Landscape.FOREST, Landscape.CITY]:
-            image = pygame.image.load(
-                f'./gradient_images/{land_type.name}.png').convert_alpha()
+        for land_type, image_path in landscape_image_paths().items():
+            if land_type not in self.landscape_images:
+                self.landscape_images[land_type] = images.load(image_path).convert_alpha()
+            image = self.landscape_images[land_type]
             original_width, original_height = image.get_size()
             aspect_ratio = original_height / original_width
             new_height = int(cell_width * aspect_ratio)
@@ -271,70 +517,152 @@ class PygameSimulationGUI:
                 image, (temp_width, temp_height))
             # Store the position as a tuple
             cell_images[land_type] = [scaled_image, (pos_x, pos_y)]
+        self.scaled_images[(cell_width, cell_height)] = cell_images
         return cell_images
 
-    def draw_grid(self):
-        rows, cols = self.world.rows, self.world.cols
-        cell_width, cell_height = 800 / cols, self.screen.get_height() / rows
-
-        for y in range(rows):
-            for x in range(cols):
-                cell = self.world.grid[y][x]
-                rect = pygame.Rect(x * cell_width, y *
-                                   cell_height, cell_width, cell_height)
-                draw_3d_rect(self.screen, rect, cell.state.get_state_color())
+    def draw_grid(self, surface):
+        self.draw_world(surface, self.world, self.viewport, self.mipmap)
+        if self.branch is not None:
+            self.draw_world(surface, self.branch, self.branch_viewport, self.branch_mipmap)
+            pygame.draw.line(surface, (255, 255, 255), (self.branch_viewport.x, 0),
+                             (self.branch_viewport.x, surface.get_height()), 2)
+            for label, viewport in (('World', self.viewport), ('Branch', self.branch_viewport)):
+                surface.blit(self.text_cache.render(label, 20, (255, 255, 255), FONT_PATH),
+                             (viewport.x + 10, viewport.height - 30))
+
+    def draw_world(self, surface, world, viewport, mipmap):
+        level = viewport.lod_level(mipmap.max_level)
+        surface.set_clip(pygame.Rect(
+            viewport.x, viewport.y, viewport.width, viewport.height))
+        if level > 0:
+            self.draw_grid_blocks(surface, level, viewport, mipmap)
+        else:
+            self.draw_grid_cells(surface, world, viewport)
+        surface.set_clip(None)
+
+    def draw_grid_cells(self, surface, world, viewport):
+        cell_width, cell_height = viewport.cell_width, viewport.cell_height
+        detailed = min(cell_width, cell_height) >= MIN_DETAILED_CELL_PIXELS
+        if detailed:
+            self.cell_images = self.load_images()
+        first_row, last_row, first_col, last_col = viewport.visible_range()
+
+        for y in range(first_row, last_row):
+            for x in range(first_col, last_col):
+                cell = world.grid[y][x]
+                left, top = viewport.cell_to_screen(y, x)
+                rect = pygame.Rect(left, top, cell_width, cell_height)
+                if not detailed:
+                    surface.fill(hex_to_rgb(cell.state.get_state_color()), rect)
+                    continue
+                draw_3d_rect(surface, rect, cell.state.get_state_color())
                 pack = self.cell_images[cell.state.land_type]
                 try:
-                    surface, (pos_x, pos_y) = pack
-                    self.screen.blit(
-                        surface, (x * cell_width + pos_x, y * cell_height + pos_y + 20))
+                    image, (pos_x, pos_y) = pack
+                    surface.blit(
+                        image, (left + pos_x, top + pos_y + 20))
                 except TypeError:
                     print(pack)
                 if cell.state.land_type == Landscape.ICE:
-                    draw_ice(self.screen, rect)
+                    draw_ice(surface, rect)
                 elif cell.state.land_type == Landscape.CITY:
-                    draw_rain(self.screen, rect, 10, "SOUTH")
-                    draw_clouds(self.screen, rect,
+                    draw_rain(surface, rect, 10, "SOUTH")
+                    draw_clouds(surface, rect,
                                 cell.state.get_state_color(), cell_width, x, y)
 
+    def draw_grid_blocks(self, surface, level, viewport, mipmap):
+        # Zoomed out: draw the aggregated blocks of the mipmap pyramid
+        block = 2 ** level
+        block_width, block_height = viewport.cell_width * block, viewport.cell_height * block
+        first_row, last_row, first_col, last_col = viewport.visible_range(block)
+
+        for block_row in range(first_row, last_row):
+            for block_col in range(first_col, last_col):
+                left, top = viewport.cell_to_screen(block_row * block, block_col * block)
+                rect = pygame.Rect(left, top, block_width + 1, block_height + 1)
+                color = mipmap.block_color(level, block_row, block_col)
+                surface.fill(hex_to_rgb(color), rect)
+
     def handle_events(self):
-        cell_width, cell_height = 800 / self.world.cols, self.screen.get_height() / self.world.rows
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
+                self.writer.close()  # finish the pending exports
+                if self.allocations is not None:
+                    self.allocations.close()
+                if self.capture.profiler is not None:
+                    self.capture.stop()
+                if self.stream is not None:
+                    self.stream.close()
                 pygame.quit()
                 sys.exit()
+            # zoom the grid with the mouse wheel when over the grid
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (4, 5) \
+                    and self.viewport.contains(self.locate(event.pos)[1]):
+                factor = ZOOM_STEP if event.button == 4 else 1 / ZOOM_STEP
+                self.viewport.zoom_at(factor, self.locate(event.pos)[1])
+                self.update_hovered_cell(event.pos)
+            # pan the grid by dragging with the right or middle mouse button
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (2, 3) \
+                    and self.viewport.contains(self.locate(event.pos)[1]):
+                self.panning = True
+            elif event.type == pygame.MOUSEBUTTONUP and event.button in (2, 3):
+                self.panning = False
+            elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+                self.scrubbing = False
+            # one day back / forward in the history
+            elif event.type == pygame.KEYDOWN and event.key in (K_COMMA, K_PERIOD):
+                self.go_to_day(self.world.days - 1 + (1 if event.key == K_PERIOD else -1))
+            elif event.type == pygame.KEYDOWN and event.key in (K_LEFT, K_RIGHT, K_UP, K_DOWN):
+                dx = PAN_STEP if event.key == K_LEFT else -PAN_STEP if event.key == K_RIGHT else 0
+                dy = PAN_STEP if event.key == K_UP else -PAN_STEP if event.key == K_DOWN else 0
+                self.viewport.pan(dx, dy)
+            elif event.type == pygame.KEYDOWN and event.key == K_HOME:
+                self.viewport.fit()
+            elif event.type == pygame.KEYDOWN and event.key == K_p:
+                self.toggle_rule_profiling()
+            elif event.type == pygame.KEYDOWN and event.key == K_f:
+                self.toggle_branch()
+            elif event.type == pygame.KEYDOWN and event.key == K_F9:
+                self.capture.request()
             # check if scroll event
             elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 4:
-                if self.rule_checkboxes[0]['rect'].y <= 350:
-                    self.clean_checkboxes = True
-                    self.scroll_offset += 1
+                if self.rule_checkboxes[0]['rect'].y <= CHECKBOX_PANEL_TOP:
+                    self.scroll_checkboxes(1)
             elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 5:
                 if self.rule_checkboxes[-1]['rect'].y > self.screen.get_height() - 50:
-                    self.clean_checkboxes = True
-                    self.scroll_offset -= 1
+                    self.scroll_checkboxes(-1)
 
             elif event.type == pygame.MOUSEMOTION:
-                self.dirty = True
-
-                x, y = pygame.mouse.get_pos()
-                cell_x, cell_y = int(x // cell_width), int(y // cell_height)
-                if cell_y < self.world.rows and cell_x < self.world.cols:
-                    self.hovered_cell = self.world.grid[cell_y][cell_x]
-                else:
-                    self.hovered_cell = None
+                if self.panning:
+                    self.viewport.pan(*event.rel)
+                if self.scrubbing:
+                    self.scrub(event.pos)
+                self.update_hovered_cell(event.pos)
             elif event.type == pygame.MOUSEBUTTONDOWN:
-                self.dirty = True
-                if self.start_button.collidepoint(event.pos):
+                if self.timeline_rect().collidepoint(event.pos):
+                    self.scrubbing = True
+                    self.scrub(event.pos)
+                elif self.start_button.collidepoint(event.pos):
                     asyncio.create_task(self.toggle_simulation())
                 elif self.next_day_button.collidepoint(event.pos):
                     self.next_day()
                 elif self.export_button.collidepoint(event.pos):
-                    pass
+                    self.export()
                 elif self.reset_button.collidepoint(event.pos):
                     self.reset()
                 else:
                     self.handle_rule_checkbox_click(event.pos)
-                    self.clean_checkboxes = True
+
+    def update_hovered_cell(self, pos):
+        # Hit-testing goes through the same transform used for drawing
+        world, pos = self.locate(pos)
+        cell = self.viewport.screen_to_cell(pos)
+        if cell is not None:
+            # not the Cell itself: a world copies its cells when it stops sharing them
+            # with its branch (Grid.own_cells)
+            self.hovered_cell = (world, *cell)
+        else:
+            self.hovered_cell = None
 
     def handle_rule_checkbox_click(self, pos):
         for checkbox in self.rule_checkboxes:
@@ -343,7 +671,33 @@ class PygameSimulationGUI:
                 self.update_rule_state(checkbox['rule'], checkbox['checked'])
 
     def update_rule_state(self, rule, checked):
-        rule['enabled'] = checked
+        if self.branch is not None:
+            # only the branch, to compare it with the world
+            self.branch.set_rule_enabled(rule, checked)
+        else:
+            rule['enabled'] = checked
+
+    def toggle_rule_profiling(self):
+        # While profiling, the rules statistics are shown next to the checkboxes,
+        # and dumped to files when profiling is turned off
+        if TransitionRules.profiler is None:
+            TransitionRules.enable_profiling()
+        else:
+            profiler = TransitionRules.disable_profiling()
+            profiler.dump_csv(f'{RULE_PROFILE_FILE}.csv', sort_by='total_time')
+            profiler.dump_json(f'{RULE_PROFILE_FILE}.json', sort_by='total_time')
+            print(f'Rule profile saved to {RULE_PROFILE_FILE}.csv / .json')
+
+    def scroll_checkboxes(self, offset):
+        for checkbox in self.rule_checkboxes:
+            checkbox['rect'].y += offset * 10
+
+    def get_hovered_checkbox(self):
+        pos = pygame.mouse.get_pos()
+        for i, checkbox in enumerate(self.rule_checkboxes):
+            if checkbox['rect'].collidepoint(pos):
+                return i
+        return None
 
     def setup_rules_checkboxes(self):
         rule_checkboxes = []
@@ -352,127 +706,294 @@ class PygameSimulationGUI:
                 800, 350 + len(rule_checkboxes) * 50, 600, 50)})
         return rule_checkboxes
 
-    def draw_checkboxes(self):
-        scroll_offset = self.scroll_offset
-        font = self.tooltip_font
-        mx, my = pygame.mouse.get_pos()
-        screen_height = self.screen.get_height()  # Get the height of the screen
+    def draw_checkboxes(self, surface):
+        hovered = self.get_hovered_checkbox()
+        panel_bottom = self.screen.get_height()  # Get the height of the screen
+        origin = (-GRID_WIDTH, -CHECKBOX_PANEL_TOP)
 
         for i, checkbox in enumerate(self.rule_checkboxes):
-            checkbox['rect'].y += scroll_offset * 10
-
             # Check if the checkbox is on the screen
-            if checkbox['rect'].y < 350 or checkbox['rect'].y > screen_height:
+            if checkbox['rect'].y < CHECKBOX_PANEL_TOP or checkbox['rect'].y > panel_bottom:
                 continue  # Skip this checkbox if it's not on the screen
 
-            if not checkbox['rect'].collidepoint((mx, my)):
+            rect = checkbox['rect'].move(origin)
+            if i != hovered:
                 # Use different colors for checked and unchecked checkboxes
                 color_hex = '#008080' if checkbox['checked'] else '#800000'
-                draw_3d_rect(self.screen, checkbox['rect'], color_hex)
-            text = font.render(
-                checkbox['rule']['name'], True, (255, 255, 255), wraplength=450)
-            self.screen.blit(
-                text, (checkbox['rect'].x + 71, checkbox['rect'].y + 10))
-
-        self.scroll_offset = 0
-        self.clean_checkboxes = False
+                draw_3d_rect(surface, rect, color_hex)
+            profiling = TransitionRules.profiler is not None
+            # Leave room for the profile overlay while profiling
+            text = self.text_cache.render(
+                checkbox['rule']['name'], 13, (255, 255, 255), FONT_PATH,
+                wraplength=370 if profiling else 450)
+            surface.blit(text, (rect.x + 71, rect.y + 10))
+            if profiling:
+                self.draw_rule_profile(surface, rect, checkbox['rule'])
+
+    def draw_rule_profile(self, surface, rect, rule):
+        # mean condition time, how often the condition is true and how often it changes the state
+        stats = TransitionRules.profiler.rule_stats(rule)
+        profile_text = f"{stats['mean_condition_us'] + stats['mean_action_us'] * stats['hit_rate']:.1f}us\n" \
+                       f"hit {stats['hit_rate']:.0%} chg {stats['change_rate']:.0%}"
+        text = self.text_cache.render(profile_text, 11, (255, 255, 0), FONT_PATH)
+        surface.blit(text, (rect.x + 445, rect.y + 10))
+
+    def get_checkboxes_key(self):
+        return (self.rule_checkboxes[0]['rect'].y,
+                tuple(checkbox['checked'] for checkbox in self.rule_checkboxes),
+                self.get_hovered_checkbox(),
+                # the profile overlay changes with every day
+                self.world_version if TransitionRules.profiler is not None else None)
 
     def draw_tooltip(self):
+        # The tooltip surface is only rebuilt when the hovered cell's state changes,
+        # moving the mouse just blits it at the new position
         if self.hovered_cell is not None:
-            tooltip_text = f"Land: {self.hovered_cell.state.land_type.name}\n" \
-                           f"Temp: {self.hovered_cell.state.temperature.name}\n" \
-                           f"Pollution: {self.hovered_cell.state.air_pollution.name}\n" \
-                           f"Wind: {self.hovered_cell.state.wind_direction.name}"
-            tooltip_surf = self.tooltip_font.render(
-                tooltip_text, True, (255, 255, 255))
-            mx, my = pygame.mouse.get_pos()
-
-            # Create a new Surface for the tooltip background
-            bg_surf = pygame.Surface(
-                (tooltip_surf.get_width() + 20, tooltip_surf.get_height() + 20))
+            world, row, col = self.hovered_cell
+            state = world.grid[row][col].state
+            key = state.pack()
+            if self.tooltip[0] != key:
+                tooltip_text = f"Land: {state.land_type.name}\n" \
+                               f"Temp: {state.temperature.name}\n" \
+                               f"Pollution: {state.air_pollution.name}\n" \
+                               f"Wind: {state.wind_direction.name}"
+                text_surf = self.text_cache.render(
+                    tooltip_text, 13, (255, 255, 255), FONT_PATH)
+
+                # The semi-transparent background and the text in one surface
+                tooltip_surf = pygame.Surface(
+                    (text_surf.get_width() + 20, text_surf.get_height() + 20), pygame.SRCALPHA)
+                tooltip_surf.fill((0, 0, 0, 128))  # RGBA color
+                tooltip_surf.blit(text_surf, (10, 10))
+                self.tooltip = (key, tooltip_surf)
 
-            # Fill the new Surface with a semi-transparent color
-            bg_surf.fill((0, 0, 0, 128))  # RGBA color
-            bg_surf.set_alpha(128)  # Set the alpha value
-
-            # Blit the new Surface onto the screen
-            self.screen.blit(bg_surf, (mx, my))
-
-            # Blit the tooltip text onto the screen
-            self.screen.blit(tooltip_surf, (mx + 10, my + 10))
+            mx, my = pygame.mouse.get_pos()
+            self.tooltip_rect = self.screen.blit(self.tooltip[1], (mx, my))
+            self.dirty_rects.append(self.tooltip_rect)
 
-    def draw_date(self):
-        font = pygame.font.Font('Roboto-Regular.ttf', 20)
+    def draw_date(self, surface):
         stat = self.get_world_stats()
         # Turquoise, Hot Pink, Medium Purple, Orange
         colors = [(64, 224, 208), (255, 105, 180),
                   (147, 112, 219), (255, 165, 0)]
         labels = ["Average Temp", "Average Wind",
                   "Average Rainfall", "Average Pollution"]
-        rect = pygame.Rect(800, 0, 600, 300)
-        draw_3d_rect_stripes(self.screen, rect, '#003366')
-        self.draw_title(font)
-        self.draw_stats_lines(font, stat, colors)
-        self.draw_legend(font, labels, stat, colors)
+        rect = pygame.Rect(0, 0, STATS_PANEL[2], STATS_PANEL[3])
+        draw_3d_rect_stripes(surface, rect, '#003366')
+        self.draw_title(surface)
+        self.draw_stats_lines(surface, stat, colors)
+        self.draw_legend(surface, labels, stat, colors)
+        self.draw_land_counts(surface)
+        self.draw_timeline(surface)
+
+    def draw_land_counts(self, surface):
+        # Read from the world's spatial index, no scan of the grid
+        counts = self.world.index.counts()
+        for i, land_type in enumerate((Landscape.CITY, Landscape.FOREST, Landscape.ICE, Landscape.SEA)):
+            text_surf = self.text_cache.render(f'{land_type.name.title()}: {counts[land_type]}',
+                                               16, (255, 255, 255), FONT_PATH)
+            surface.blit(text_surf, (10, 40 + i * 22))
+
+    def update_stats_history(self):
+        # From the world's daily statistics, which go back with it to a day of the
+        # history; the last sample is the shown day's
+        statistics = self.world.statistics
+        for i, name in enumerate(('temperature', 'wind_speed', 'rainfall', 'pollution')):
+            values = statistics[name][-(self.days + 1):]
+            first_day = self.days - len(values) + 1
+            self.stats_history[i] = [(first_day + j, value) for j, value in enumerate(values)]
 
     def get_world_stats(self):
         return self.world.avg_temperature, self.world.avg_wind_speed, self.world.avg_rainfall, self.world.avg_pollution
 
-    def draw_title(self, font):
+    def draw_title(self, surface):
         title_text = self.get_status_text()
-        title_surf = font.render(title_text, True, (255, 255, 255))
-        self.screen.blit(title_surf, (800 + 225, 10))
+        title_surf = self.text_cache.render(title_text, 20, (255, 255, 255), FONT_PATH)
+        surface.blit(title_surf, (225, 10))
 
-    def draw_stats_lines(self, font, stat, colors):
-        for i, curr_stat in enumerate(stat):
-            # Add current stat to history
-            self.stats_history[i].append((self.days, curr_stat))
+    def draw_stats_lines(self, surface, stat, colors):
+        for i in range(len(stat)):
             # If there is more than one stat in history
             if len(self.stats_history[i]) > 1:
                 # Draw line for each pair of stats in history
                 for j in range(len(self.stats_history[i]) - 1):
-                    pygame.draw.line(self.screen, colors[i],
-                                     (800 + 100 + self.stats_history[i][j][0],
+                    pygame.draw.line(surface, colors[i],
+                                     (100 + self.stats_history[i][j][0],
                                       180 + self.stats_history[i][j][1] * 10),
-                                     (800 + 100 + self.stats_history[i][j + 1][0],
+                                     (100 + self.stats_history[i][j + 1][0],
                                       180 + self.stats_history[i][j + 1][1] * 10),
                                      2)
 
-    def draw_legend(self, font, labels, stat, colors):
-        max_label_width = max(font.size(label)[0] for label in labels) + 50
-        max_stat_width = max(font.size(f"{s:.2f}")[0] for s in stat) + 50
+    def draw_legend(self, surface, labels, stat, colors):
+        text = self.text_cache
+        max_label_width = max(text.size(label, 20, FONT_PATH)[0] for label in labels) + 50
+        max_stat_width = max(text.size(f"{s:.2f}", 20, FONT_PATH)[0] for s in stat) + 50
         for i, label in enumerate(labels):
-            label_text = font.render(label, True, colors[i])
-            stat_text = font.render(f"{stat[i]:.2f}", True, colors[i])
+            label_text = text.render(label, 20, colors[i], FONT_PATH)
+            stat_text = text.render(f"{stat[i]:.2f}", 20, colors[i], FONT_PATH)
             # Adjusted y-coordinate to make room for title
-            self.screen.blit(label_text, (800 + 150, 40 + i * 30))
-            self.screen.blit(stat_text, (800 + 150 + max_label_width +
-                             max_stat_width - font.size(f"{stat[i]:.2f}")[0], 40 + i * 30))
+            surface.blit(label_text, (150, 40 + i * 30))
+            surface.blit(stat_text, (150 + max_label_width +
+                         max_stat_width - stat_text.get_width(), 40 + i * 30))
+
+    def update_layer(self, layer, key, phase):
+        if self.metrics is None:
+            return layer.update(key)
+        start = perf_counter()
+        changed = layer.update(key)
+        if changed:
+            # Only actual re-renders are timed, a cached layer costs nothing
+            self.metrics.record(phase, perf_counter() - start)
+        return changed
 
     async def draw(self):
-        self.screen.fill((0, 0, 0))
-        self.draw_grid()
-        self.draw_checkboxes()
-        self.draw_buttons()
-        self.draw_tooltip()
-        self.draw_date()
+        start = perf_counter()
+        # Each layer is re-rendered only when its inputs changed
+        viewport = self.viewport
+        if self.branch is not None:
+            # the branch's camera follows the world's
+            self.branch_viewport.zoom = viewport.zoom
+            self.branch_viewport.offset_row = viewport.offset_row
+            self.branch_viewport.offset_col = viewport.offset_col
+        changed = []
+        if self.update_layer(
+                self.grid_layer,
+                (self.world_version, viewport.zoom, viewport.offset_row, viewport.offset_col),
+                'draw_grid'):
+            changed.append(self.grid_layer)
+        if self.update_layer(self.stats_layer, (self.world_version, self.export_status),
+                             'draw_date'):
+            changed.append(self.stats_layer)
+        if self.update_layer(self.controls_layer, self.is_simulation_running, 'draw_buttons'):
+            changed.append(self.controls_layer)
+        if self.update_layer(self.checkbox_layer, self.get_checkboxes_key(), 'draw_checkboxes'):
+            changed.append(self.checkbox_layer)
+        # Only the changed layers and the tooltip's old and new areas are copied to
+        # the screen, and updated on the display (see run)
+        self.dirty_rects = []
+        for layer in changed:
+            self.frame.blit(layer.surface, layer.rect)
+            self.screen.blit(layer.surface, layer.rect)
+            self.dirty_rects.append(layer.rect)
+        if self.tooltip_rect is not None:
+            # erases the last tooltip
+            self.screen.blit(self.frame, self.tooltip_rect, self.tooltip_rect)
+            self.dirty_rects.append(self.tooltip_rect)
+            self.tooltip_rect = None
+        if self.metrics is None:
+            self.draw_tooltip()
+        else:
+            with self.metrics.phase('draw_tooltip'):
+                self.draw_tooltip()
+            self.metrics.record('draw', perf_counter() - start)
 
     async def run(self):
         while True:
+            self.capture.step()
             self.handle_events()
-            await self.draw()
-            pygame.display.flip()
+            self.check_writer()
+            if self.stream is not None:
+                self.apply_stream()
+            if self.allocations is not None:
+                with self.allocations.phase('draw'):
+                    await self.draw()
+            else:
+                await self.draw()
+            pygame.display.update(self.dirty_rects)
+            if self.first_frame_seconds is None:
+                self.first_frame()
+                if self.startup_check:
+                    return
+                if self.music is not None:
+                    self.start_music()
+            if self.metrics is not None:
+                self.metrics.maybe_export()
             await asyncio.sleep(0)
 
+    def first_frame(self):
+        self.first_frame_seconds = perf_counter() - STARTED
+        print(f'First frame after {self.first_frame_seconds * 1000:.0f} ms')
+        if self.metrics is not None:
+            self.metrics.record('first_frame', self.first_frame_seconds)
+
+    def start_music(self):
+        # Only once the first frame is shown, opening the audio device and
+        # decoding the music take a while (more so in the browser)
+        try:
+            pygame.mixer.init()
+            pygame.mixer.music.load(self.music)
+            pygame.mixer.music.play(-1)
+        except (pygame.error, OSError) as error:
+            print(f'No music: {error}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Simulation Earth')
+    parser.add_argument('--metrics', help='export phase timing metrics to this file')
+    parser.add_argument('--metrics-format', choices=['jsonl', 'prometheus'], default='jsonl')
+    parser.add_argument('--metrics-interval', type=float, default=60.0,
+                        help='seconds between metrics exports')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default=DEFAULT_ENGINE)
+    parser.add_argument('--verify', action='store_true',
+                        help='run the reference engine side by side, stop at the first divergence')
+    parser.add_argument('--boundary', choices=BOUNDARIES, default='clamp',
+                        help='what the cells at the edges of the grid see past the edge')
+    parser.add_argument('--periods', nargs='*', type=parse_period, default=[], metavar='CATEGORY=DAYS',
+                        help='update period of rule categories, e.g. LAND=7 TEMP=2 (see scheduler.py)')
+    parser.add_argument('--autosave', type=int, metavar='DAYS',
+                        help='save a snapshot every DAYS days, in the background')
+    parser.add_argument('--autosave-dir', default='autosave')
+    parser.add_argument('--export-format', choices=FORMATS, default='csv',
+                        help='format of the exports and autosaves (see snapshots.py)')
+    parser.add_argument('--allocations', metavar='FILE',
+                        help='track the allocations and GC pauses of the phases into FILE (slow)')
+    parser.add_argument('--allocations-every', type=int, default=1, metavar='N',
+                        help='track every N-th phase only')
+    parser.add_argument('--profile-frames', type=int, default=PROFILE_CAPTURE_FRAMES,
+                        help='frames profiled when F9 is pressed (see profile_capture.py)')
+    parser.add_argument('--profile-prefix', default='profile')
+    parser.add_argument('--connect', type=parse_address, metavar='HOST:PORT',
+                        help='show the world of a simulation server (see stream.py)')
+    parser.add_argument('--startup-check', action='store_true',
+                        help='quit after the first frame, to measure the time to it')
+    parser.add_argument('--history-keyframes', type=int, default=30, metavar='DAYS',
+                        help='days between the full keyframes of the timeline (see history.py)')
+    parser.add_argument('--history-budget', type=int, default=64, metavar='MB',
+                        help='memory kept for the timeline, the oldest days are dropped first')
+    # parse_known_args, as the web build may pass its own arguments
+    return parser.parse_known_args()[0]
+
 
 if __name__ == "__main__":
-    pygame.init()
-    # init mixer and set music
-    pygame.mixer.init()
-    pygame.mixer.music.load('hope.mp3')
-    pygame.mixer.music.play(-1)
-    world = Grid(6, 6)  # You would use your actual world object here
-    world.apply_initial_conditions_csv('enums.csv')
+    args = parse_args()
+    # only what the first frame needs, the mixer is initialized after it (start_music)
+    pygame.display.init()
+    pygame.font.init()
+    stream = None
+    if args.connect:
+        # a viewer: the world is only updated from the server's stream
+        from stream import StreamClient
+        stream = StreamClient(args.connect)
+        world = Grid(stream.rows, stream.cols)
+    else:
+        world = Grid(6, 6, engine=args.engine, verify=args.verify,
+                     boundary=args.boundary, update_periods=dict(args.periods))  # You would use your actual world object here
+        world.apply_initial_conditions_csv('enums.csv')
 
     gui = PygameSimulationGUI(world)
+    gui.stream = stream
+    gui.music = 'hope.mp3'
+    gui.startup_check = args.startup_check
+    gui.export_format = args.export_format
+    gui.capture = ProfileCapture(args.profile_prefix, args.profile_frames)
+    gui.history = History(world, args.history_keyframes, args.history_budget * 1024 * 1024)
+    if args.allocations:
+        from allocations import AllocationTracker
+        gui.allocations = AllocationTracker(args.allocations, every=args.allocations_every)
+    if args.autosave:
+        gui.autosave = Autosave(gui.writer, args.autosave, args.autosave_dir, args.export_format)
+    if args.metrics:
+        world.metrics = gui.metrics = PhaseMetrics(
+            export_path=args.metrics, export_format=args.metrics_format,
+            export_interval=args.metrics_interval)
     asyncio.run(gui.run())
@@ -0,0 +1,129 @@
+"""
+This module holds the phase-level timing metrics of the simulation.
+The grid (next_day) and the GUI (draw) record how long each of their phases took
+into rolling histograms, which report percentiles (p50 / p95 / p99) over the
+last samples. The metrics can be exported as JSON Lines (one line per export)
+or as a Prometheus text-format file, periodically.
+
+Metrics are disabled unless a PhaseMetrics object is set on the grid / GUI,
+and then the only cost is a None check per day or frame.
+"""
+import json
+import math
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+QUANTILES = (0.5, 0.95, 0.99)
+FORMATS = ('jsonl', 'prometheus')
+
+
+class RollingHistogram:
+    """
+    Keeps the last window samples of one phase (for the percentiles),
+    plus the count and sum of all the samples.
+    """
+
+    def __init__(self, window=1000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentile(self, quantile, ordered=None):
+        if ordered is None:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return 0.0
+        # nearest rank
+        rank = max(0, math.ceil(quantile * len(ordered)) - 1)
+        return ordered[rank]
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        summary = {
+            'count': self.count,
+            'sum': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': ordered[-1] if ordered else 0.0,
+        }
+        for quantile in QUANTILES:
+            summary[f'p{int(quantile * 100)}'] = self.percentile(quantile, ordered)
+        return summary
+
+
+class PhaseMetrics:
+    """
+    Rolling histograms of phase durations (in seconds), keyed by phase name.
+    If export_path is given, maybe_export() writes the metrics there every
+    export_interval seconds, in export_format ('jsonl' or 'prometheus').
+    """
+
+    def __init__(self, window=1000, export_path=None, export_format='jsonl',
+                 export_interval=60.0):
+        if export_format not in FORMATS:
+            raise ValueError(f"Unknown metrics format {export_format}, expected one of {FORMATS}")
+        self.window = window
+        self.histograms = {}
+        self.export_path = export_path
+        self.export_format = export_format
+        self.export_interval = export_interval
+        self.last_export = time.monotonic()
+
+    def record(self, phase, seconds):
+        histogram = self.histograms.get(phase)
+        if histogram is None:
+            histogram = self.histograms[phase] = RollingHistogram(self.window)
+        histogram.add(seconds)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def summary(self):
+        return {phase: histogram.summary() for phase, histogram in self.histograms.items()}
+
+    def maybe_export(self):
+        """Exports the metrics if the export interval passed since the last export."""
+        if self.export_path is None:
+            return False
+        now = time.monotonic()
+        if now - self.last_export < self.export_interval:
+            return False
+        self.export()
+        return True
+
+    def export(self, path=None, export_format=None):
+        path = path or self.export_path
+        export_format = export_format or self.export_format
+        self.last_export = time.monotonic()
+        if export_format == 'jsonl':
+            with open(path, 'a') as jsonl_file:
+                jsonl_file.write(json.dumps(
+                    {'timestamp': time.time(), 'phases': self.summary()}) + '\n')
+        else:
+            # Written to a temporary file and renamed, so a scraper never reads half a file
+            temp_path = f'{path}.tmp'
+            with open(temp_path, 'w') as prometheus_file:
+                prometheus_file.write(self.to_prometheus())
+            os.replace(temp_path, path)
+
+    def to_prometheus(self):
+        lines = ['# HELP simulation_phase_seconds Duration of the simulation phases.',
+                 '# TYPE simulation_phase_seconds summary']
+        for phase, summary in sorted(self.summary().items()):
+            for quantile in QUANTILES:
+                lines.append(f'simulation_phase_seconds{{phase="{phase}",quantile="{quantile}"}} '
+                             f'{summary[f"p{int(quantile * 100)}"]:.9f}')
+            lines.append(f'simulation_phase_seconds_sum{{phase="{phase}"}} {summary["sum"]:.9f}')
+            lines.append(f'simulation_phase_seconds_count{{phase="{phase}"}} {summary["count"]}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,103 @@
+"""
+This module holds the neighborhood passed to the rules, and the aggregates of its neighbors.
+A Neighborhood is a dictionary of direction -> neighbor state, plus the cell's own
+state under 'center'. The rules only ever change the center, so anything computed
+from the neighbors alone holds for the whole rule pass of the cell: the aggregates
+below are computed once per cell per step and cached on the Neighborhood.
+
+The aggregates never include the center, the rules combine them with the
+center's current value (see the helpers in rules.py).
+"""
+from state import WindDirection, WindSpeed
+
+# Maps each direction to the opposite direction
+OPPOSITE_DIRECTIONS = {
+    WindDirection.NORTH: WindDirection.SOUTH,
+    WindDirection.SOUTH: WindDirection.NORTH,
+    WindDirection.EAST: WindDirection.WEST,
+    WindDirection.WEST: WindDirection.EAST,
+    WindDirection.NORTHEAST: WindDirection.SOUTHWEST,
+    WindDirection.SOUTHEAST: WindDirection.NORTHWEST,
+    WindDirection.SOUTHWEST: WindDirection.NORTHEAST,
+    WindDirection.NORTHWEST: WindDirection.SOUTHEAST,
+}
+
+
+class Neighborhood(dict):
+    """A neighborhood dictionary with a cache of its neighbors' aggregates."""
+    __slots__ = ('cache',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = {}
+
+
+def aggregate(neighborhood, function, *args):
+    """
+    Returns function(neighborhood, *args), cached on the neighborhood.
+    Plain dictionaries are supported, without the cache.
+    """
+    cache = getattr(neighborhood, 'cache', None)
+    if cache is None:
+        return function(neighborhood, *args)
+    key = (function, args)
+    if key in cache:
+        return cache[key]
+    value = cache[key] = function(neighborhood, *args)
+    return value
+
+
+def neighbor_states(neighborhood):
+    return [state for direction, state in neighborhood.items() if direction != 'center' and state]
+
+
+def neighbors_blow_towards(neighborhood):
+    """True if the wind of one of the neighbors blows towards the center."""
+    for direction, neighbor in neighborhood.items():
+        if direction == 'center':
+            continue
+        if neighbor and neighbor.wind_direction == OPPOSITE_DIRECTIONS.get(direction, WindDirection.NONE):
+            return True
+    return False
+
+
+def neighbor_wind_from(neighborhood, wind_direction):
+    """True if the neighbor the wind (blowing in wind_direction) comes from has wind."""
+    neighbor = neighborhood.get(OPPOSITE_DIRECTIONS.get(wind_direction, WindDirection.NONE), None)
+    return bool(neighbor) and neighbor.wind_speed > WindSpeed.NONE
+
+
+def neighbors_counts(neighborhood, attribute):
+    """Number of neighbors by the value of attribute."""
+    counts = {}
+    for neighbor in aggregate(neighborhood, neighbor_states):
+        value = getattr(neighbor, attribute)
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+
+def neighbors_count_above(neighborhood, attribute, threshold):
+    return sum(getattr(neighbor, attribute) > threshold
+               for neighbor in aggregate(neighborhood, neighbor_states))
+
+
+def neighbors_max(neighborhood, attribute):
+    """The highest value of attribute among the neighbors, None if there are none."""
+    states = aggregate(neighborhood, neighbor_states)
+    return max(getattr(neighbor, attribute) for neighbor in states) if states else None
+
+
+def neighbors_hottest(neighborhood):
+    """The first neighbor (in the neighborhood's order) with the highest temperature, or None."""
+    states = aggregate(neighborhood, neighbor_states)
+    return max(states, key=lambda neighbor: neighbor.temperature) if states else None
+
+
+def neighbors_wind_by_direction(neighborhood):
+    """The highest wind speed of the neighbors, by their wind direction."""
+    speeds = {}
+    for neighbor in aggregate(neighborhood, neighbor_states):
+        speed = speeds.get(neighbor.wind_direction)
+        if speed is None or neighbor.wind_speed > speed:
+            speeds[neighbor.wind_direction] = neighbor.wind_speed
+    return speeds
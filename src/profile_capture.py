@@ -0,0 +1,118 @@
+"""
+This module holds the on-demand profiler capture: cProfile turned on for the next N
+days (headless.py) or frames (the GUI), then dumped and turned off again.
+
+A capture is requested with a hotkey in the GUI (F9), or with SIGUSR1 in headless mode:
+    kill -USR1 <pid of headless.py>
+The request only sets a flag, the profiler starts at the next day / frame. Until then
+nothing is profiled, and the only cost is a check per day / frame.
+
+Each capture writes two files:
+- <prefix>_<time>.pstats: the cProfile statistics (python -m pstats, snakeviz, ...)
+- <prefix>_<time>.folded: collapsed stacks ("a;b;c microseconds" lines) for flame graph
+    tools (flamegraph.pl, speedscope, ...). cProfile only records caller -> callee
+    edges, so the time of a function called from several places is split between
+    its callers in proportion to the time of each call edge.
+"""
+import os
+import signal
+import time
+
+MAX_STACK_DEPTH = 64
+
+
+def function_label(function):
+    file_name, line, name = function
+    if file_name == '~':
+        return name  # built-in functions
+    return f'{os.path.basename(file_name)}:{line}({name})'
+
+
+def collapsed_stacks(stats):
+    """
+    Returns {stack: microseconds} of a pstats.Stats, the stacks being the labels
+    of the functions from the root joined by ';'.
+    """
+    entries = stats.stats  # function -> (calls, primitive calls, own time, total time, callers)
+    callees = {}
+    for function, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((function, edge[3]))
+    roots = [function for function, entry in entries.items() if not entry[4]]
+    folded = {}
+
+    def walk(function, scale, path, labels):
+        _, _, own_time, total_time, _ = entries[function]
+        labels = labels + [function_label(function)]
+        stack = ';'.join(labels)
+        folded[stack] = folded.get(stack, 0) + own_time * scale
+        if len(labels) >= MAX_STACK_DEPTH:
+            return
+        for callee, edge_time in callees.get(function, []):
+            if callee in path or callee not in entries:
+                continue  # recursion is folded into the first call
+            callee_total = entries[callee][3]
+            if callee_total > 0 and edge_time > 0:
+                walk(callee, scale * edge_time / callee_total, path | {callee}, labels)
+
+    for root in roots:
+        walk(root, 1.0, {root}, [])
+    return {stack: round(seconds * 1e6) for stack, seconds in folded.items() if seconds * 1e6 >= 1}
+
+
+class ProfileCapture:
+    """
+    Profiles the next `count` days or frames once requested. step() must be called
+    once per day / frame; request() may be called from a signal handler.
+    """
+
+    def __init__(self, prefix='profile', count=10):
+        self.prefix = prefix
+        self.count = count
+        self.requested = False
+        self.profiler = None
+        self.remaining = 0
+        self.files = []  # the files of the finished captures
+
+    def request(self):
+        self.requested = True
+
+    def install_signal_handler(self, signal_number=None):
+        """Requests a capture on SIGUSR1 (or signal_number). Returns False where unsupported."""
+        if signal_number is None:
+            signal_number = getattr(signal, 'SIGUSR1', None)
+        if signal_number is None:
+            return False
+        signal.signal(signal_number, lambda number, frame: self.request())
+        return True
+
+    def step(self):
+        if self.profiler is not None:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.stop()
+        elif self.requested:
+            self.requested = False
+            self.start()
+
+    def start(self):
+        import cProfile  # imported on the first capture, not when the GUI starts
+        self.remaining = self.count
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop(self):
+        """Stops profiling and writes the files, returns their paths."""
+        import pstats
+        profiler, self.profiler = self.profiler, None
+        profiler.disable()
+        base = f"{self.prefix}_{time.strftime('%Y%m%d_%H%M%S')}"
+        stats = pstats.Stats(profiler)
+        stats.dump_stats(f'{base}.pstats')
+        with open(f'{base}.folded', 'w', encoding='utf-8') as folded_file:
+            for stack, microseconds in sorted(collapsed_stacks(stats).items()):
+                folded_file.write(f'{stack} {microseconds}\n')
+        paths = (f'{base}.pstats', f'{base}.folded')
+        self.files.append(paths)
+        print(f'Profile of {self.count} steps saved to {paths[0]} / {paths[1]}')
+        return paths
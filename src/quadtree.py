@@ -0,0 +1,455 @@
+"""
+This module holds the hash-consed quadtree worlds (Hashlife style), for very large worlds
+made mostly of uniform regions, e.g. a planet of sea and ice that can't fit in a dense Grid.
+
+A world of 2^k x 2^k cells is a Node of level k, made of its 4 quadrants (level k - 1),
+down to the cells' States (level 0). Nodes are hash-consed by a Universe: equal regions,
+anywhere in the world and on any day, are the same Node object. The cells outside of the
+world are None (no cell, as the missing neighbors of the grid's edges).
+
+Universe.step(node) returns the center half of a node (level k - 1) advanced by one day.
+It is memoized per node, so every distinct region is computed once, wherever and whenever
+it appears: a sea of any size costs about as much as a 4x4 block of sea. Each cell is
+computed by the rules of TransitionRules from its Moore neighborhood (in the order of
+topology.DIRECTIONS, as the other engines), so the results are the same as the reference
+engine's. The memo is dropped when a rule is enabled, disabled or replaced (see
+TransitionRules.rules_key), and kept per set of skipped categories (see scheduler.py)
+and rule mask (see Grid.fork).
+
+Unlike Hashlife, a step is always one day, so the statistics and the update periods
+of every day are kept. While profiling, the rule statistics count each distinct
+region once.
+
+Example (a 100000 x 100000 sea with random islands):
+    python quadtree.py --size 100000 --islands 1000 --days 5
+"""
+import argparse
+import random
+import weakref
+from time import perf_counter
+from CA import Cell
+from neighborhood import Neighborhood
+from rules import TransitionRules
+from scheduler import skipped_categories, validate_periods
+from state import State, Landscape
+from topology import DIRECTIONS, BOUNDARIES, _boundary_index
+
+# Statistics summed over the cells, as Grid.calculate_statistics
+STATISTICS_FIELDS = ('temperature', 'wind_speed', 'rainfall', 'air_pollution')
+
+
+class Node:
+    """A square region of 2^level x 2^level cells, made of its four quadrants."""
+    __slots__ = ('level', 'nw', 'ne', 'sw', 'se')
+
+    def __init__(self, level, nw, ne, sw, se):
+        self.level = level
+        self.nw = nw
+        self.ne = ne
+        self.sw = sw
+        self.se = se
+
+
+class Universe:
+    """
+    The hash-consing tables of the nodes and cells, and the memo of their steps.
+    collect() drops everything not reachable from the given roots once there are
+    more than max_nodes nodes.
+    """
+
+    def __init__(self, max_nodes=1000000):
+        self.max_nodes = max_nodes
+        self.leaves = {}  # State.pack() -> the shared State
+        self.nodes = {}  # ids of the 4 quadrants -> Node
+        self.uniforms = {}  # (id of the cell, level) -> Node made of this cell only
+        self.rules_key = None  # the rules the memos were computed with
+        # (skipped categories, rule mask) -> ({Node: stepped Node}, {ids of the 9 cells of a neighborhood: new cell})
+        self.memos = {}
+        self.worlds = weakref.WeakSet()  # the worlds of this universe, their roots are kept by collect()
+        self.totals_memo = {}  # Node -> statistics sums
+        self.hits = self.misses = 0
+
+    def leaf(self, state):
+        """The shared State equal to state (None for no cell)."""
+        if state is None:
+            return None
+        key = state.pack()
+        leaf = self.leaves.get(key)
+        if leaf is None:
+            # a copy, so later changes to the given state don't change the world
+            leaf = self.leaves[key] = state.copy()
+        return leaf
+
+    def node(self, nw, ne, sw, se):
+        key = (id(nw), id(ne), id(sw), id(se))
+        node = self.nodes.get(key)
+        if node is None:
+            level = nw.level + 1 if type(nw) is Node else 1
+            node = self.nodes[key] = Node(level, nw, ne, sw, se)
+        return node
+
+    def uniform(self, leaf, level):
+        """The node of the given level with leaf in every cell."""
+        if level == 0:
+            return leaf
+        key = (id(leaf), level)
+        node = self.uniforms.get(key)
+        if node is None:
+            quadrant = self.uniform(leaf, level - 1)
+            node = self.uniforms[key] = self.node(quadrant, quadrant, quadrant, quadrant)
+        return node
+
+    def build(self, level, top, left, cell):
+        """
+        The node of the given level at (top, left), with cell(row, col) -> (State, None or a
+        node to use for the whole quadrant) called for the quadrants' top-left corners.
+        """
+        leaf, node = cell(top, left, level)
+        if node is not None:
+            return node
+        if level == 0:
+            return self.leaf(leaf)
+        half = 1 << (level - 1)
+        return self.node(self.build(level - 1, top, left, cell),
+                         self.build(level - 1, top, left + half, cell),
+                         self.build(level - 1, top + half, left, cell),
+                         self.build(level - 1, top + half, left + half, cell))
+
+    def get(self, node, level, row, col):
+        while level > 0:
+            half = 1 << (level - 1)
+            if row < half:
+                node = node.nw if col < half else node.ne
+            else:
+                node = node.sw if col < half else node.se
+                row -= half
+            if col >= half:
+                col -= half
+            level -= 1
+        return node
+
+    def set_cells(self, node, level, cells):
+        """Returns node with the cells set, cells being a list of (row, col, leaf) in the node."""
+        if not cells:
+            return node
+        if level == 0:
+            return cells[-1][2]
+        half = 1 << (level - 1)
+        quadrants = ([], [], [], [])
+        for row, col, leaf in cells:
+            quadrant = (2 if row >= half else 0) + (1 if col >= half else 0)
+            quadrants[quadrant].append((row % half, col % half, leaf))
+        return self.node(self.set_cells(node.nw, level - 1, quadrants[0]),
+                         self.set_cells(node.ne, level - 1, quadrants[1]),
+                         self.set_cells(node.sw, level - 1, quadrants[2]),
+                         self.set_cells(node.se, level - 1, quadrants[3]))
+
+    def line(self, node, level, index, length, horizontal):
+        """The first length cells of row (or column) index of the node."""
+        if length <= 0:
+            return []
+        if type(node) is not Node:
+            return [node]
+        if node is self.uniforms.get((id(self._uniform_leaf(node)), level)):
+            return [self._uniform_leaf(node)] * min(length, 1 << level)
+        half = 1 << (level - 1)
+        if horizontal:
+            first, second = (node.nw, node.ne) if index < half else (node.sw, node.se)
+        else:
+            first, second = (node.nw, node.sw) if index < half else (node.ne, node.se)
+        index %= half
+        return (self.line(first, level - 1, index, length, horizontal) +
+                self.line(second, level - 1, index, length - half, horizontal))
+
+    @staticmethod
+    def _uniform_leaf(node):
+        while type(node) is Node:
+            node = node.nw
+        return node
+
+    # Subnodes of the step's recursion (see step)
+
+    def _center(self, node):
+        return self.node(node.nw.se, node.ne.sw, node.sw.ne, node.se.nw)
+
+    def _horizontal(self, west, east):
+        return self.node(west.ne.se, east.nw.sw, west.se.ne, east.sw.nw)
+
+    def _vertical(self, north, south):
+        return self.node(north.sw.se, north.se.sw, south.nw.ne, south.ne.nw)
+
+    def _center_center(self, node):
+        return self.node(node.nw.se.se, node.ne.sw.sw, node.sw.ne.ne, node.se.nw.nw)
+
+    def step(self, node, memo, cell_memo, apply):
+        """The center half of node (level >= 2) advanced by one day."""
+        result = memo.get(node)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        if node.level == 2:
+            result = self._step_cells(node, cell_memo, apply)
+        else:
+            nw, ne, sw, se = node.nw, node.ne, node.sw, node.se
+            # 9 overlapping subnodes of level - 2, then the 4 quadrants of the result
+            n00, n01, n02 = self._center(nw), self._horizontal(nw, ne), self._center(ne)
+            n10, n11, n12 = self._vertical(nw, sw), self._center_center(node), self._vertical(ne, se)
+            n20, n21, n22 = self._center(sw), self._horizontal(sw, se), self._center(se)
+            result = self.node(self.step(self.node(n00, n01, n10, n11), memo, cell_memo, apply),
+                               self.step(self.node(n01, n02, n11, n12), memo, cell_memo, apply),
+                               self.step(self.node(n10, n11, n20, n21), memo, cell_memo, apply),
+                               self.step(self.node(n11, n12, n21, n22), memo, cell_memo, apply))
+        memo[node] = result
+        return result
+
+    def _step_cells(self, node, cell_memo, apply):
+        # The 4 center cells of a 4x4 node
+        cells = [[node.nw.nw, node.nw.ne, node.ne.nw, node.ne.ne],
+                 [node.nw.sw, node.nw.se, node.ne.sw, node.ne.se],
+                 [node.sw.nw, node.sw.ne, node.se.nw, node.se.ne],
+                 [node.sw.sw, node.sw.se, node.se.sw, node.se.se]]
+        new_cells = []
+        for row, col in ((1, 1), (1, 2), (2, 1), (2, 2)):
+            center = cells[row][col]
+            if center is None:
+                new_cells.append(None)
+                continue
+            neighbors = [cells[row + d_row][col + d_col] for (d_row, d_col), _ in DIRECTIONS]
+            key = (id(center), *map(id, neighbors))
+            new_cell = cell_memo.get(key)
+            if new_cell is None:
+                neighborhood = Neighborhood()
+                for neighbor, (_, direction) in zip(neighbors, DIRECTIONS):
+                    if neighbor is not None:
+                        neighborhood[direction] = neighbor
+                neighborhood['center'] = center.copy()
+                new_cell = cell_memo[key] = self.leaf(apply(neighborhood))
+            new_cells.append(new_cell)
+        return self.node(*new_cells)
+
+    def advance(self, root, skip=frozenset(), mask=None):
+        """
+        Returns root (with its cells in its center half) advanced by one day,
+        the rule categories in skip not being applied, with the rules enabled by mask.
+        """
+        rules_key = TransitionRules.rules_key()
+        if rules_key != self.rules_key:
+            # a rule was enabled, disabled or replaced, every memo is stale
+            self.rules_key = rules_key
+            self.memos = {}
+        memo, cell_memo = self.memos.setdefault((skip, mask), ({}, {}))
+        if TransitionRules.profiler is not None:
+            rules = TransitionRules.active(skip, mask)
+            apply = lambda neighborhood: TransitionRules.apply(neighborhood, rules)
+        else:
+            apply = TransitionRules.dispatch_table(skip, mask).apply
+        result = self.step(root, memo, cell_memo, apply)
+        # back to the center of a node of the root's level
+        empty = self.uniform(None, root.level - 2)
+        return self.node(self.node(empty, empty, empty, result.nw),
+                         self.node(empty, empty, result.ne, empty),
+                         self.node(empty, result.sw, empty, empty),
+                         self.node(result.se, empty, empty, empty))
+
+    def totals(self, node):
+        """(cells, sums of STATISTICS_FIELDS, sums of their squares) of the node."""
+        if node is None:
+            return (0,) + (0,) * 2 * len(STATISTICS_FIELDS)
+        if type(node) is not Node:
+            values = [getattr(node, field).value for field in STATISTICS_FIELDS]
+            return (1, *values, *(value * value for value in values))
+        totals = self.totals_memo.get(node)
+        if totals is None:
+            totals = self.totals_memo[node] = tuple(
+                sum(values) for values in zip(self.totals(node.nw), self.totals(node.ne),
+                                              self.totals(node.sw), self.totals(node.se)))
+        return totals
+
+    def collect(self, *roots):
+        """Drops the nodes not reachable from roots, and the memos, if there are too many nodes."""
+        if len(self.nodes) <= self.max_nodes:
+            return
+        self.nodes = {}
+        self.uniforms = {}
+        self.memos = {}
+        self.totals_memo = {}
+        seen = set()
+        for root in roots:
+            self._register(root, seen)
+
+    def _register(self, node, seen):
+        if type(node) is not Node or id(node) in seen:
+            return
+        seen.add(id(node))
+        for quadrant in (node.nw, node.ne, node.sw, node.se):
+            self._register(quadrant, seen)
+        self.nodes[(id(node.nw), id(node.ne), id(node.sw), id(node.se))] = node
+
+
+class QuadtreeWorld:
+    """
+    A rows x cols world stored as a quadtree, stepped like a Grid (next_day, days,
+    update_periods and boundary modes included). The world is in the center half
+    of the root, surrounded by no cells. With the wrap and reflect boundaries the
+    ring of cells around the world is set from the world before each day.
+    """
+
+    def __init__(self, rows, cols, fill=None, boundary='clamp', update_periods=None, universe=None):
+        if boundary not in BOUNDARIES:
+            raise ValueError(f"Unknown boundary {boundary}, expected one of {BOUNDARIES}")
+        self.rows = rows
+        self.cols = cols
+        self.boundary = boundary
+        self.update_periods = validate_periods(dict(update_periods or {}))
+        self.universe = universe if universe is not None else Universe()
+        self.universe.worlds.add(self)
+        self.days = 1
+        self.rule_mask = None  # own enabled flags of the rules (see Grid.fork), None for the rules' own
+        # the root's center half holds the world
+        self.level = 2
+        while 1 << (self.level - 1) < max(rows, cols):
+            self.level += 1
+        self.offset = 1 << (self.level - 2)
+        fill = self.universe.leaf(fill if fill is not None else State(Landscape.LAND))
+        self.root = self._build(lambda row, col: fill, uniform=fill)
+
+    @classmethod
+    def from_states(cls, rows, cols, states, **kwargs):
+        """A world of the given states (row major)."""
+        world = cls(rows, cols, **kwargs)
+        world.root = world._build(lambda row, col: states[row * cols + col])
+        return world
+
+    def _build(self, cell, uniform=None):
+        universe, offset, rows, cols = self.universe, self.offset, self.rows, self.cols
+
+        def region(top, left, level):
+            size = 1 << level
+            top, left = top - offset, left - offset
+            if top >= rows or left >= cols or top + size <= 0 or left + size <= 0:
+                return None, universe.uniform(None, level)
+            inside = top >= 0 and left >= 0 and top + size <= rows and left + size <= cols
+            if inside and uniform is not None:
+                return None, universe.uniform(uniform, level)
+            if level == 0:
+                return cell(top, left), None
+            return None, None
+        return universe.build(self.level, 0, 0, region)
+
+    def get_state(self, row, col):
+        leaf = self.universe.get(self.root, self.level, row + self.offset, col + self.offset)
+        return leaf.copy()
+
+    def set_states(self, cells):
+        """Sets the states of cells, a dictionary of (row, col) -> State."""
+        self.root = self.universe.set_cells(
+            self.root, self.level,
+            [(row + self.offset, col + self.offset, self.universe.leaf(state))
+             for (row, col), state in cells.items()])
+
+    def apply_conditions(self, initial_conditions):
+        """Places the cells of initial conditions, as Grid.apply_initial_conditions_csv."""
+        self.set_states({(condition['x'], condition['y']): condition['cell'].state
+                         for condition in initial_conditions})
+
+    def states(self):
+        """The states of every cell (row major), only for worlds that fit in memory."""
+        universe, offset = self.universe, self.offset
+        states = []
+        for row in range(self.rows):
+            line = universe.line(self.root, self.level, row + offset, offset + self.cols, True)
+            states.extend(leaf.copy() for leaf in line[offset:])
+        return states
+
+    def _ring(self, source):
+        # The cells around the world, (row, col) -> leaf, with source(row, col) -> world cell or None
+        universe, offset, rows, cols = self.universe, self.offset, self.rows, self.cols
+        ring = {}
+        for row in (-1, rows):
+            source_row = source(row, rows)
+            line = [] if source_row < 0 else universe.line(
+                self.root, self.level, source_row + offset, offset + cols, True)[offset:]
+            for col in range(-1, cols + 1):
+                source_col = col if 0 <= col < cols else source(col, cols)
+                ring[row, col] = line[source_col] if source_row >= 0 and source_col >= 0 else None
+        for col in (-1, cols):
+            source_col = source(col, cols)
+            line = [] if source_col < 0 else universe.line(
+                self.root, self.level, source_col + offset, offset + rows, False)[offset:]
+            for row in range(rows):
+                ring[row, col] = line[row] if source_col >= 0 else None
+        return ring
+
+    def next_day(self):
+        universe = self.universe
+        if self.boundary != 'clamp':
+            ring = self._ring(lambda index, size: _boundary_index(index, size, self.boundary))
+            self.root = universe.set_cells(self.root, self.level, [
+                (row + self.offset, col + self.offset, leaf) for (row, col), leaf in ring.items()])
+        skip = skipped_categories(self.update_periods, self.days - 1)
+        self.root = universe.advance(self.root, skip, self.rule_mask)
+        if self.boundary != 'clamp':
+            # the ring was stepped too, back to no cells
+            self.root = universe.set_cells(self.root, self.level, [
+                (row + self.offset, col + self.offset, None) for row, col in ring])
+        self.days += 1
+        universe.collect(*(world.root for world in list(universe.worlds)))
+
+    def fork(self):
+        """
+        A copy of the world stepped on its own, e.g. with another rule mask. It shares
+        the root, and every region the two worlds keep in common, so it costs O(1).
+        """
+        branch = QuadtreeWorld.__new__(QuadtreeWorld)
+        branch.__dict__.update(self.__dict__)
+        branch.update_periods = dict(self.update_periods)
+        self.universe.worlds.add(branch)
+        return branch
+
+    def statistics(self):
+        """The average and standard deviation of STATISTICS_FIELDS over the cells."""
+        cells, *totals = self.universe.totals(self.root)
+        count = len(STATISTICS_FIELDS)
+        statistics = {}
+        for field, total, squares in zip(STATISTICS_FIELDS, totals[:count], totals[count:]):
+            average = total / cells
+            statistics[field] = (average, max(squares / cells - average ** 2, 0) ** 0.5)
+        return statistics
+
+
+def random_islands(rows, cols, islands, seed=0, size=8):
+    """Initial conditions of square islands of random land types in the world."""
+    rnd = random.Random(seed)
+    conditions = []
+    for _ in range(islands):
+        land_type = rnd.choice([Landscape.LAND, Landscape.FOREST, Landscape.CITY, Landscape.ICE])
+        top, left = rnd.randrange(rows), rnd.randrange(cols)
+        for x in range(top, min(top + size, rows)):
+            for y in range(left, min(left + size, cols)):
+                conditions.append({'x': x, 'y': y, 'cell': Cell(State(land_type))})
+    return conditions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Step a large quadtree world')
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--islands', type=int, default=100)
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--boundary', choices=BOUNDARIES, default='clamp')
+    args = parser.parse_args(argv)
+    world = QuadtreeWorld(args.size, args.size, fill=State(Landscape.SEA), boundary=args.boundary)
+    world.apply_conditions(random_islands(args.size, args.size, args.islands, args.seed))
+    universe = world.universe
+    for _ in range(args.days):
+        start = perf_counter()
+        world.next_day()
+        elapsed = perf_counter() - start
+        temperature, _ = world.statistics()['temperature']
+        print(f'day {world.days - 1}: {elapsed * 1000:.0f} ms, {len(universe.nodes)} nodes, '
+              f'{universe.hits} memo hits, {universe.misses} misses, avg. temp {temperature:.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+This module holds the rule dispatch tables: the rules indexed by the values of a
+few center attributes (DISPATCH_FIELDS), so each cell only evaluates the rules
+that can apply to it.
+
+Many rule conditions are conjunctions with cheap center-only parts, e.g.
+    neighborhood['center'].land_type == Landscape.FOREST and (...)
+    neighborhood['center'].wind_speed > WindSpeed.NONE and ...
+These parts are found in the source of the condition lambdas. For every combination
+of the dispatch attributes' values (a bucket) the table keeps the rules whose
+center-only parts are not false for it. A rule without such parts is in every bucket.
+
+An action may change a dispatch attribute in the middle of the pass (e.g. ice
+melting into sea). The cell then continues with the rules of its new bucket
+that come after the rule that changed it, so the result is the same as
+evaluating every rule in order.
+
+Example (prints the buckets and how many evaluations were skipped on a random world):
+    python rule_dispatch.py --size 32 --days 5
+"""
+import argparse
+import ast
+import copy
+import inspect
+from bisect import bisect_right
+from itertools import product
+from types import SimpleNamespace
+from rule_optimizer import RuleAnalysis
+from state import Landscape, WindSpeed
+
+# Center attributes the rules are indexed by, and their possible values
+DISPATCH_FIELDS = ('land_type', 'wind_speed', 'clouds')
+DISPATCH_VALUES = (tuple(Landscape), tuple(WindSpeed), (False, True))
+# Node types allowed in a center-only predicate
+PREDICATE_NODES = (ast.Compare, ast.BoolOp, ast.UnaryOp, ast.Attribute, ast.Name, ast.Constant,
+                   ast.Load, ast.And, ast.Or, ast.Not, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Is, ast.IsNot)
+
+_lambda_nodes = {}  # file name -> {line: [ast.Lambda]}
+
+
+def _lambda_node(function):
+    """Returns the ast.Lambda of a lambda function, or None if it can't be found."""
+    try:
+        file_name = inspect.getsourcefile(function)
+        if file_name not in _lambda_nodes:
+            with open(file_name, encoding='utf-8') as source_file:
+                tree = ast.parse(source_file.read())
+            lines = _lambda_nodes[file_name] = {}
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Lambda):
+                    lines.setdefault(node.lineno, []).append(node)
+    except (OSError, TypeError, SyntaxError):
+        return None
+    code = function.__code__
+    for node in _lambda_nodes[file_name].get(code.co_firstlineno, []):
+        if [arg.arg for arg in node.args.args] == list(code.co_varnames[:code.co_argcount]):
+            # The same line may hold more lambdas, compare the compiled code
+            compiled = compile(ast.Expression(node), file_name, 'eval')
+            lambda_code = next(constant for constant in compiled.co_consts
+                               if hasattr(constant, 'co_code'))
+            if lambda_code.co_code == code.co_code:
+                return node
+    return None
+
+
+def _center_predicate(conjunct, argument):
+    """
+    If conjunct only reads the dispatch attributes of argument['center'] (and global names),
+    returns it with argument['center'].<field> replaced by center.<field>, otherwise None.
+    """
+    class Rewriter(ast.NodeTransformer):
+        def visit_Attribute(self, attribute):
+            value = attribute.value
+            if isinstance(value, ast.Subscript) and isinstance(value.value, ast.Name) \
+                    and value.value.id == argument and isinstance(value.slice, ast.Constant) \
+                    and value.slice.value == 'center':
+                return ast.copy_location(
+                    ast.Attribute(value=ast.Name(id='center', ctx=ast.Load()),
+                                  attr=attribute.attr, ctx=ast.Load()), attribute)
+            return self.generic_visit(attribute)
+
+    predicate = Rewriter().visit(copy.deepcopy(conjunct))
+    center_names = center_fields = 0
+    for node in ast.walk(predicate):
+        if not isinstance(node, PREDICATE_NODES) or isinstance(node, ast.Name) and node.id == argument:
+            return None
+        if isinstance(node, ast.Name) and node.id == 'center':
+            center_names += 1
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) \
+                and node.value.id == 'center':
+            if node.attr not in DISPATCH_FIELDS:
+                return None
+            center_fields += 1
+    # every center is read through a dispatch attribute, and there is at least one
+    if center_names == 0 or center_names != center_fields:
+        return None
+    return predicate
+
+
+def center_predicates(condition):
+    """
+    Returns the compiled center-only conjuncts of a condition lambda,
+    each to be evaluated with eval(code, globals, {'center': ...}).
+    """
+    node = _lambda_node(condition)
+    if node is None:
+        return []
+    argument = node.args.args[0].arg
+    body = node.body
+    conjuncts = body.values if isinstance(body, ast.BoolOp) and isinstance(body.op, ast.And) else [body]
+    predicates = []
+    for conjunct in conjuncts:
+        predicate = _center_predicate(conjunct, argument)
+        if predicate is not None:
+            expression = ast.fix_missing_locations(ast.Expression(predicate))
+            predicates.append(compile(expression, '<predicate>', 'eval'))
+    return predicates
+
+
+def bucket_key(center):
+    return (center.land_type, center.wind_speed, center.clouds)
+
+
+class DispatchTable:
+    """
+    The rules (in order) of every bucket. Each entry is (position, condition, action, redispatch),
+    position being the rule's index in the given rules, and redispatch whether the action
+    may change a dispatch attribute.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        entries = []
+        rule_predicates = []
+        for position, rule in enumerate(rules):
+            redispatch = bool(RuleAnalysis(rule).writes & set(DISPATCH_FIELDS))
+            entries.append((position, rule['condition'], rule['action'], redispatch))
+            rule_predicates.append(center_predicates(rule['condition']))
+        # Used for cells with values outside of DISPATCH_VALUES
+        self.all_entries = entries
+        self.all_positions = list(range(len(entries)))
+        self.buckets = {}
+        self.positions = {}
+        for values in product(*DISPATCH_VALUES):
+            namespace = {'center': SimpleNamespace(**dict(zip(DISPATCH_FIELDS, values)))}
+            bucket = []
+            for entry, predicates in zip(entries, rule_predicates):
+                if all(self._holds(predicate, rules[entry[0]]['condition'], namespace)
+                       for predicate in predicates):
+                    bucket.append(entry)
+            self.buckets[values] = bucket
+            self.positions[values] = [entry[0] for entry in bucket]
+        self.reset_stats()
+
+    @staticmethod
+    def _holds(predicate, condition, namespace):
+        try:
+            return bool(eval(predicate, condition.__globals__, namespace))
+        except Exception:
+            return True  # keep the rule if the predicate can't be decided
+
+    def reset_stats(self):
+        # bucket -> [cells, rules evaluated]
+        self.stats = {}
+
+    def apply(self, neighborhood):
+        """Same as TransitionRules.apply, evaluating only the rules of the center's bucket."""
+        center = neighborhood['center']
+        key = bucket_key(center)
+        entries = self.buckets.get(key, self.all_entries)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = [0, 0]
+        stats[0] += 1
+        evaluated = 0
+        index = 0
+        count = len(entries)
+        while index < count:
+            position, condition, action, redispatch = entries[index]
+            index += 1
+            if condition(neighborhood):
+                action(neighborhood)
+                if redispatch:
+                    new_key = bucket_key(center)
+                    if new_key != key:
+                        # Continue with the new bucket's rules after this one
+                        evaluated += index
+                        key = new_key
+                        entries = self.buckets.get(key, self.all_entries)
+                        index = bisect_right(self.positions.get(key, self.all_positions), position)
+                        evaluated -= index
+                        count = len(entries)
+        stats[1] += evaluated + count
+        return center
+
+    def report(self):
+        """
+        Per bucket: the number of cells dispatched to it, the rules evaluated and
+        the evaluations skipped (compared to evaluating every rule), most skipped first.
+        """
+        rows = []
+        for key, (cells, evaluated) in self.stats.items():
+            skipped = cells * len(self.all_entries) - evaluated
+            rows.append({'bucket': '/'.join(str(getattr(value, 'name', value)) for value in key),
+                         'rules': len(self.buckets.get(key, self.all_entries)),
+                         'cells': cells, 'evaluated': evaluated, 'skipped': skipped})
+        rows.sort(key=lambda row: row['skipped'], reverse=True)
+        return rows
+
+
+def main(argv=None):
+    from grid import Grid, random_initial_conditions
+    from rules import TransitionRules
+    parser = argparse.ArgumentParser(description='Rule dispatch statistics on a random world')
+    parser.add_argument('--size', type=int, default=32)
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    world = Grid(args.size, args.size, engine='fast')
+    world.apply_initial_conditions_csv(
+        initial_conditions=random_initial_conditions(args.size, args.size, args.seed))
+    table = TransitionRules.dispatch_table()
+    table.reset_stats()
+    for _ in range(args.days):
+        world.next_day()
+    rows = table.report()
+    print(f"{'bucket':<28}{'rules':>7}{'cells':>9}{'evaluated':>11}{'skipped':>10}")
+    for row in rows:
+        print(f"{row['bucket']:<28}{row['rules']:>7}{row['cells']:>9}{row['evaluated']:>11}{row['skipped']:>10}")
+    evaluated = sum(row['evaluated'] for row in rows)
+    skipped = sum(row['skipped'] for row in rows)
+    print(f'{skipped} of {evaluated + skipped} rule evaluations skipped '
+          f'({skipped / max(evaluated + skipped, 1):.0%})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""
+This module holds the rule optimizer: an analysis of which State attributes each
+rule reads and writes, used to drop rules that cannot change the result of a day.
+
+The analysis reads the bytecode of the conditions and actions (and of the helper
+functions they call). An action is understood if it has the form of the rules in
+rules.py, setattr(neighborhood['center'], '<attribute>', <value>). Anything else
+is treated as reading and writing every attribute, so it is never removed and
+nothing is removed across it.
+
+Two kinds of rules are removed:
+- duplicates: a rule identical to an earlier enabled rule, when nothing between
+    them writes an attribute the rule reads or writes, and its value does not read
+    the attribute it writes. Applying it again can only set the same value.
+- overwritten: a rule whose attribute is always overwritten later in the same
+    step by a rule with an always true condition, before anything reads it.
+
+Example (prints the analysis of the enabled rules):
+    python rule_optimizer.py
+"""
+import dis
+import types
+from state import STATE_FIELDS
+
+ALL_FIELDS = frozenset(STATE_FIELDS)
+# Attributes / functions that read every field of a State
+WHOLE_STATE_READS = {'pack', 'copy', '__dict__', '__eq__', '__str__', 'vars'}
+# Instructions that carry no meaning for the analysis
+IGNORED_OPCODES = {'RESUME', 'NOP', 'CACHE', 'PUSH_NULL', 'PRECALL', 'EXTENDED_ARG',
+                   'MAKE_CELL', 'COPY_FREE_VARS'}
+
+
+class Effects:
+    """The State attributes a function reads and writes, and whether it is understood."""
+
+    def __init__(self, reads=frozenset(), writes=frozenset(), opaque=False):
+        self.reads = ALL_FIELDS if opaque else frozenset(reads)
+        self.writes = ALL_FIELDS if opaque else frozenset(writes)
+        self.opaque = opaque
+
+
+_code_reads = {}
+
+
+def code_reads(code, functions=None):
+    """
+    Returns the fields read by a code object (including nested code and the
+    Python functions it calls), or None if it may write anything.
+    """
+    if code in _code_reads:
+        return _code_reads[code]
+    if functions is None:
+        functions = {}
+    _code_reads[code] = frozenset()  # recursive helpers
+    reads = set()
+    for instruction in dis.get_instructions(code):
+        name = instruction.opname
+        argument = instruction.argval
+        if name in ('STORE_ATTR', 'DELETE_ATTR') or argument in ('setattr', 'delattr'):
+            reads = None
+            break
+        if argument in WHOLE_STATE_READS:
+            reads.update(ALL_FIELDS)
+        elif name.startswith('LOAD_ATTR') or name == 'LOAD_METHOD' or name == 'LOAD_CONST':
+            if isinstance(argument, str) and argument in ALL_FIELDS:
+                reads.add(argument)
+        if name == 'LOAD_GLOBAL' and argument in functions:
+            function_reads = code_reads(functions[argument].__code__, functions)
+            if function_reads is None:
+                reads = None
+                break
+            reads.update(function_reads)
+    if reads is not None:
+        for constant in code.co_consts:
+            if isinstance(constant, types.CodeType):
+                nested_reads = code_reads(constant, functions)
+                if nested_reads is None:
+                    reads = None
+                    break
+                reads.update(nested_reads)
+    _code_reads[code] = None if reads is None else frozenset(reads)
+    return _code_reads[code]
+
+
+def _module_functions(function):
+    # The Python functions a rule may call, by global name
+    return {name: value for name, value in function.__globals__.items()
+            if isinstance(value, types.FunctionType)}
+
+
+def _instructions(function):
+    return [instruction for instruction in dis.get_instructions(function)
+            if instruction.opname not in IGNORED_OPCODES]
+
+
+def condition_effects(condition):
+    reads = code_reads(condition.__code__, _module_functions(condition))
+    if reads is None or condition.__closure__:
+        return Effects(opaque=True)
+    return Effects(reads=reads)
+
+
+def action_effects(action):
+    """
+    Effects of an action of the form setattr(neighborhood['center'], '<attribute>', <value>).
+    The value expression must not write anything.
+    """
+    instructions = _instructions(action)
+    if action.__closure__ or action.__code__.co_argcount != 1 or len(instructions) < 6:
+        return Effects(opaque=True)
+    setattr_call, neighborhood, center, subscript, attribute = instructions[:5]
+    if not (setattr_call.opname == 'LOAD_GLOBAL' and setattr_call.argval == 'setattr'
+            and neighborhood.opname in ('LOAD_FAST', 'LOAD_DEREF')
+            and neighborhood.argval == action.__code__.co_varnames[0]
+            and center.opname == 'LOAD_CONST' and center.argval == 'center'
+            and subscript.opname in ('BINARY_SUBSCR', 'BINARY_OP')
+            and attribute.opname == 'LOAD_CONST' and attribute.argval in ALL_FIELDS
+            and instructions[-1].opname == 'RETURN_VALUE'):
+        return Effects(opaque=True)
+    # The value is everything after the attribute name, but the final setattr call
+    functions = _module_functions(action)
+    value_reads = set()
+    for instruction in instructions[5:]:
+        name, argument = instruction.opname, instruction.argval
+        if name in ('STORE_ATTR', 'DELETE_ATTR') or argument in ('setattr', 'delattr'):
+            return Effects(opaque=True)
+        if argument in WHOLE_STATE_READS:
+            value_reads.update(ALL_FIELDS)
+        elif name.startswith('LOAD_ATTR') or name in ('LOAD_METHOD', 'LOAD_CONST'):
+            if isinstance(argument, str) and argument in ALL_FIELDS:
+                value_reads.add(argument)
+        if name == 'LOAD_GLOBAL' and argument in functions:
+            function_reads = code_reads(functions[argument].__code__, functions)
+            if function_reads is None:
+                return Effects(opaque=True)
+            value_reads.update(function_reads)
+    for constant in action.__code__.co_consts:
+        if isinstance(constant, types.CodeType):
+            nested_reads = code_reads(constant, functions)
+            if nested_reads is None:
+                return Effects(opaque=True)
+            value_reads.update(nested_reads)
+    return Effects(reads=value_reads, writes={attribute.argval})
+
+
+def is_always_true(condition):
+    instructions = _instructions(condition)
+    if len(instructions) == 1:
+        return instructions[0].opname == 'RETURN_CONST' and instructions[0].argval is True
+    return (len(instructions) == 2 and instructions[0].opname == 'LOAD_CONST'
+            and instructions[0].argval is True and instructions[1].opname == 'RETURN_VALUE')
+
+
+def _code_key(code):
+    return (code.co_code, code.co_names, code.co_varnames, code.co_argcount,
+            tuple(_code_key(constant) if isinstance(constant, types.CodeType) else constant
+                  for constant in code.co_consts))
+
+
+def function_key(function):
+    """Functions with the same key behave the same (same code, globals, and no closure)."""
+    if function.__closure__ or function.__defaults__:
+        return ('function', id(function))
+    return (_code_key(function.__code__), id(function.__globals__))
+
+
+class RuleAnalysis:
+    """The effects of one rule (condition and action together)."""
+
+    def __init__(self, rule):
+        self.rule = rule
+        condition = condition_effects(rule['condition'])
+        action = action_effects(rule['action'])
+        self.opaque = condition.opaque or action.opaque
+        self.reads = condition.reads | action.reads
+        self.value_reads = action.reads
+        self.writes = action.writes
+        self.always = is_always_true(rule['condition'])
+        self.key = (function_key(rule['condition']), function_key(rule['action']))
+
+
+def optimize_rules(rules, enabled=None):
+    """
+    Returns the enabled rules without the redundant ones, and a report:
+    a list of dictionaries (index, name, reason) of the removed rules.
+    enabled is a list of flags (one per rule), by default the rules' own.
+    """
+    if enabled is None:
+        enabled = [rule['enabled'] for rule in rules]
+    enabled = [(index, rule) for index, (rule, rule_enabled) in enumerate(zip(rules, enabled))
+               if rule_enabled]
+    analyses = [RuleAnalysis(rule) for _, rule in enabled]
+    removed = {}
+
+    # Duplicates: compare every rule to the earlier kept rules with the same key
+    for position, analysis in enumerate(analyses):
+        if analysis.opaque or len(analysis.writes) != 1 or analysis.writes <= analysis.value_reads:
+            continue
+        touched = analysis.reads | analysis.writes
+        for earlier in range(position - 1, -1, -1):
+            if earlier in removed:
+                continue
+            if analyses[earlier].key == analysis.key:
+                removed[position] = f'duplicate of rule {enabled[earlier][0]}'
+                break
+            if analyses[earlier].writes & touched:
+                break
+
+    # Overwritten: backward liveness of the attributes, everything is live at the end of the step
+    live = set(ALL_FIELDS)
+    for position in range(len(analyses) - 1, -1, -1):
+        if position in removed:
+            continue
+        analysis = analyses[position]
+        if not analysis.opaque and not (analysis.writes & live):
+            overwriting = next(
+                enabled[later][0] for later in range(position + 1, len(analyses))
+                if later not in removed and analyses[later].always
+                and analyses[later].writes == analysis.writes)
+            removed[position] = f'{next(iter(analysis.writes))} is overwritten by rule {overwriting}'
+            continue
+        if analysis.always and not analysis.opaque:
+            live -= analysis.writes
+        live |= analysis.reads
+
+    active = [rule for position, (_, rule) in enumerate(enabled) if position not in removed]
+    report = [{'index': enabled[position][0], 'name': enabled[position][1]['name'],
+               'reason': reason} for position, reason in sorted(removed.items())]
+    return active, report
+
+
+def format_report(report):
+    if not report:
+        return 'No redundant rules.'
+    return '\n'.join(f"rule {entry['index']}: {entry['name']}\n    removed, {entry['reason']}"
+                     for entry in report)
+
+
+def main():
+    from rules import TransitionRules
+    for index, rule in enumerate(TransitionRules.rules):
+        if not rule['enabled']:
+            continue
+        analysis = RuleAnalysis(rule)
+        if analysis.opaque:
+            effects = 'not understood'
+        else:
+            effects = f"reads {sorted(analysis.reads)}, writes {sorted(analysis.writes)}" + \
+                (', always' if analysis.always else '')
+        print(f"{index:>3} {rule['name'][:60]:<60} {effects}")
+    print()
+    active, report = optimize_rules(TransitionRules.rules)
+    print(format_report(report))
+    enabled = sum(rule['enabled'] for rule in TransitionRules.rules)
+    print(f'{len(active)} of {enabled} enabled rules are applied')
+
+
+if __name__ == '__main__':
+    main()
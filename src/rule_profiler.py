@@ -0,0 +1,86 @@
+"""
+This module holds the per-rule instrumentation of the transition rules.
+When a RuleProfiler is set on TransitionRules.profiler, every rule application records:
+- how long the condition and the action took,
+- how many times the condition was true or false,
+- how many times the action actually changed the cell's state.
+The collected data can be read through report(), or dumped as CSV / JSON.
+"""
+import csv
+import json
+
+FIELDNAMES = ['index', 'name', 'enabled', 'evaluations', 'true', 'false', 'changed',
+              'condition_time', 'action_time', 'total_time',
+              'mean_condition_us', 'mean_action_us', 'hit_rate', 'change_rate']
+
+
+class RuleProfiler:
+    """
+    Collects timings and hit counts per rule.
+    Rules are identified by their position in the rules list, since names are not unique.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.reset()
+
+    def reset(self):
+        # id(rule) -> [true, false, changed, condition_time, action_time]
+        self.counters = {id(rule): [0, 0, 0, 0.0, 0.0] for rule in self.rules}
+
+    def record(self, rule, condition_time, action_time, result, changed):
+        counters = self.counters.get(id(rule))
+        if counters is None:
+            # A rule added after the profiler was created
+            counters = self.counters[id(rule)] = [0, 0, 0, 0.0, 0.0]
+        if result:
+            counters[0] += 1
+            if changed:
+                counters[2] += 1
+        else:
+            counters[1] += 1
+        counters[3] += condition_time
+        counters[4] += action_time
+
+    def rule_stats(self, rule):
+        """Returns the collected statistics of one rule as a dictionary."""
+        index = next((i for i, other in enumerate(self.rules) if other is rule), -1)
+        true, false, changed, condition_time, action_time = self.counters.get(
+            id(rule), [0, 0, 0, 0.0, 0.0])
+        evaluations = true + false
+        return {
+            'index': index,
+            'name': rule['name'],
+            'enabled': rule['enabled'],
+            'evaluations': evaluations,
+            'true': true,
+            'false': false,
+            'changed': changed,
+            'condition_time': condition_time,
+            'action_time': action_time,
+            'total_time': condition_time + action_time,
+            'mean_condition_us': condition_time / evaluations * 1e6 if evaluations else 0.0,
+            'mean_action_us': action_time / true * 1e6 if true else 0.0,
+            'hit_rate': true / evaluations if evaluations else 0.0,
+            'change_rate': changed / true if true else 0.0,
+        }
+
+    def report(self, sort_by=None):
+        """
+        Returns the statistics of all the rules, in rules order,
+        or sorted descending by one of the fields (e.g. 'total_time').
+        """
+        stats = [self.rule_stats(rule) for rule in self.rules]
+        if sort_by is not None:
+            stats.sort(key=lambda rule_stats: rule_stats[sort_by], reverse=True)
+        return stats
+
+    def dump_csv(self, file_path, sort_by=None):
+        with open(file_path, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
+            writer.writeheader()
+            writer.writerows(self.report(sort_by))
+
+    def dump_json(self, file_path, sort_by=None):
+        with open(file_path, 'w') as jsonfile:
+            json.dump(self.report(sort_by), jsonfile, indent=2)
@@ -18,25 +18,67 @@ namedtuple are immutable, so I couldn't change the enabled value of a rule after
 The namedtuple approach is commented below.
 """
 import copy
+from time import perf_counter
+from rule_profiler import RuleProfiler
+from rule_optimizer import optimize_rules
+from rule_dispatch import DispatchTable
+from scheduler import rule_category
+from neighborhood import (Neighborhood, OPPOSITE_DIRECTIONS, aggregate, neighbors_blow_towards,
+                          neighbors_counts, neighbors_count_above, neighbors_max,
+                          neighbors_hottest, neighbors_wind_by_direction, neighbor_wind_from)
 from state import Landscape, WindDirection, WindSpeed, Temperature, Rain, AirQuality
 
 
 def get_wind_direction_from_to(from_direction):
     # Maps each direction to the direction it's coming from
-    direction_map = {
-        WindDirection.NORTH: WindDirection.SOUTH,
-        WindDirection.SOUTH: WindDirection.NORTH,
-        WindDirection.EAST: WindDirection.WEST,
-        WindDirection.WEST: WindDirection.EAST,
-        WindDirection.NORTHEAST: WindDirection.SOUTHWEST,
-        WindDirection.SOUTHEAST: WindDirection.NORTHWEST,
-        WindDirection.SOUTHWEST: WindDirection.NORTHEAST,
-        WindDirection.NORTHWEST: WindDirection.SOUTHEAST,
-    }
-    return direction_map.get(from_direction, WindDirection.NONE)
+    return OPPOSITE_DIRECTIONS.get(from_direction, WindDirection.NONE)
+
+
+# The helpers below answer questions about the whole neighborhood (the neighbors and the center):
+# the neighbors' part is computed once per cell per step (see neighborhood.py),
+# and combined with the center's current value.
+
+def count_in_neighborhood(neighborhood, attribute, value):
+    count = aggregate(neighborhood, neighbors_counts, attribute).get(value, 0)
+    return count + (getattr(neighborhood['center'], attribute) == value)
+
+
+def any_in_neighborhood(neighborhood, attribute, value):
+    return count_in_neighborhood(neighborhood, attribute, value) > 0
+
+
+def all_in_neighborhood(neighborhood, attribute, value):
+    counts = aggregate(neighborhood, neighbors_counts, attribute)
+    return getattr(neighborhood['center'], attribute) == value and counts.get(value, 0) == sum(counts.values())
+
+
+def count_above_in_neighborhood(neighborhood, attribute, threshold):
+    count = aggregate(neighborhood, neighbors_count_above, attribute, threshold)
+    return count + (getattr(neighborhood['center'], attribute) > threshold)
+
+
+def max_in_neighborhood(neighborhood, attribute):
+    neighbors_value = aggregate(neighborhood, neighbors_max, attribute)
+    value = getattr(neighborhood['center'], attribute)
+    return value if neighbors_value is None or value > neighbors_value else neighbors_value
+
+
+def hottest_in_neighborhood(neighborhood):
+    # Same as max(neighborhood.values(), key=temperature): the first hottest, the center comes last
+    neighbor = aggregate(neighborhood, neighbors_hottest)
+    center = neighborhood['center']
+    return center if neighbor is None or center.temperature > neighbor.temperature else neighbor
 
 
 def change_wind_direction(neighborhood):
+    # Cached by the center values it depends on, so an engine can compute it
+    # for the whole grid beforehand (see transport.py)
+    center = neighborhood['center']
+    return aggregate(neighborhood, compute_wind_direction, center.wind_direction, center.temperature)
+
+
+def compute_wind_direction(neighborhood, wind_direction, temperature):
+    # wind_direction and temperature are the center's (the cache key of change_wind_direction)
     # if wind toward edge, change direction to opposite direction
     if neighborhood['center'].wind_direction not in neighborhood:
         # check if there is a neighbor with opposite direction that has wind towards the cell
@@ -46,8 +88,7 @@ def change_wind_direction(neighborhood):
             if neighbor and neighbor.wind_direction != get_wind_direction_from_to(direction):
                 return get_wind_direction_from_to(direction)
         # move to the highest temperature neighbor
-        neighbor_with_highest_temperature = max(
-            neighborhood.values(), key=lambda neighbor: neighbor.temperature)
+        neighbor_with_highest_temperature = hottest_in_neighborhood(neighborhood)
         if neighbor_with_highest_temperature.wind_direction != WindDirection.NONE \
                 and neighbor_with_highest_temperature.wind_direction in neighborhood:
             return neighbor_with_highest_temperature.wind_direction
@@ -68,20 +109,15 @@ def change_wind_direction(neighborhood):
                 return get_wind_direction_from_to(direction)
 
     # Get the neighbor with the highest temperature
-    neighbor_with_highest_temperature = max(
-        neighborhood.values(), key=lambda neighbor: neighbor.temperature)
+    neighbor_with_highest_temperature = hottest_in_neighborhood(neighborhood)
 
     # Set the wind direction to the direction of the neighbor with the highest temperature
     return neighbor_with_highest_temperature.wind_direction
 
 
 def spread_pollution_based_on_wind(neighborhood):
-    # Check the wind direction from the neighbor to the cell
-    wind_direction = get_wind_direction_from_to(
-        neighborhood['center'].wind_direction)
-
     # If the wind is blowing from the neighbor to the cell, spread the pollution
-    if neighborhood.get(wind_direction, None) and neighborhood.get(wind_direction, None).wind_speed > WindSpeed.NONE:
+    if aggregate(neighborhood, neighbor_wind_from, neighborhood['center'].wind_direction):
         return neighborhood['center'].air_pollution + AirQuality(1)
 
     # Otherwise, reduce the pollution
@@ -89,34 +125,15 @@ def spread_pollution_based_on_wind(neighborhood):
 
 
 def is_wind_blowing_towards_cell(neighborhood):
-    opposite_directions = {
-        WindDirection.NORTH: WindDirection.SOUTH,
-        WindDirection.SOUTH: WindDirection.NORTH,
-        WindDirection.EAST: WindDirection.WEST,
-        WindDirection.WEST: WindDirection.EAST,
-        WindDirection.NORTHEAST: WindDirection.SOUTHWEST,
-        WindDirection.SOUTHEAST: WindDirection.NORTHWEST,
-        WindDirection.SOUTHWEST: WindDirection.NORTHEAST,
-        WindDirection.NORTHWEST: WindDirection.SOUTHEAST,
-    }
     # check if the wind is blowing towards the cell in the center from one of its neighbors
-    for direction, neighbor in neighborhood.items():
-        if direction == 'center':
-            continue
-        if neighbor and neighbor.wind_direction == opposite_directions.get(direction, WindDirection.NONE):
-            return True
-
-    return False
+    return aggregate(neighborhood, neighbors_blow_towards)
 
 
 def calculate_wind_speed_change(neighborhood):
     # Calculate wind speed based on neighbors
-    for direction, neighbor in neighborhood.items():
-        if direction == 'center':
-            continue
-        if neighbor and is_wind_blowing_towards_cell(neighborhood):
-            # Increase wind speed if wind is blowing towards the cell
-            return neighborhood['center'].wind_speed + WindSpeed(2)
+    if is_wind_blowing_towards_cell(neighborhood):
+        # Increase wind speed if wind is blowing towards the cell
+        return neighborhood['center'].wind_speed + WindSpeed(2)
 
     # If no wind is blowing towards the cell, decrease its wind speed
     return neighborhood['center'].wind_speed - WindSpeed(1)
@@ -126,11 +143,28 @@ class TransitionRules:
     """
     This class contains the rules for the simulation.
     The rules use the context manager protocol to create a neighborhood for the cell.
-    The neighborhood is a dictionary of the cell's neighbors, with the cell in the center.
+    The neighborhood is a dictionary of the cell's neighbors, with the cell in the center
+    (a neighborhood.Neighborhood, which caches the aggregates of the neighbors).
     The rules are applied on the cell in the center of the neighborhood.
     Lambda functions are used to define the rules, so that they can be easily added,
     removed or modified in the rules list.
+    Setting a RuleProfiler on TransitionRules.profiler (see enable_profiling) records
+    per rule timings and hit counts.
+    active() returns the enabled rules without the ones the rule optimizer proved
+    redundant (see rule_optimizer), it is used by the engines unless optimize is False.
+    dispatch_table() indexes the active rules by the center's land type, wind speed
+    and clouds (see rule_dispatch), so a cell only evaluates the rules that can apply to it.
+    Both take the rule categories to skip on the current step (see scheduler), and
+    the mask of a world with its own enabled flags (a tuple of one flag per rule,
+    see Grid.fork), None for the rules' own flags.
     """
+    profiler = None
+    optimize = True
+    optimization_report = []
+    _rules_key = None  # the rules the caches below were computed for
+    _active = {}  # (skipped categories, mask) -> active rules
+    _dispatch_tables = {}  # (skipped categories, mask) -> rule_dispatch.DispatchTable
+
     rules = [
         # ================ Wind ================
         {
@@ -158,27 +192,27 @@ class TransitionRules:
             'enabled': True,
             'condition': lambda neighborhood: True,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'wind_speed',
-                                                   WindSpeed.STRONG if neighborhood['center'].land_type == Landscape.SEA and all(neighbors.wind_direction == neighborhood['center'].wind_direction for neighbors in neighborhood.values()) and neighborhood['center'].wind_speed == WindSpeed.NONE
+                                                   WindSpeed.STRONG if neighborhood['center'].land_type == Landscape.SEA and all_in_neighborhood(neighborhood, 'wind_direction', neighborhood['center'].wind_direction) and neighborhood['center'].wind_speed == WindSpeed.NONE
                                                    else max(WindSpeed.NONE, neighborhood['center'].wind_speed - WindSpeed(1)) if neighborhood['center'].land_type == Landscape.FOREST
-                                                   else neighborhood['center'].wind_speed + WindSpeed(1) if any(neighbor.wind_direction == neighborhood['center'].wind_direction and neighbor.wind_speed > neighborhood['center'].wind_speed for neighbor in neighborhood.values())
+                                                   else neighborhood['center'].wind_speed + WindSpeed(1) if aggregate(neighborhood, neighbors_wind_by_direction).get(neighborhood['center'].wind_direction, WindSpeed.NONE) > neighborhood['center'].wind_speed
                                                    else neighborhood['center'].wind_speed)
         },
         {
             'name': 'WIND: fades if no neighbors have wind and wind speed is greater than 1 or if strongest wind in the neighborhood from center',
             'enabled': True,
-            'condition': lambda neighborhood: all(neighbor.wind_speed == WindSpeed.NONE for neighbor in neighborhood.values()) and neighborhood['center'].wind_speed > WindSpeed.NONE or neighborhood['center'].wind_speed == max(neighborhood.values(), key=lambda neighbor: neighbor.wind_speed).wind_speed,
+            'condition': lambda neighborhood: all_in_neighborhood(neighborhood, 'wind_speed', WindSpeed.NONE) and neighborhood['center'].wind_speed > WindSpeed.NONE or neighborhood['center'].wind_speed == max_in_neighborhood(neighborhood, 'wind_speed'),
             'action': lambda neighborhood: setattr(neighborhood['center'], 'wind_speed', neighborhood['center'].wind_speed - WindSpeed(1))
         },
         {
             'name': 'WIND: stops if neighbors have no wind or winds come from opposite directions',
             'enabled': True,
-            'condition': lambda neighborhood: all(neighbor.wind_speed == WindSpeed.NONE for neighbor in neighborhood.values()) or is_wind_blowing_towards_cell(neighborhood) == False,
+            'condition': lambda neighborhood: all_in_neighborhood(neighborhood, 'wind_speed', WindSpeed.NONE) or is_wind_blowing_towards_cell(neighborhood) == False,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'wind_speed', WindSpeed.NONE)
         },
         {
             'name': 'WIND: Conflicts if my neighbors from the same direction dont have wind, reduce my wind',
             'enabled': True,
-            'condition': lambda neighborhood: all(neighbor.wind_speed == WindSpeed.NONE for neighbor in neighborhood.values() if neighbor.wind_direction == neighborhood['center'].wind_direction),
+            'condition': lambda neighborhood: neighborhood['center'].wind_speed == WindSpeed.NONE and aggregate(neighborhood, neighbors_wind_by_direction).get(neighborhood['center'].wind_direction, WindSpeed.NONE) == WindSpeed.NONE,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'wind_speed', neighborhood['center'].wind_speed - WindSpeed(1))
         },
 
@@ -186,13 +220,13 @@ class TransitionRules:
         {
             'name': 'CLOUDS: Add if one neighbor has clouds and wind direction is towards current cell',
             'enabled': True,
-            'condition': lambda neighborhood: any(neighbor.clouds == True for neighbor in neighborhood.values()) and is_wind_blowing_towards_cell(neighborhood),
+            'condition': lambda neighborhood: any_in_neighborhood(neighborhood, 'clouds', True) and is_wind_blowing_towards_cell(neighborhood),
             'action': lambda neighborhood: setattr(neighborhood['center'], 'clouds', True)
         },
         {
             'name': 'CLOUDS: stop if no neighbors have clouds and current cell has wind',
             'enabled': True,
-            'condition': lambda neighborhood: all(neighbor.clouds == False for neighbor in neighborhood.values()) and neighborhood['center'].wind_speed > WindSpeed.NONE,
+            'condition': lambda neighborhood: all_in_neighborhood(neighborhood, 'clouds', False) and neighborhood['center'].wind_speed > WindSpeed.NONE,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'clouds', False)
         },
         {
@@ -224,7 +258,7 @@ class TransitionRules:
         {
             'name': 'Clouds: come from the direction of the neighbor with the highest temperature',
             'enabled': True,
-            'condition': lambda neighborhood: any(neighbor.temperature > neighborhood['center'].temperature for neighbor in neighborhood.values()),
+            'condition': lambda neighborhood: max_in_neighborhood(neighborhood, 'temperature') > neighborhood['center'].temperature,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'clouds', True)
         },
 
@@ -232,7 +266,7 @@ class TransitionRules:
         {
             'name': 'RAIN: stop if no nabors have clouds and current cell has wind',
             'enabled': True,
-            'condition': lambda neighborhood: all(neighbor.clouds == False for neighbor in neighborhood.values()) and neighborhood['center'].wind_speed > WindSpeed.NONE,
+            'condition': lambda neighborhood: all_in_neighborhood(neighborhood, 'clouds', False) and neighborhood['center'].wind_speed > WindSpeed.NONE,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'rainfall', Rain(0))
 
         },
@@ -245,7 +279,7 @@ class TransitionRules:
         {
             'name': 'RAIN: Add if current cell has clouds and at least one neighbor has rain',
             'enabled': True,
-            'condition': lambda neighborhood: any(neighbor.rainfall > Rain(0) for neighbor in neighborhood.values()) and neighborhood['center'].clouds == True,
+            'condition': lambda neighborhood: max_in_neighborhood(neighborhood, 'rainfall') > Rain(0) and neighborhood['center'].clouds == True,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'rainfall', getattr(neighborhood['center'], 'rainfall', 0) + Rain(2))
         },
         {
@@ -279,13 +313,13 @@ class TransitionRules:
             'name': 'AIR: Cities creates pollution add by the number of city neighbors',
             'enabled': True,
             'condition': lambda neighborhood: neighborhood['center'].land_type == Landscape.CITY,
-            'action': lambda neighborhood: setattr(neighborhood['center'], 'air_pollution', neighborhood['center'].air_pollution + AirQuality(len([neighbor for neighbor in neighborhood.values() if neighbor and neighbor.land_type == Landscape.CITY])))
+            'action': lambda neighborhood: setattr(neighborhood['center'], 'air_pollution', neighborhood['center'].air_pollution + AirQuality(count_in_neighborhood(neighborhood, 'land_type', Landscape.CITY)))
         },
         {
             'name': 'AIR: Increase pollution based on neighbors pollution and wind direction',
             'enabled': True,
-            'condition': lambda neighborhood: any(neighbor.air_pollution > AirQuality(0) for neighbor in neighborhood.values()) and is_wind_blowing_towards_cell(neighborhood),
-            'action': lambda neighborhood: setattr(neighborhood['center'], 'air_pollution', neighborhood['center'].air_pollution + AirQuality(max(neighbor.air_pollution.value for neighbor in neighborhood.values())))
+            'condition': lambda neighborhood: max_in_neighborhood(neighborhood, 'air_pollution') > AirQuality(0) and is_wind_blowing_towards_cell(neighborhood),
+            'action': lambda neighborhood: setattr(neighborhood['center'], 'air_pollution', neighborhood['center'].air_pollution + AirQuality(max_in_neighborhood(neighborhood, 'air_pollution').value))
         },
         {
             'name': 'AIR: Reduce pollution based on wind speed',
@@ -316,13 +350,13 @@ class TransitionRules:
         {
             'name': 'TEMP: Forest reduces temperature if at least 3 neighbors have temperature above warm or if its temperature is above warm',
             'enabled': True,
-            'condition': lambda neighborhood: neighborhood['center'].land_type == Landscape.FOREST and (neighborhood['center'].temperature >= Temperature.WARM or sum(neighbor.temperature > Temperature.WARM for neighbor in neighborhood.values()) >= 3),
+            'condition': lambda neighborhood: neighborhood['center'].land_type == Landscape.FOREST and (neighborhood['center'].temperature >= Temperature.WARM or count_above_in_neighborhood(neighborhood, 'temperature', Temperature.WARM) >= 3),
             'action': lambda neighborhood: setattr(neighborhood['center'], 'temperature', neighborhood['center'].temperature - Temperature(1))
         },
         {
             'name': 'TEMP: low neighbors reduces temperature',
             'enabled': True,
-            'condition': lambda neighborhood: neighborhood['center'].wind_speed > WindSpeed.NONE and any(neighbor.wind_speed > WindSpeed.NONE for neighbor in neighborhood.values()),
+            'condition': lambda neighborhood: neighborhood['center'].wind_speed > WindSpeed.NONE and max_in_neighborhood(neighborhood, 'wind_speed') > WindSpeed.NONE,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'temperature', neighborhood['center'].temperature - Temperature(1))
         },
         {
@@ -337,7 +371,7 @@ class TransitionRules:
         {
             'name': 'Ice melts if at least 6 neighbors have temperature above freezing or if its temperature is above freezing',
             'enabled': True,
-            'condition': lambda neighborhood: neighborhood['center'].land_type == Landscape.ICE and (neighborhood['center'].temperature > Temperature.ZERO or sum(neighbor.temperature > Temperature.FREEZING for neighbor in neighborhood.values()) >= 6),
+            'condition': lambda neighborhood: neighborhood['center'].land_type == Landscape.ICE and (neighborhood['center'].temperature > Temperature.ZERO or count_above_in_neighborhood(neighborhood, 'temperature', Temperature.FREEZING) >= 6),
             'action': lambda neighborhood: setattr(neighborhood['center'], 'land_type', Landscape.SEA)
         },
         {
@@ -349,33 +383,33 @@ class TransitionRules:
         {
             'name': 'Forests burn if at least 3 neighbors have temperature above warm or if its temperature is above warm',
             'enabled': True,
-            'condition': lambda neighborhood: neighborhood['center'].land_type == Landscape.FOREST and (neighborhood['center'].temperature >= Temperature.WARM or sum(neighbor.temperature > Temperature.WARM for neighbor in neighborhood.values()) >= 3),
+            'condition': lambda neighborhood: neighborhood['center'].land_type == Landscape.FOREST and (neighborhood['center'].temperature >= Temperature.WARM or count_above_in_neighborhood(neighborhood, 'temperature', Temperature.WARM) >= 3),
             'action': lambda neighborhood: setattr(neighborhood['center'], 'land_type', Landscape.LAND)
         },
         {
             'name': 'Land become sea if temperature is above freezing and wind speed is above none and neighbor is sea and current cell is land and rainfall is above 3',
             'enabled': True,
-            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed > WindSpeed.NONE and any(neighbor.land_type == Landscape.SEA for neighbor in neighborhood.values()) and neighborhood['center'].land_type == Landscape.LAND and neighborhood['center'].rainfall > Rain.STORM,
+            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed > WindSpeed.NONE and any_in_neighborhood(neighborhood, 'land_type', Landscape.SEA) and neighborhood['center'].land_type == Landscape.LAND and neighborhood['center'].rainfall > Rain.STORM,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'land_type', Landscape.SEA)
         },
         {
             'name': 'Sea become land if temperature is HEATWAVE or if doesnt have at least 2 city neighbors',
             'enabled': True,
-            'condition': lambda neighborhood: neighborhood['center'].temperature == Temperature.HEATWAVE or neighborhood['center'].temperature == Temperature.HOT and sum(neighbor.land_type == Landscape.CITY for neighbor in neighborhood.values()) < 2,
+            'condition': lambda neighborhood: neighborhood['center'].temperature == Temperature.HEATWAVE or neighborhood['center'].temperature == Temperature.HOT and count_in_neighborhood(neighborhood, 'land_type', Landscape.CITY) < 2,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'land_type', Landscape.LAND)
         },
         {
             'name': 'Land become city if temperature is above freezing and wind speed is below Heavy and neighbor cell is forest or see or ciry and current cell is land',
             'enabled': True,
-            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed < WindSpeed.VERY_STRONG and any(neighbor.land_type == Landscape.CITY or neighbor.land_type == Landscape.FOREST or neighbor.land_type == Landscape.SEA for neighbor in neighborhood.values()) and neighborhood['center'].land_type == Landscape.LAND,
+            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed < WindSpeed.VERY_STRONG and (any_in_neighborhood(neighborhood, 'land_type', Landscape.CITY) or any_in_neighborhood(neighborhood, 'land_type', Landscape.FOREST) or any_in_neighborhood(neighborhood, 'land_type', Landscape.SEA)) and neighborhood['center'].land_type == Landscape.LAND,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'land_type', Landscape.CITY)
         },
         {
             'name': 'City become land if temperature is HEATWAVE or if doesnt have at least 2 city neighbors or if pollution is max',
             'enabled': True,
             'condition': lambda neighborhood: neighborhood['center'].air_pollution >= AirQuality.MAX or neighborhood['center'].temperature == Temperature.HEATWAVE or
-            neighborhood['center'].temperature >= Temperature.HEATWAVE or neighborhood['center'].temperature == Temperature.HOT and sum(
-                neighbor.land_type == Landscape.CITY for neighbor in neighborhood.values()) < 2,
+            neighborhood['center'].temperature >= Temperature.HEATWAVE or neighborhood['center'].temperature == Temperature.HOT and count_in_neighborhood(
+                neighborhood, 'land_type', Landscape.CITY) < 2,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'land_type', Landscape.LAND)
         },
 
@@ -388,37 +422,37 @@ class TransitionRules:
         {
             'name': 'Land become sea if temperature is above freezing and wind speed is above none and neighbor is sea and current cell is land and rainfall is above 3',
             'enabled': True,
-            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed > WindSpeed.NONE and any(neighbor.land_type == Landscape.SEA for neighbor in neighborhood.values()) and neighborhood['center'].land_type == Landscape.LAND and neighborhood['center'].rainfall > Rain.STORM,
+            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed > WindSpeed.NONE and any_in_neighborhood(neighborhood, 'land_type', Landscape.SEA) and neighborhood['center'].land_type == Landscape.LAND and neighborhood['center'].rainfall > Rain.STORM,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'land_type', Landscape.SEA)
         },
         {
             'name': 'Land become city if temperature is above freezing and wind speed is below Heavy and neighbor cell is forest or see or ciry and current cell is land',
             'enabled': False,
-            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed < WindSpeed.VERY_STRONG and any(neighbor.land_type == Landscape.CITY or neighbor.land_type == Landscape.FOREST or neighbor.land_type == Landscape.SEA for neighbor in neighborhood.values()) and neighborhood['center'].land_type == Landscape.LAND,
+            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed < WindSpeed.VERY_STRONG and (any_in_neighborhood(neighborhood, 'land_type', Landscape.CITY) or any_in_neighborhood(neighborhood, 'land_type', Landscape.FOREST) or any_in_neighborhood(neighborhood, 'land_type', Landscape.SEA)) and neighborhood['center'].land_type == Landscape.LAND,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'land_type', Landscape.CITY)
         },
         {
             'name': 'City become land if temperature is HEATWAVE or if doesnt have at least 2 city neighbors',
             'enabled': True,
-            'condition': lambda neighborhood: neighborhood['center'].temperature == Temperature.HEATWAVE or neighborhood['center'].temperature == Temperature.HOT and sum(neighbor.land_type == Landscape.CITY for neighbor in neighborhood.values()) < 2,
+            'condition': lambda neighborhood: neighborhood['center'].temperature == Temperature.HEATWAVE or neighborhood['center'].temperature == Temperature.HOT and count_in_neighborhood(neighborhood, 'land_type', Landscape.CITY) < 2,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'land_type', Landscape.LAND)
         },
         {
             'name': 'Land become forest if temperature is above freezing and wind speed is above none and neighbor is forest and current cell is land',
             'enabled': True,
-            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed > WindSpeed.NONE and any(neighbor.land_type == Landscape.FOREST for neighbor in neighborhood.values()) and neighborhood['center'].land_type == Landscape.LAND,
+            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed > WindSpeed.NONE and any_in_neighborhood(neighborhood, 'land_type', Landscape.FOREST) and neighborhood['center'].land_type == Landscape.LAND,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'land_type', Landscape.FOREST)
         },
         {
             'name': 'land become forest if temperature is above freezing and wind speed is above none and neighbor is forest and current cell is land',
             'enabled': True,
-            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed > WindSpeed.NONE and any(neighbor.land_type == Landscape.FOREST for neighbor in neighborhood.values()) and neighborhood['center'].land_type == Landscape.LAND,
+            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed > WindSpeed.NONE and any_in_neighborhood(neighborhood, 'land_type', Landscape.FOREST) and neighborhood['center'].land_type == Landscape.LAND,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'land_type', Landscape.FOREST)
         },
         {
             'name': 'Sea become ice if temperature is below freezing and wind speed is above none and neighbor is ice',
             'enabled': True,
-            'condition': lambda neighborhood: neighborhood['center'].temperature < Temperature.FREEZING and neighborhood['center'].wind_speed > WindSpeed.NONE and any(neighbor.land_type == Landscape.ICE for neighbor in neighborhood.values()),
+            'condition': lambda neighborhood: neighborhood['center'].temperature < Temperature.FREEZING and neighborhood['center'].wind_speed > WindSpeed.NONE and any_in_neighborhood(neighborhood, 'land_type', Landscape.ICE),
             'action': lambda neighborhood: setattr(neighborhood['center'], 'land_type', Landscape.ICE)
         },
         {
@@ -430,7 +464,7 @@ class TransitionRules:
         {
             'name': 'land become sea if temperature is above freezing and wind speed is above none and neighbor is sea and current cell is land and rainfall is above 3',
             'enabled': True,
-            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed > WindSpeed.NONE and any(neighbor.land_type == Landscape.SEA for neighbor in neighborhood.values()) and neighborhood['center'].land_type == Landscape.LAND and neighborhood['center'].rainfall > Rain.STORM,
+            'condition': lambda neighborhood: neighborhood['center'].temperature > Temperature.FREEZING and neighborhood['center'].wind_speed > WindSpeed.NONE and any_in_neighborhood(neighborhood, 'land_type', Landscape.SEA) and neighborhood['center'].land_type == Landscape.LAND and neighborhood['center'].rainfall > Rain.STORM,
             'action': lambda neighborhood: setattr(neighborhood['center'], 'land_type', Landscape.SEA)
         },
 
@@ -479,14 +513,15 @@ class TransitionRules:
         },
     ]
 
-    def __init__(self, cell=None):
-        self.enabled_rules = [rule for rule in self.rules if rule['enabled']]
+    def __init__(self, cell=None, rules=None):
+        # the rules to apply, by default all the enabled rules
+        self.enabled_rules = rules if rules is not None else self.enabled()
         self.cell = cell
         self.neighborhood = None
 
     def __enter__(self):
         # Setup code for the context manager (e.g., creating the neighborhood)
-        self.neighborhood = {}
+        self.neighborhood = Neighborhood()
         for direction, neighbor in self.cell.neighbors.items():
             if neighbor:
                 self.neighborhood[direction] = copy.deepcopy(neighbor.state)
@@ -499,10 +534,116 @@ class TransitionRules:
         pass
 
     def apply_rules(self):
-        for rule in self.enabled_rules:
-            if rule['condition'](self.neighborhood):
-                rule['action'](self.neighborhood)
-        return self.neighborhood.get('center', None)
+        return self.apply(self.neighborhood, self.enabled_rules)
+
+    @classmethod
+    def enabled(cls):
+        return [rule for rule in cls.rules if rule['enabled']]
+
+    @classmethod
+    def enabled_flags(cls, mask=None):
+        """The enabled flag of every rule, the mask's when given."""
+        if mask is None:
+            return [rule['enabled'] for rule in cls.rules]
+        if len(mask) != len(cls.rules):
+            raise ValueError(f'The rule mask has {len(mask)} flags for {len(cls.rules)} rules')
+        return list(mask)
+
+    @classmethod
+    def scheduled(cls, skip=frozenset(), mask=None):
+        """The enabled rules, without the ones of the skipped categories."""
+        if not skip and mask is None:
+            return cls.enabled()
+        return [rule for rule, enabled in zip(cls.rules, cls.enabled_flags(mask))
+                if enabled and rule_category(rule) not in skip]
+
+    @classmethod
+    def rules_key(cls):
+        """Changes when a rule is enabled, disabled or replaced."""
+        return tuple((id(rule['condition']), id(rule['action']), rule['enabled']) for rule in cls.rules)
+
+    @classmethod
+    def _check_rules(cls):
+        # Drops the cached rule lists when the rules change
+        key = cls.rules_key()
+        if key != cls._rules_key:
+            cls._rules_key = key
+            cls._active = {}
+            cls._dispatch_tables = {}
+
+    @classmethod
+    def active(cls, skip=frozenset(), mask=None):
+        """
+        The scheduled rules to apply, without the redundant ones. While profiling,
+        all of them are applied, so every rule gets its statistics.
+        """
+        if not cls.optimize or cls.profiler is not None:
+            return cls.scheduled(skip, mask)
+        cls._check_rules()
+        active = cls._active.get((skip, mask))
+        if active is None:
+            enabled = [enabled and rule_category(rule) not in skip
+                       for rule, enabled in zip(cls.rules, cls.enabled_flags(mask))]
+            active, report = optimize_rules(cls.rules, enabled)
+            cls._active[(skip, mask)] = active
+            if not skip and mask is None:
+                cls.optimization_report = report
+        return active
+
+    @classmethod
+    def dispatch_table(cls, skip=frozenset(), mask=None):
+        """The dispatch table of the active rules, rebuilt when they change."""
+        active = cls.active(skip, mask)
+        cls._check_rules()
+        table = cls._dispatch_tables.get((skip, mask))
+        if table is None or [id(rule) for rule in table.rules] != [id(rule) for rule in active]:
+            table = cls._dispatch_tables[(skip, mask)] = DispatchTable(active)
+        return table
+
+    @classmethod
+    def apply(cls, neighborhood, rules):
+        """
+        Applies the rules on the center of the neighborhood (which is changed in place),
+        returns the center.
+        """
+        if cls.profiler is not None:
+            return cls.apply_profiled(neighborhood, rules)
+        for rule in rules:
+            if rule['condition'](neighborhood):
+                rule['action'](neighborhood)
+        return neighborhood.get('center', None)
+
+    @classmethod
+    def apply_profiled(cls, neighborhood, rules):
+        profiler = cls.profiler
+        center = neighborhood['center']
+        for rule in rules:
+            start = perf_counter()
+            result = rule['condition'](neighborhood)
+            condition_time = perf_counter() - start
+            if result:
+                before = center.pack()
+                start = perf_counter()
+                rule['action'](neighborhood)
+                action_time = perf_counter() - start
+                profiler.record(rule, condition_time, action_time,
+                                True, center.pack() != before)
+            else:
+                profiler.record(rule, condition_time, 0.0, False, False)
+        return center
+
+    @classmethod
+    def enable_profiling(cls):
+        """Starts recording per rule statistics, returns the profiler."""
+        if cls.profiler is None:
+            cls.profiler = RuleProfiler(cls.rules)
+        return cls.profiler
+
+    @classmethod
+    def disable_profiling(cls):
+        """Stops recording, returns the profiler with the collected statistics."""
+        profiler, cls.profiler = cls.profiler, None
+        return profiler
 
 
 # from collections import namedtuple
@@ -0,0 +1,53 @@
+"""
+This module holds the multi-rate schedule of the rules.
+Every rule belongs to a category, by the prefix of its name (the groups of
+TransitionRules.rules): WIND, CLOUDS, RAIN, AIR, TEMP, MANUAL (the user testing
+rules), and LAND for the land type rules. A category can be given an update
+period in days: its rules are only applied on the steps that are a multiple
+of the period (the first step applies every category). Categories without a
+period are applied every day.
+
+Example (land types change weekly, temperatures every other day):
+    Grid(rows, cols, update_periods={'LAND': 7, 'TEMP': 2})
+    python headless.py --periods LAND=7 TEMP=2
+"""
+import argparse
+
+CATEGORIES = ('WIND', 'CLOUDS', 'RAIN', 'AIR', 'TEMP', 'LAND', 'MANUAL')
+# Name prefixes of the categories, the other rules are LAND rules
+PREFIXES = (('MANUALLY', 'MANUAL'), ('WIND', 'WIND'), ('CLOUDS', 'CLOUDS'), ('RAIN', 'RAIN'),
+            ('AIR', 'AIR'), ('TEMP', 'TEMP'))
+
+
+def rule_category(rule):
+    name = rule['name'].upper()
+    for prefix, category in PREFIXES:
+        if name.startswith(prefix):
+            return category
+    return 'LAND'
+
+
+def validate_periods(periods):
+    for category, period in periods.items():
+        if category not in CATEGORIES:
+            raise ValueError(f"Unknown rule category {category}, expected one of {CATEGORIES}")
+        if not isinstance(period, int) or period < 1:
+            raise ValueError(f"The update period of {category} must be a positive number of days")
+    return periods
+
+
+def skipped_categories(periods, step):
+    """The categories not due on step (counted from 0)."""
+    return frozenset(category for category, period in periods.items()
+                     if period > 1 and step % period != 0)
+
+
+def parse_period(value):
+    """argparse type of CATEGORY=DAYS, returns (category, days)."""
+    category, _, days = value.partition('=')
+    try:
+        period = {category.upper(): int(days)}
+        validate_periods(period)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"invalid period {value}, expected CATEGORY=DAYS: {e}")
+    return category.upper(), int(days)
@@ -0,0 +1,435 @@
+"""
+This module holds the sharded simulation: a world split into bands of rows (shards),
+each owned by a worker process, which may run on another host.
+
+- Worker: serves a coordinator over TCP. It holds the states of its shard only, and
+    steps them with the fast engine (engines.FastEngine.step).
+- ShardedGrid: the coordinator. It sends the shards to the workers, and steps them
+    day by day. Before each day, every worker sends the rows its neighbors need (the
+    rows next to their shards, as given by the boundary mode) straight to them, then
+    steps its shard. The coordinator waits for every worker (a barrier) and gathers
+    the day's statistics as sums (grid.state_totals), never the states themselves.
+
+Each cell sees the same neighbors, in the same order, as in a single Grid, so the
+results are identical to a single-node run. The rules' enabled flags and the update
+periods (see scheduler.py) are sent with every day; rules replaced by other functions
+are not, the workers run the rules of their own rules.py.
+
+Messages are lines of JSON, the states are sent packed (State.pack).
+
+A worker that dies or stops answering does not block the run: the coordinator waits
+at most `timeout` seconds for each reply, and the workers half of it for the rows of
+their neighbors, then the run stops with a ShardError naming the shard.
+
+Example (4 workers on this host, checked against a single Grid):
+    python sharding.py run --local 4 --rows 64 --cols 64 --days 10 --check
+Workers on other hosts:
+    python sharding.py worker --host 0.0.0.0 --port 9100
+    python sharding.py run --workers host1:9100 host2:9100 --rows 2000 --cols 2000
+"""
+import argparse
+import json
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+from engines import FastEngine
+from grid import GridStatistics, Grid, merge_totals, state_totals, random_initial_conditions
+from rules import TransitionRules
+from scheduler import parse_period, skipped_categories, validate_periods
+from state import State
+from topology import DIRECTIONS, BOUNDARIES, NEIGHBOR_COUNT, _boundary_index
+
+
+DEFAULT_TIMEOUT = 120.0  # seconds the coordinator waits for a reply
+
+
+class ShardError(Exception):
+    """Raised by the coordinator when a worker failed."""
+
+
+def send(stream, message):
+    stream.write(json.dumps(message, separators=(',', ':')).encode('utf-8') + b'\n')
+    stream.flush()
+
+
+def receive(stream):
+    line = stream.readline()
+    if not line:
+        raise ConnectionError('connection closed')
+    return json.loads(line)
+
+
+def connect(address, timeout=None):
+    connection = socket.create_connection(address, timeout)
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection, connection.makefile('rwb')
+
+
+def shard_rows(rows, shards):
+    """(start, end) of the rows of each shard, as even as possible."""
+    return [(rows * shard // shards, rows * (shard + 1) // shards) for shard in range(shards)]
+
+
+def halo_rows(rows, start, end, boundary):
+    """The rows of other shards the cells of rows start..end - 1 have as neighbors."""
+    halo = []
+    for row in (start - 1, end):
+        row = _boundary_index(row, rows, boundary)
+        if row >= 0 and not start <= row < end and row not in halo:
+            halo.append(row)
+    return halo
+
+
+def shard_table(rows, cols, start, end, boundary):
+    """
+    The neighbor table of a shard's local states: its own rows, then its halo rows
+    (which have no neighbors, they are only read).
+    """
+    halo = halo_rows(rows, start, end, boundary)
+    local_rows = {row: row - start for row in range(start, end)}
+    local_rows.update((row, end - start + i) for i, row in enumerate(halo))
+    table = []
+    for row in range(start, end):
+        for col in range(cols):
+            for (d_row, d_col), _ in DIRECTIONS:
+                neighbor_row = _boundary_index(row + d_row, rows, boundary)
+                neighbor_col = _boundary_index(col + d_col, cols, boundary)
+                if neighbor_row < 0 or neighbor_col < 0:
+                    table.append(-1)
+                else:
+                    table.append(local_rows[neighbor_row] * cols + neighbor_col)
+    table.extend([-1] * (len(halo) * cols * NEIGHBOR_COUNT))
+    return tuple(table)
+
+
+class Worker:
+    """
+    Serves coordinators on (host, port) until shut down. Every connection is served by
+    its own thread: the coordinator's session, and the rows sent by the other workers.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = socket.create_server((host, port))
+        self.address = self.server.getsockname()[:2]
+        self.engine = FastEngine()
+        self.halos = queue.Queue()  # (day, shard, [(row, packed cells)]) from the other workers
+        self.running = True
+
+    def serve_forever(self, poll_interval=0.5):
+        self.server.settimeout(poll_interval)
+        while self.running:
+            try:
+                connection, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            connection.settimeout(None)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+        self.server.close()
+
+    def _serve(self, connection):
+        stream = connection.makefile('rwb')
+        try:
+            hello = receive(stream)
+            if hello['type'] == 'peer':
+                while True:
+                    message = receive(stream)
+                    self.halos.put((message['day'], message['shard'], message['rows']))
+            else:
+                self._session(stream)
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            stream.close()
+            connection.close()
+
+    def _session(self, stream):
+        peers = []
+        try:
+            while True:
+                message = receive(stream)
+                kind = message['type']
+                try:
+                    if kind == 'setup':
+                        peers = self._setup(stream, message)
+                        reply = {'type': 'ready', 'totals': state_totals(self.states)}
+                    elif kind == 'step':
+                        reply = self._step(message, peers)
+                    elif kind == 'gather':
+                        reply = {'type': 'states', 'start': self.start,
+                                 'states': [state.pack() for state in self.states]}
+                    elif kind == 'close':
+                        self.running = not message.get('shutdown', False)
+                        return
+                    else:
+                        raise ValueError(f'Unknown message {kind}')
+                except Exception as e:
+                    reply = {'type': 'error', 'message': f'{type(e).__name__}: {e}'}
+                send(stream, reply)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            for connection, peer_stream, _ in peers:
+                peer_stream.close()
+                connection.close()
+
+    def _setup(self, stream, message):
+        self.rows, self.cols = message['rows'], message['cols']
+        self.start, self.end = message['start'], message['end']
+        self.table = shard_table(self.rows, self.cols, self.start, self.end, message['boundary'])
+        self.halo = halo_rows(self.rows, self.start, self.end, message['boundary'])
+        self.shard = message['shard']
+        self.producers = set(message['producers'])  # the shards sending rows to this one
+        self.timeout = message['timeout']
+        self.pending = {}  # day -> halo messages received early
+        self.halos = queue.Queue()
+        self.states = []
+        for _ in range(self.start, self.end):
+            row = receive(stream)
+            self.states.extend(State.unpack(packed) for packed in row['cells'])
+        # the workers this shard sends rows to, and the rows they need
+        peers = []
+        for address, rows in message['sends']:
+            connection, peer_stream = connect(tuple(address))
+            send(peer_stream, {'type': 'peer'})
+            peers.append((connection, peer_stream, rows))
+        return peers
+
+    def _step(self, message, peers):
+        day = message['day']
+        cols, start = self.cols, self.start
+        for _, peer_stream, rows in peers:
+            send(peer_stream, {'type': 'halo', 'day': day, 'shard': self.shard, 'rows': [
+                (row, [state.pack() for state in self.states[(row - start) * cols:(row - start + 1) * cols]])
+                for row in rows]})
+        # wait for the rows of every neighbor shard
+        received = self.pending.pop(day, {})
+        while len(received) < len(self.producers):
+            try:
+                halo_day, shard, rows = self.halos.get(timeout=self.timeout)
+            except queue.Empty:
+                missing = ', '.join(str(shard) for shard in sorted(self.producers - set(received)))
+                raise ShardError(f'no rows from shard {missing} for day {day} '
+                                 f'after {self.timeout:g} s') from None
+            if halo_day != day:
+                self.pending.setdefault(halo_day, {})[shard] = rows
+            else:
+                received[shard] = rows
+        halo = {row: cells for rows in received.values() for row, cells in rows}
+        states = list(self.states)
+        for row in self.halo:
+            states.extend(State.unpack(packed) for packed in halo[row])
+        # the coordinator's enabled flags, the rules' own flags are left alone
+        new_states = self.engine.step(states, self.table, frozenset(message['skip']),
+                                      mask=tuple(message['enabled']))
+        new_states = new_states[:len(self.states)]
+        changed = sum(new.pack() != old.pack() for new, old in zip(new_states, self.states))
+        self.states = new_states
+        return {'type': 'stepped', 'totals': state_totals(new_states), 'changed': changed}
+
+
+class ShardedGrid(GridStatistics):
+    """
+    A rows x cols world sharded over workers (a list of (host, port)), stepped like a Grid.
+    row_states(row) returns the initial states of a row. Only the statistics are kept here,
+    states() gathers the states of the whole world. A worker not replying within timeout
+    seconds raises a ShardError (timeout None waits for the workers without a limit).
+    """
+
+    def __init__(self, rows, cols, workers, row_states, boundary='clamp', update_periods=None,
+                 timeout=DEFAULT_TIMEOUT):
+        if boundary not in BOUNDARIES:
+            raise ValueError(f"Unknown boundary {boundary}, expected one of {BOUNDARIES}")
+        self.rows = rows
+        self.cols = cols
+        self.boundary = boundary
+        self.update_periods = validate_periods(dict(update_periods or {}))
+        self.shards = shard_rows(rows, len(workers))
+        self.timeout = timeout
+        self.connections = []
+        for shard, address in enumerate(workers):
+            try:
+                self.connections.append(connect(tuple(address), timeout))
+            except OSError as e:
+                self.close()
+                raise ShardError(f'shard {shard}: cannot connect to {address[0]}:{address[1]}: {e}') from e
+        self.changed = None  # number of cells changed by the last day
+        self.rule_mask = None  # own enabled flags of the rules, as Grid.rule_mask
+        self.reset_statistics()
+        self.days = 1
+
+        # The worker owning each row, and the rows each worker needs from the others
+        owners = {row: shard for shard, (start, end) in enumerate(self.shards)
+                  for row in range(start, end)}
+        needs = [halo_rows(rows, start, end, boundary) for start, end in self.shards]
+        for shard, ((start, end), (_, stream)) in enumerate(zip(self.shards, self.connections)):
+            sends = []
+            for consumer, rows_needed in enumerate(needs):
+                mine = [row for row in rows_needed if owners[row] == shard]
+                if mine:
+                    sends.append((workers[consumer], mine))
+            producers = sorted({owners[row] for row in needs[shard]})
+            send(stream, {'type': 'coordinator'})
+            send(stream, {'type': 'setup', 'rows': rows, 'cols': cols, 'start': start, 'end': end,
+                          'boundary': boundary, 'sends': sends, 'shard': shard,
+                          'producers': producers,
+                          'timeout': None if timeout is None else timeout / 2})
+            for row in range(start, end):
+                send(stream, {'type': 'row', 'cells': [state.pack() for state in row_states(row)]})
+        self.record_statistics(merge_totals(reply['totals'] for reply in self._replies('ready')))
+
+    def _replies(self, expected):
+        replies = []
+        errors = []
+        for shard, (_, stream) in enumerate(self.connections):
+            try:
+                reply = receive(stream)
+            except socket.timeout:
+                errors.append(f'shard {shard}: no reply after {self.timeout:g} s')
+                continue
+            except (ConnectionError, OSError, ValueError) as e:
+                errors.append(f'shard {shard}: {e}')
+                continue
+            if reply['type'] == 'error':
+                errors.append(f"shard {shard}: {reply['message']}")
+            elif reply['type'] != expected:
+                errors.append(f"shard {shard}: unexpected reply {reply['type']}")
+            replies.append(reply)
+        if errors:
+            raise ShardError('; '.join(errors))
+        return replies
+
+    def skipped_categories(self):
+        """The rule categories not updated on the coming day."""
+        return skipped_categories(self.update_periods, self.days - 1)
+
+    def next_day(self):
+        message = {'type': 'step', 'day': self.days, 'skip': sorted(self.skipped_categories()),
+                   'enabled': TransitionRules.enabled_flags(self.rule_mask)}
+        for _, stream in self.connections:
+            send(stream, message)
+        replies = self._replies('stepped')
+        self.changed = sum(reply['changed'] for reply in replies)
+        self.days = self.days + 1
+        self.record_statistics(merge_totals(reply['totals'] for reply in replies))
+
+    def states(self):
+        """The states of every cell (row major), gathered from the workers."""
+        for _, stream in self.connections:
+            send(stream, {'type': 'gather'})
+        states = []
+        for reply in self._replies('states'):
+            states.extend(State.unpack(packed) for packed in reply['states'])
+        return states
+
+    def close(self, shutdown=False):
+        """Ends the sessions, and stops the workers with shutdown=True."""
+        for connection, stream in self.connections:
+            try:
+                send(stream, {'type': 'close', 'shutdown': shutdown})
+                stream.close()
+            except OSError:
+                pass
+            connection.close()
+        self.connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def spawn_local_workers(count):
+    """Starts count worker processes on this host, returns them and their addresses."""
+    processes, addresses = [], []
+    here = os.path.dirname(os.path.abspath(__file__))
+    for _ in range(count):
+        process = subprocess.Popen([sys.executable, os.path.join(here, 'sharding.py'), 'worker'],
+                                   stdout=subprocess.PIPE, text=True, cwd=here)
+        # the worker prints its address once it listens
+        host, port = process.stdout.readline().split()[-1].rsplit(':', 1)
+        processes.append(process)
+        addresses.append((host, int(port)))
+    return processes, addresses
+
+
+def parse_address(value):
+    host, _, port = value.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def run(args):
+    if args.local:
+        processes, workers = spawn_local_workers(args.local)
+    else:
+        processes, workers = [], args.workers
+    periods = dict(args.periods)
+    conditions = random_initial_conditions(args.rows, args.cols, args.seed)
+    states = [condition['cell'].state for condition in conditions]
+    reference = None
+    if args.check:
+        reference = Grid(args.rows, args.cols, boundary=args.boundary, update_periods=periods)
+        reference.apply_initial_conditions_csv(
+            initial_conditions=random_initial_conditions(args.rows, args.cols, args.seed))
+    failures = 0
+    world = ShardedGrid(args.rows, args.cols, workers,
+                        lambda row: states[row * args.cols:(row + 1) * args.cols],
+                        boundary=args.boundary, update_periods=periods, timeout=args.timeout)
+    try:
+        for _ in range(args.days):
+            world.next_day()
+            print(f'day {world.days - 1}: {world.changed} cells changed, '
+                  f'{world.get_average_temperature().splitlines()[0]}')
+            if reference is not None:
+                reference.next_day()
+                same = [state.pack() for state in world.states()] == \
+                    [cell.state.pack() for cell in reference.cells]
+                same = same and reference.statistics['temperature'][-1] == world.statistics['temperature'][-1]
+                if not same:
+                    failures += 1
+                    print(f'day {world.days - 1}: differs from the single-node run')
+    finally:
+        world.close(shutdown=bool(processes))
+        for process in processes:
+            process.wait()
+    if reference is not None:
+        print(f'{args.days - failures}/{args.days} days match the single-node run')
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sharded simulation over TCP')
+    commands = parser.add_subparsers(dest='command', required=True)
+    worker = commands.add_parser('worker', help='serve a shard')
+    worker.add_argument('--host', default='127.0.0.1')
+    worker.add_argument('--port', type=int, default=0, help='0 for any free port')
+    coordinator = commands.add_parser('run', help='run a sharded random world')
+    where = coordinator.add_mutually_exclusive_group(required=True)
+    where.add_argument('--workers', nargs='+', type=parse_address, metavar='HOST:PORT')
+    where.add_argument('--local', type=int, help='start this many workers on this host')
+    coordinator.add_argument('--rows', type=int, default=64)
+    coordinator.add_argument('--cols', type=int, default=64)
+    coordinator.add_argument('--days', type=int, default=10)
+    coordinator.add_argument('--seed', type=int, default=0)
+    coordinator.add_argument('--boundary', choices=BOUNDARIES, default='clamp')
+    coordinator.add_argument('--periods', nargs='*', type=parse_period, default=[],
+                             metavar='CATEGORY=DAYS')
+    coordinator.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                             help='seconds to wait for a worker before stopping the run')
+    coordinator.add_argument('--check', action='store_true',
+                             help='compare every day with a single Grid')
+    args = parser.parse_args(argv)
+    if args.command == 'worker':
+        server = Worker(args.host, args.port)
+        print(f'listening on {server.address[0]}:{server.address[1]}', flush=True)
+        server.serve_forever()
+        return 0
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
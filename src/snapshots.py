@@ -0,0 +1,184 @@
+"""
+This module holds the snapshots of a world's day, and their export files.
+
+A Snapshot is the list of the cells' State objects of one day. Taking it only copies
+the list: the grid never changes a State in place (commit_states puts new State
+objects in the cells), so the snapshot keeps the states of its day while the
+simulation goes on (copy-on-write).
+
+BackgroundWriter writes snapshots on a worker thread, so exporting never blocks the
+simulation or the render loop; Autosave submits a snapshot every N days. Files are
+written to a temporary file first and then renamed, so a file is always complete.
+
+Formats:
+- csv: the columns of Grid.export_state_to_csv
+- binary: a header (MAGIC, version, rows, cols, day) followed by the packed states
+    (State.pack), one byte per attribute, row major. read_binary reads it back.
+"""
+import csv
+import os
+import queue
+import struct
+import sys
+import threading
+from state import State, STATE_FIELDS
+
+FORMATS = ('csv', 'binary')
+EXTENSIONS = {'csv': 'csv', 'binary': 'bin'}
+MAGIC = b'SIMEARTH'
+VERSION = 1
+HEADER = struct.Struct('<8sHIII')  # magic, version, rows, cols, day
+
+
+class Snapshot:
+    """The states (row major) of a rows x cols world on a day."""
+
+    def __init__(self, rows, cols, day, states):
+        self.rows = rows
+        self.cols = cols
+        self.day = day
+        self.states = states
+
+
+def write_csv(snapshot, file_path):
+    with open(file_path, 'w', newline='') as csvfile:
+        fieldnames = ['x', 'y', 'land_type', 'temperature',
+                      'wind_speed', 'rainfall', 'air_pollution']
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        states = iter(snapshot.states)
+        for x in range(snapshot.rows):
+            for y in range(snapshot.cols):
+                state = next(states)
+                writer.writerow({
+                    'x': x, 'y': y,
+                    'land_type': state.land_type.name,
+                    'temperature': state.temperature.value,
+                    'wind_speed': state.wind_speed.name,
+                    'rainfall': state.rainfall.value,
+                    'air_pollution': state.air_pollution.value
+                })
+
+
+def write_binary(snapshot, file_path):
+    with open(file_path, 'wb') as binary_file:
+        binary_file.write(HEADER.pack(MAGIC, VERSION, snapshot.rows, snapshot.cols, snapshot.day))
+        binary_file.write(bytes(value for state in snapshot.states for value in state.pack()))
+
+
+def read_binary(file_path):
+    """The Snapshot of a file written by write_binary."""
+    with open(file_path, 'rb') as binary_file:
+        magic, version, rows, cols, day = HEADER.unpack(binary_file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{file_path} is not a snapshot file of version {VERSION}')
+        data = binary_file.read()
+    size = len(STATE_FIELDS)
+    if len(data) != rows * cols * size:
+        raise ValueError(f'{file_path} is truncated')
+    states = [State.unpack(data[i:i + size]) for i in range(0, len(data), size)]
+    return Snapshot(rows, cols, day, states)
+
+
+def write_snapshot(snapshot, file_path, file_format='csv'):
+    """Writes the snapshot in file_format, replacing file_path only once the file is complete."""
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown export format {file_format}, expected one of {FORMATS}")
+    temporary_path = f'{file_path}.tmp'
+    if file_format == 'csv':
+        write_csv(snapshot, temporary_path)
+    else:
+        write_binary(snapshot, temporary_path)
+    os.replace(temporary_path, file_path)
+
+
+class BackgroundWriter:
+    """
+    Writes snapshots on a worker thread. submit() never blocks: when max_pending
+    snapshots are already waiting, the new one is dropped (and counted in dropped).
+    The errors of the writes are kept in errors, (file path, exception).
+    The thread is started on the first submit(); where threads are not available
+    (the web build), the snapshots are written by submit() itself.
+    """
+
+    def __init__(self, max_pending=4):
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.written = []  # the paths written, in order
+        self.errors = []
+        self.dropped = 0
+        self.thread = None
+        self.synchronous = sys.platform == 'emscripten'
+
+    def _start(self):
+        thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+        try:
+            thread.start()
+        except RuntimeError:
+            self.synchronous = True  # can't start threads here
+            return
+        self.thread = thread
+
+    def submit(self, snapshot, file_path, file_format='csv'):
+        """Queues the snapshot to be written, returns False if it was dropped."""
+        if self.thread is None and not self.synchronous:
+            self._start()
+        if self.synchronous:
+            self._write(snapshot, file_path, file_format)
+            return True
+        try:
+            self.pending.put_nowait((snapshot, file_path, file_format))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _run(self):
+        while True:
+            job = self.pending.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            finally:
+                self.pending.task_done()
+
+    def _write(self, snapshot, file_path, file_format):
+        try:
+            write_snapshot(snapshot, file_path, file_format)
+            self.written.append(file_path)
+        except Exception as e:
+            self.errors.append((file_path, e))
+
+    def flush(self):
+        """Waits until every submitted snapshot is written."""
+        self.pending.join()
+
+    def close(self):
+        """Writes the pending snapshots and stops the thread."""
+        if self.thread is None:
+            return
+        self.pending.put(None)
+        self.thread.join()
+        self.thread = None
+
+
+class Autosave:
+    """Submits a snapshot of the world to writer every `every` days, into directory."""
+
+    def __init__(self, writer, every, directory='autosave', file_format='csv'):
+        if every < 1:
+            raise ValueError('The autosave period must be a positive number of days')
+        self.writer = writer
+        self.every = every
+        self.directory = directory
+        self.file_format = file_format
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, day):
+        return os.path.join(self.directory, f'day_{day:06d}.{EXTENSIONS[self.file_format]}')
+
+    def maybe_save(self, world):
+        """Called after every day, saves the day if it is due."""
+        if (world.days - 1) % self.every == 0:
+            snapshot = world.snapshot()
+            self.writer.submit(snapshot, self.path(snapshot.day), self.file_format)
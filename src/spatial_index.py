@@ -0,0 +1,116 @@
+"""
+This module holds the spatial index of a world: the cells (flat indices, row * cols + col)
+of each land type, and of each temperature and / or pollution level per land type.
+
+The Grid keeps its index up to date as it commits the states of a day, moving only the
+changed cells between the sets, so a query never scans the grid: e.g. the CITY cells
+with a pollution of HEAVY or worse are the union of the (CITY, HEAVY), (CITY, DEADLY)
+and (CITY, MAX) sets, in time proportional to the answer.
+
+Example:
+    world.index.count(Landscape.CITY)
+    world.index.cells(Landscape.CITY, min_pollution=AirQuality.HEAVY)
+    world.index.hottest_cells(Landscape.ICE)
+"""
+from state import Landscape, Temperature, AirQuality
+
+
+class SpatialIndex:
+    """The cells of a world by land type, and by temperature / pollution per land type."""
+
+    def __init__(self, states=()):
+        self.rebuild(states)
+
+    def rebuild(self, states):
+        """Indexes the states (row major) of a whole world."""
+        self.land = {land_type: set() for land_type in Landscape}
+        self.temperature = {(land_type, temperature): set()
+                            for land_type in Landscape for temperature in Temperature}
+        self.pollution = {(land_type, pollution): set()
+                          for land_type in Landscape for pollution in AirQuality}
+        self.both = {(land_type, temperature, pollution): set() for land_type in Landscape
+                     for temperature in Temperature for pollution in AirQuality}
+        for index, state in enumerate(states):
+            self.add(index, state)
+
+    def copy(self):
+        """An index of the same cells, changed independently from this one."""
+        index = SpatialIndex.__new__(SpatialIndex)
+        index.land = {key: set(cells) for key, cells in self.land.items()}
+        index.temperature = {key: set(cells) for key, cells in self.temperature.items()}
+        index.pollution = {key: set(cells) for key, cells in self.pollution.items()}
+        index.both = {key: set(cells) for key, cells in self.both.items()}
+        return index
+
+    def add(self, index, state):
+        land_type = state.land_type
+        self.land[land_type].add(index)
+        self.temperature[(land_type, state.temperature)].add(index)
+        self.pollution[(land_type, state.air_pollution)].add(index)
+        self.both[(land_type, state.temperature, state.air_pollution)].add(index)
+
+    def remove(self, index, state):
+        land_type = state.land_type
+        self.land[land_type].discard(index)
+        self.temperature[(land_type, state.temperature)].discard(index)
+        self.pollution[(land_type, state.air_pollution)].discard(index)
+        self.both[(land_type, state.temperature, state.air_pollution)].discard(index)
+
+    def move(self, index, old_state, new_state):
+        """Called when the state of the cell index changes from old_state to new_state."""
+        if old_state.land_type == new_state.land_type \
+                and old_state.temperature == new_state.temperature \
+                and old_state.air_pollution == new_state.air_pollution:
+            return  # e.g. only the wind changed
+        self.remove(index, old_state)
+        self.add(index, new_state)
+
+    def count(self, land_type):
+        return len(self.land[land_type])
+
+    def counts(self):
+        """land type -> number of cells."""
+        return {land_type: len(cells) for land_type, cells in self.land.items()}
+
+    @staticmethod
+    def _levels(enum, minimum, maximum):
+        return [level for level in enum
+                if (minimum is None or level >= minimum) and (maximum is None or level <= maximum)]
+
+    @staticmethod
+    def _union(buckets, keys):
+        cells = set()
+        for key in keys:
+            cells |= buckets[key]
+        return cells
+
+    def cells(self, land_type=None, min_temperature=None, max_temperature=None,
+              min_pollution=None, max_pollution=None):
+        """
+        The set of the cells of land_type (any when None) in the temperature and
+        pollution ranges (inclusive, open when None).
+        """
+        land_types = list(Landscape) if land_type is None else [land_type]
+        by_temperature = min_temperature is not None or max_temperature is not None
+        by_pollution = min_pollution is not None or max_pollution is not None
+        if not by_temperature and not by_pollution:
+            return set().union(*(self.land[land_type] for land_type in land_types))
+        temperatures = self._levels(Temperature, min_temperature, max_temperature)
+        pollutions = self._levels(AirQuality, min_pollution, max_pollution)
+        if not by_pollution:
+            return self._union(self.temperature, [(land, temperature) for land in land_types
+                                                  for temperature in temperatures])
+        if not by_temperature:
+            return self._union(self.pollution, [(land, pollution) for land in land_types
+                                                for pollution in pollutions])
+        return self._union(self.both, [(land, temperature, pollution) for land in land_types
+                                       for temperature in temperatures for pollution in pollutions])
+
+    def hottest_cells(self, land_type=None):
+        """(temperature, cells) of the highest temperature reached (on land_type), (None, set()) if none."""
+        land_types = list(Landscape) if land_type is None else [land_type]
+        for temperature in sorted(Temperature, key=lambda level: level.value, reverse=True):
+            cells = self._union(self.temperature, [(land, temperature) for land in land_types])
+            if cells:
+                return temperature, cells
+        return None, set()
@@ -4,6 +4,17 @@ This module contains the State class and the enums used to define the state spac
 
 from enum import Enum
 
+# (min value, max value) of each enum class, for the arithmetic operators
+_bounds = {}
+
+
+def _value_bounds(enum_class):
+    bounds = _bounds.get(enum_class)
+    if bounds is None:
+        values = [member.value for member in enum_class]
+        bounds = _bounds[enum_class] = (min(values), max(values))
+    return bounds
+
 
 class ComparableEnum(Enum):
     """
@@ -12,35 +23,35 @@ class ComparableEnum(Enum):
 
     def __lt__(self, other):
         if self.__class__ is other.__class__:
-            return self.value < other.value
+            return self._value_ < other._value_
         return NotImplemented
 
     def __le__(self, other):
         if self.__class__ is other.__class__:
-            return self.value <= other.value
+            return self._value_ <= other._value_
         return NotImplemented
 
     def __gt__(self, other):
         if self.__class__ is other.__class__:
-            return self.value > other.value
+            return self._value_ > other._value_
         return NotImplemented
 
     def __ge__(self, other):
         if self.__class__ is other.__class__:
-            return self.value >= other.value
+            return self._value_ >= other._value_
         return NotImplemented
 
     def __add__(self, other):
         if self.__class__ is other.__class__:
-            new_value = self.value + other.value
-            max_value = max(member.value for member in self.__class__)
+            new_value = self._value_ + other._value_
+            max_value = _value_bounds(self.__class__)[1]
             return self.__class__(min(new_value, max_value))
         return NotImplemented
 
     def __sub__(self, other):
         if self.__class__ is other.__class__:
-            new_value = self.value - other.value
-            min_value = min(member.value for member in self.__class__)
+            new_value = self._value_ - other._value_
+            min_value = _value_bounds(self.__class__)[0]
             return self.__class__(max(new_value, min_value))
         return NotImplemented
 
@@ -50,7 +61,7 @@ class ComparableEnum(Enum):
     def __mul__(self, other):
         if self.__class__ is other.__class__:
             new_value = self.value * other.value
-            max_value = max(member.value for member in self.__class__)
+            max_value = _value_bounds(self.__class__)[1]
             return self.__class__(min(new_value, max_value))
         return NotImplemented
 
@@ -58,8 +69,7 @@ class ComparableEnum(Enum):
         if self.__class__ is other.__class__:
             if other.value != 0:
                 new_value = self.value / other.value
-                min_value = min(member.value for member in self.__class__)
-                max_value = max(member.value for member in self.__class__)
+                min_value, max_value = _value_bounds(self.__class__)
                 return self.__class__(max(min(new_value, max_value), min_value))
         return NotImplemented
 
@@ -67,8 +77,7 @@ class ComparableEnum(Enum):
         if self.__class__ is other.__class__:
             if other.value != 0:
                 new_value = self.value // other.value
-                min_value = min(member.value for member in self.__class__)
-                max_value = max(member.value for member in self.__class__)
+                min_value, max_value = _value_bounds(self.__class__)
                 return self.__class__(max(min(new_value, max_value), min_value))
         return NotImplemented
 
@@ -82,8 +91,7 @@ class ComparableEnum(Enum):
     def __pow__(self, power, modulo=None):
         if self.__class__ is power.__class__:
             new_value = pow(self.value, power.value, modulo)
-            min_value = min(member.value for member in self.__class__)
-            max_value = max(member.value for member in self.__class__)
+            min_value, max_value = _value_bounds(self.__class__)
             return self.__class__(max(min(new_value, max_value), min_value))
         return NotImplemented
 
@@ -183,6 +191,11 @@ class Temperature(ComparableEnum):
     MAX_PLUS_PLUS_PLUS = 14
 
 
+# The State attributes, in the order of State.pack()
+STATE_FIELDS = ('land_type', 'temperature', 'wind_speed', 'wind_direction',
+                'rainfall', 'clouds', 'air_pollution')
+
+
 class State:
     """
     State class to hold various attributes of a cell.
@@ -217,6 +230,29 @@ class State:
                 f"Rainfall: {self.rainfall}, Clouds: {'Yes' if self.clouds else 'No'}, "
                 f"Pollution: {self.air_pollution})")
 
+    def copy(self):
+        """A shallow copy, enough since all the attributes are immutable."""
+        state = State.__new__(State)
+        state.__dict__.update(self.__dict__)
+        return state
+
+    def pack(self):
+        """
+        Returns the state as a tuple of plain ints (the enums values),
+        which is cheap to compare, hash and store.
+        """
+        return (self.land_type.value, self.temperature.value, self.wind_speed.value,
+                self.wind_direction.value, self.rainfall.value, int(self.clouds),
+                self.air_pollution.value)
+
+    @classmethod
+    def unpack(cls, packed):
+        """The State of a tuple returned by pack."""
+        land_type, temperature, wind_speed, wind_direction, rainfall, clouds, air_pollution = packed
+        return cls(Landscape(land_type), Temperature(temperature), WindSpeed(wind_speed),
+                   WindDirection(wind_direction), Rain(rainfall), bool(clouds),
+                   AirQuality(air_pollution))
+
     def get_state_color(self):
         base_colors = {
             Landscape.SEA: (0, 0, 255),
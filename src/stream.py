@@ -0,0 +1,315 @@
+"""
+This module holds the simulation server: one world stepped by an asyncio server, its
+days streamed to any number of viewers over TCP, and the client the viewers use.
+
+On connecting, a viewer gets a hello (MAGIC, VERSION, rows, cols), then one message
+per day: a header (kind, day, number of cells, the 4 daily averages) followed by
+- a keyframe: the packed states (State.pack, one byte per attribute) of every cell
+- a delta: the flat indices (uint32) of the cells the day changed, then their packed states
+A viewer gets a keyframe first, and deltas after it. Each viewer has its own queue of
+messages: when a viewer is too slow and its queue is full, its pending days are
+dropped and it gets the current day as a keyframe, so a slow viewer never holds up
+the simulation or the other viewers.
+
+Example (a server on localhost, a text viewer and the GUI as a viewer):
+    python stream.py serve --rows 64 --cols 64 --conditions "" --port 9200 --interval 0.1
+    python stream.py watch 127.0.0.1:9200
+    python main.py --connect 127.0.0.1:9200
+"""
+import argparse
+import array
+import asyncio
+import queue
+import socket
+import struct
+import sys
+import threading
+from engines import ENGINES, DEFAULT_ENGINE
+from grid import Grid, random_initial_conditions
+from history import STATE_SIZE, pack_states
+from sharding import parse_address
+from state import State
+
+MAGIC = b'SIMSTRM1'
+VERSION = 1
+HELLO = struct.Struct('<8sHII')  # magic, version, rows, cols
+# kind, day, number of cells, average temperature, wind speed, rainfall and pollution
+HEADER = struct.Struct('<BIIdddd')
+KEYFRAME = 0
+DELTA = 1
+
+
+def encode_header(world, kind, count):
+    return HEADER.pack(kind, world.days - 1, count, world.avg_temperature, world.avg_wind_speed,
+                       world.avg_rainfall, world.avg_pollution)
+
+
+def encode_keyframe(world):
+    cells = world.cells
+    return encode_header(world, KEYFRAME, len(cells)) + pack_states(cell.state for cell in cells)
+
+
+def encode_delta(world):
+    """The message of the world's last day, None if the whole world changed."""
+    changed = world.changed_cells
+    if changed is None:
+        return None
+    indices = array.array('I', changed)
+    if sys.byteorder == 'big':
+        indices.byteswap()
+    cells = world.cells
+    return encode_header(world, DELTA, len(changed)) + indices.tobytes() + \
+        pack_states(cells[index].state for index in changed)
+
+
+class Viewer:
+    """A connected viewer, with its queue of messages to send."""
+
+    def __init__(self, writer, queue_size):
+        self.writer = writer
+        self.queue = asyncio.Queue(queue_size)
+        self.needs_keyframe = True
+        self.keyframes = 0  # keyframes sent because the viewer was too slow
+        self.dropped = 0  # days dropped because the viewer was too slow
+
+
+class SimulationServer:
+    """
+    Steps world every interval seconds and streams its days to the viewers
+    connected to host:port (port 0 for any free port, see address after start()).
+    """
+
+    def __init__(self, world, host='127.0.0.1', port=0, interval=0.0, queue_size=8):
+        self.world = world
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.queue_size = queue_size
+        self.viewers = set()
+        self.server = None
+        self.address = None
+        self.stepping = False
+        self.keyframe = (None, None)  # (day, message) of the last keyframe encoded
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._connected, self.host, self.port)
+        self.address = self.server.sockets[0].getsockname()[:2]
+
+    def _keyframe(self):
+        day = self.world.days - 1
+        if self.keyframe[0] != day:
+            self.keyframe = (day, encode_keyframe(self.world))
+        return self.keyframe[1]
+
+    def _queue_keyframe(self, viewer):
+        # a keyframe replaces whatever the viewer had pending
+        while not viewer.queue.empty():
+            viewer.queue.get_nowait()
+            viewer.queue.task_done()
+            viewer.dropped += 1
+        viewer.queue.put_nowait(self._keyframe())
+        viewer.needs_keyframe = False
+
+    async def _connected(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        writer.write(HELLO.pack(MAGIC, VERSION, self.world.rows, self.world.cols))
+        viewer = Viewer(writer, self.queue_size)
+        self.viewers.add(viewer)
+        if not self.stepping:
+            self._queue_keyframe(viewer)  # else it gets one with the coming day
+        try:
+            while True:
+                message = await viewer.queue.get()
+                writer.write(message)
+                await writer.drain()
+                viewer.queue.task_done()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.viewers.discard(viewer)
+            while not viewer.queue.empty():
+                viewer.queue.get_nowait()
+                viewer.queue.task_done()
+            writer.close()
+
+    def broadcast(self):
+        """Queues the world's current day to every viewer."""
+        delta = encode_delta(self.world)
+        for viewer in list(self.viewers):
+            if viewer.needs_keyframe or delta is None:
+                self._queue_keyframe(viewer)
+            elif viewer.queue.full():
+                # too slow: the pending days are dropped for the current day's keyframe
+                viewer.keyframes += 1
+                self._queue_keyframe(viewer)
+            else:
+                viewer.queue.put_nowait(delta)
+
+    async def run(self, days=None):
+        """Steps days days (forever when None), broadcasting each."""
+        loop = asyncio.get_running_loop()
+        day = 0
+        while days is None or day < days:
+            # stepped in a thread, the viewers are served meanwhile
+            self.stepping = True
+            await loop.run_in_executor(None, self.world.next_day)
+            self.stepping = False
+            self.broadcast()
+            day += 1
+            await asyncio.sleep(self.interval)
+
+    async def flush(self):
+        """Waits until every viewer got its messages."""
+        for viewer in list(self.viewers):
+            await viewer.queue.join()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise ConnectionError('connection closed')
+    return data
+
+
+def read_message(stream):
+    """The next message of a stream, a dictionary (see the module docstring)."""
+    kind, day, count, *averages = HEADER.unpack(_read_exactly(stream, HEADER.size))
+    indices = None
+    if kind == DELTA:
+        indices = array.array('I')
+        indices.frombytes(_read_exactly(stream, indices.itemsize * count))
+        if sys.byteorder == 'big':
+            indices.byteswap()
+    packed = _read_exactly(stream, STATE_SIZE * count)
+    return {'kind': kind, 'day': day, 'averages': tuple(averages), 'indices': indices, 'packed': packed}
+
+
+class StreamClient:
+    """
+    Connects to a SimulationServer, and reads its messages on a thread.
+    poll() returns the messages received since the last call.
+    """
+
+    def __init__(self, address):
+        self.connection = socket.create_connection(address)
+        self.stream = self.connection.makefile('rb')
+        magic, version, self.rows, self.cols = HELLO.unpack(_read_exactly(self.stream, HELLO.size))
+        if magic != MAGIC or version != VERSION:
+            raise ConnectionError(f'{address} is not a simulation server of version {VERSION}')
+        self.messages = queue.Queue()
+        self.closed = False
+        self.states = {}  # packed state -> the shared State
+        self.thread = threading.Thread(target=self._read, name='stream-client', daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        try:
+            while True:
+                self.messages.put(read_message(self.stream))
+        except (ConnectionError, OSError, ValueError):
+            self.closed = True
+
+    def poll(self):
+        messages = []
+        while True:
+            try:
+                messages.append(self.messages.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def apply(self, world, message):
+        """Sets a message's day on world, a rows x cols Grid only updated by the stream."""
+        packed = message['packed']
+        shared = self.states
+        states = [cell.state for cell in world.cells]
+        indices = message['indices'] if message['kind'] == DELTA else range(len(states))
+        for i, index in enumerate(indices):
+            key = packed[i * STATE_SIZE:(i + 1) * STATE_SIZE]
+            state = shared.get(key)
+            if state is None:
+                state = shared[key] = State.unpack(key)
+            states[index] = state
+        world.commit_states(states)
+        world.days = message['day'] + 1
+        world.calculate_statistics()
+
+    def close(self):
+        self.closed = True
+        self.connection.close()
+
+
+async def serve(args):
+    world = Grid(args.rows, args.cols, engine=args.engine)
+    if args.conditions:
+        world.apply_initial_conditions_csv(args.conditions)
+    else:
+        world.apply_initial_conditions_csv(
+            initial_conditions=random_initial_conditions(args.rows, args.cols, args.seed))
+    server = SimulationServer(world, args.host, args.port, args.interval, args.queue)
+    await server.start()
+    print(f'listening on {server.address[0]}:{server.address[1]}', flush=True)
+    if args.wait:
+        while len(server.viewers) < args.wait:
+            await asyncio.sleep(0.01)
+    await server.run(args.days)
+    await server.flush()
+    await server.close()
+    for viewer in server.viewers:
+        print(f'viewer: {viewer.keyframes} catch-up keyframes, {viewer.dropped} days dropped')
+
+
+def watch(args):
+    client = StreamClient(args.address)
+    world = Grid(client.rows, client.cols)
+    received = 0
+    while not (client.closed and client.messages.empty()):
+        try:
+            message = client.messages.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        client.apply(world, message)
+        received += 1
+        kind = 'keyframe' if message['kind'] == KEYFRAME else 'delta'
+        print(f"day {message['day']}: {kind}, {len(message['packed']) // STATE_SIZE} cells, "
+              f"avg. temp {message['averages'][0]:.2f}", flush=True)
+        if args.days and received >= args.days:
+            break
+    client.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stream a simulation to viewers over TCP')
+    commands = parser.add_subparsers(dest='command', required=True)
+    server = commands.add_parser('serve', help='step a world and stream it')
+    server.add_argument('--host', default='127.0.0.1')
+    server.add_argument('--port', type=int, default=9200, help='0 for any free port')
+    server.add_argument('--rows', type=int, default=6)
+    server.add_argument('--cols', type=int, default=6)
+    server.add_argument('--conditions', default='enums.csv',
+                        help='initial conditions csv file (empty for a random world)')
+    server.add_argument('--seed', type=int, default=0)
+    server.add_argument('--engine', choices=sorted(ENGINES), default=DEFAULT_ENGINE)
+    server.add_argument('--days', type=int, help='days to run, forever by default')
+    server.add_argument('--interval', type=float, default=0.0, help='seconds between days')
+    server.add_argument('--queue', type=int, default=8,
+                        help='days queued per viewer before it is sent a keyframe instead')
+    server.add_argument('--wait', type=int, default=0, help='wait for this many viewers to start')
+    viewer = commands.add_parser('watch', help='print the days of a server')
+    viewer.add_argument('address', type=parse_address, metavar='HOST:PORT')
+    viewer.add_argument('--days', type=int, help='stop after this many days')
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        asyncio.run(serve(args))
+    else:
+        watch(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+This module holds the neighbor topology of the grid as flat index tables.
+Cells are indexed row major (index = row * cols + col). For every cell the table
+holds 8 neighbor indices, in the order of DIRECTIONS, with -1 for a missing
+neighbor. Tables are computed once per (rows, cols, boundary) and shared.
+
+Boundary modes:
+- clamp: the grid ends at its edges, edge cells have missing neighbors (the original behavior)
+- wrap: toroidal, the neighbors of an edge cell are on the opposite edge
+- reflect: a mirrored padded border, the neighbor past an edge is the cell one step back inside
+"""
+from functools import lru_cache
+from state import WindDirection
+
+# (row offset, column offset) of each neighbor direction
+DIRECTIONS = (
+    ((-1, -1), WindDirection.NORTHWEST),
+    ((-1, 0), WindDirection.NORTH),
+    ((-1, 1), WindDirection.NORTHEAST),
+    ((0, -1), WindDirection.WEST),
+    ((0, 1), WindDirection.EAST),
+    ((1, -1), WindDirection.SOUTHWEST),
+    ((1, 0), WindDirection.SOUTH),
+    ((1, 1), WindDirection.SOUTHEAST),
+)
+NEIGHBOR_DIRECTIONS = tuple(direction for _, direction in DIRECTIONS)
+NEIGHBOR_COUNT = len(DIRECTIONS)
+BOUNDARIES = ('clamp', 'wrap', 'reflect')
+
+
+def _boundary_index(index, size, boundary):
+    # Maps a row / column index that may be one step outside the grid, -1 if there is no cell
+    if 0 <= index < size:
+        return index
+    if boundary == 'wrap':
+        return index % size
+    if boundary == 'reflect':
+        index = -index if index < 0 else 2 * (size - 1) - index
+        return index if 0 <= index < size else -1
+    return -1
+
+
+@lru_cache(maxsize=None)
+def neighbor_table(rows, cols, boundary='clamp'):
+    """
+    Returns the neighbor indices of every cell as a flat tuple of rows * cols * 8 ints:
+    the neighbors of cell i are table[i * 8:i * 8 + 8], in the order of DIRECTIONS.
+    """
+    if boundary not in BOUNDARIES:
+        raise ValueError(f"Unknown boundary {boundary}, expected one of {BOUNDARIES}")
+    table = []
+    for row in range(rows):
+        for col in range(cols):
+            for (d_row, d_col), _ in DIRECTIONS:
+                neighbor_row = _boundary_index(row + d_row, rows, boundary)
+                neighbor_col = _boundary_index(col + d_col, cols, boundary)
+                if neighbor_row < 0 or neighbor_col < 0:
+                    table.append(-1)
+                else:
+                    table.append(neighbor_row * cols + neighbor_col)
+    return tuple(table)
+
+
+class Neighbors:
+    """
+    Read-only mapping of direction -> neighbor cell, a view over the neighbor table.
+    Missing neighbors are not in the mapping (as with the dictionaries it replaces).
+    """
+    __slots__ = ('cells', 'table', 'base')
+
+    def __init__(self, cells, table, index):
+        self.cells = cells
+        self.table = table
+        self.base = index * NEIGHBOR_COUNT
+
+    def items(self):
+        cells, table, base = self.cells, self.table, self.base
+        for offset, direction in enumerate(NEIGHBOR_DIRECTIONS):
+            neighbor = table[base + offset]
+            if neighbor >= 0:
+                yield direction, cells[neighbor]
+
+    def keys(self):
+        return (direction for direction, _ in self.items())
+
+    def values(self):
+        return (cell for _, cell in self.items())
+
+    def get(self, direction, default=None):
+        if direction not in NEIGHBOR_DIRECTIONS:
+            return default
+        neighbor = self.table[self.base + NEIGHBOR_DIRECTIONS.index(direction)]
+        return self.cells[neighbor] if neighbor >= 0 else default
+
+    def __getitem__(self, direction):
+        cell = self.get(direction)
+        if cell is None:
+            raise KeyError(direction)
+        return cell
+
+    def __contains__(self, direction):
+        return self.get(direction) is not None
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        table, base = self.table, self.base
+        return sum(1 for offset in range(NEIGHBOR_COUNT) if table[base + offset] >= 0)
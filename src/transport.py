@@ -0,0 +1,110 @@
+"""
+This module holds the whole-grid transport kernels: the wind and pollution helpers of
+rules.py computed for every cell at once, from flat lists of the day's values and the
+grid's neighbor table (see topology.py), instead of per cell scans of the neighborhood.
+
+- wind_blowing_towards: is_wind_blowing_towards_cell (used by calculate_wind_speed_change)
+- wind_directions: change_wind_direction, with its first-match order
+    (neighbors in the order of the table, the center last on temperature ties)
+- wind_from: spread_pollution_based_on_wind's test of the neighbor the wind comes from
+
+The results are exact for the values they were computed from. seed_caches puts them
+in the neighborhoods' aggregate caches, keyed by those values (see neighborhood.aggregate),
+so a rule that runs after the center changed computes its own value as before.
+"""
+from neighborhood import OPPOSITE_DIRECTIONS, neighbors_blow_towards, neighbor_wind_from
+from rules import compute_wind_direction
+from state import WindDirection, WindSpeed
+from topology import NEIGHBOR_DIRECTIONS, NEIGHBOR_COUNT
+
+# The direction each slot of the neighbor table is coming from (the opposite of its direction)
+SLOT_OPPOSITES = tuple(OPPOSITE_DIRECTIONS[direction] for direction in NEIGHBOR_DIRECTIONS)
+# Slot of the neighbor the wind comes from, by wind direction
+WIND_SOURCE_SLOT = {direction: NEIGHBOR_DIRECTIONS.index(OPPOSITE_DIRECTIONS[direction])
+                    for direction in NEIGHBOR_DIRECTIONS}
+
+
+def wind_blowing_towards(directions, table):
+    """For every cell, whether the wind of one of its neighbors blows towards it."""
+    blowing = [False] * len(directions)
+    for slot, opposite in enumerate(SLOT_OPPOSITES):
+        column = table[slot::NEIGHBOR_COUNT]
+        blowing = [blows or (neighbor >= 0 and directions[neighbor] is opposite)
+                   for blows, neighbor in zip(blowing, column)]
+    return blowing
+
+
+def wind_directions(directions, speeds, temperatures, table):
+    """
+    change_wind_direction of every cell. directions and speeds are the cells' WindDirection
+    and WindSpeed, temperatures their temperature values (ints).
+    """
+    none_direction, calm = WindDirection.NONE, WindSpeed.NONE
+    result = []
+    for index, center_direction in enumerate(directions):
+        base = index * NEIGHBOR_COUNT
+        slots = [(slot, table[base + slot]) for slot in range(NEIGHBOR_COUNT)
+                 if table[base + slot] >= 0]
+        present = {NEIGHBOR_DIRECTIONS[slot] for slot, _ in slots}
+        # the first hottest neighbor, the center only if it is hotter
+        hottest = index
+        if slots:
+            hottest = slots[0][1]
+            for _, neighbor in slots[1:]:
+                if temperatures[neighbor] > temperatures[hottest]:
+                    hottest = neighbor
+            if temperatures[index] > temperatures[hottest]:
+                hottest = index
+
+        new_direction = None
+        if center_direction not in present:
+            for slot, neighbor in slots:
+                if directions[neighbor] is not SLOT_OPPOSITES[slot]:
+                    new_direction = SLOT_OPPOSITES[slot]
+                    break
+            if new_direction is None and directions[hottest] is not none_direction \
+                    and directions[hottest] in present:
+                new_direction = directions[hottest]
+        if new_direction is None:
+            for slot, neighbor in slots:
+                if speeds[neighbor] is calm:
+                    new_direction = directions[neighbor]
+                    break
+        if new_direction is None:
+            for slot, neighbor in slots:
+                if directions[neighbor] is SLOT_OPPOSITES[slot] and SLOT_OPPOSITES[slot] in present:
+                    new_direction = SLOT_OPPOSITES[slot]
+                    break
+        result.append(directions[hottest] if new_direction is None else new_direction)
+    return result
+
+
+def wind_from(directions, speeds, table):
+    """For every cell, whether the neighbor its wind (in directions) comes from has wind."""
+    calm = WindSpeed.NONE
+    result = []
+    for index, direction in enumerate(directions):
+        slot = WIND_SOURCE_SLOT.get(direction)
+        neighbor = -1 if slot is None else table[index * NEIGHBOR_COUNT + slot]
+        result.append(neighbor >= 0 and speeds[neighbor] is not calm)
+    return result
+
+
+def seed_caches(states, table):
+    """
+    Returns the initial aggregate cache of every cell's neighborhood for a step:
+    the wind blowing towards the cell, its new wind direction, and whether the wind
+    comes from a windy neighbor once the cell has its new direction.
+    """
+    directions = [state.wind_direction for state in states]
+    speeds = [state.wind_speed for state in states]
+    temperatures = [state.temperature._value_ for state in states]
+    blowing = wind_blowing_towards(directions, table)
+    new_directions = wind_directions(directions, speeds, temperatures, table)
+    windy_sources = wind_from(new_directions, speeds, table)
+    blowing_key = (neighbors_blow_towards, ())
+    return [{blowing_key: blows,
+             (compute_wind_direction, (state.wind_direction, state.temperature)): new_direction,
+             (neighbor_wind_from, (new_direction,)): windy_source}
+            for state, blows, new_direction, windy_source
+            in zip(states, blowing, new_directions, windy_sources)]
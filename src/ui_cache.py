@@ -0,0 +1,76 @@
+"""
+This module holds the caches used by the GUI to avoid re-rendering every frame.
+- TextCache: loads each font once and keeps the rendered text surfaces.
+- Layer: an offscreen surface for one part of the GUI (the grid, a panel),
+    re-rendered only when the key describing its inputs changes.
+The GUI composes the layers into one frame, so an unchanged frame costs a single blit.
+"""
+from collections import OrderedDict
+import pygame
+
+
+class TextCache:
+    """
+    Caches fonts by (path, size) and rendered text surfaces by their inputs.
+    The least recently used surfaces are dropped once max_size is reached,
+    so ever-changing texts (like the statistics values) do not grow the cache.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.fonts = {}
+        self.surfaces = OrderedDict()
+
+    def font(self, path, size):
+        key = (path, size)
+        if key not in self.fonts:
+            self.fonts[key] = pygame.font.Font(path, size)
+        return self.fonts[key]
+
+    def size(self, text, size, path=None):
+        return self.font(path, size).size(text)
+
+    def render(self, text, size, color, path=None, wraplength=0):
+        key = (path, size, text, color, wraplength)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+        font = self.font(path, size)
+        if wraplength:
+            surface = font.render(text, True, color, wraplength=wraplength)
+        else:
+            surface = font.render(text, True, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_size:
+            self.surfaces.popitem(last=False)
+        return surface
+
+
+class Layer:
+    """
+    An offscreen surface covering rect on the screen.
+    render(surface) draws the layer in local coordinates (rect.topleft is (0, 0)).
+    """
+
+    def __init__(self, rect, render, alpha=False):
+        self.rect = pygame.Rect(rect)
+        self.render = render
+        self.alpha = alpha
+        flags = pygame.SRCALPHA if alpha else 0
+        self.surface = pygame.Surface(self.rect.size, flags)
+        self.key = None
+        self.valid = False
+
+    def invalidate(self):
+        self.valid = False
+
+    def update(self, key):
+        """Re-renders the layer if its key changed. Returns True if it was re-rendered."""
+        if self.valid and key == self.key:
+            return False
+        self.key = key
+        self.valid = True
+        self.surface.fill((0, 0, 0, 0) if self.alpha else (0, 0, 0))
+        self.render(self.surface)
+        return True
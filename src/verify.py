@@ -0,0 +1,112 @@
+"""
+Differential verification of the stepping engines against the reference engine.
+For a number of randomized worlds and rule masks, a reference grid and a grid
+using the tested engine are stepped side by side for N days, and the first
+diverging cell and attribute is reported.
+
+Example:
+    python verify.py --engine fast --worlds 10 --days 20 --size 16
+"""
+import argparse
+import random
+import sys
+from engines import ENGINES, REFERENCE_ENGINE, first_divergence
+from grid import Grid, random_initial_conditions
+from topology import BOUNDARIES
+from scheduler import parse_period
+from rules import TransitionRules
+
+
+def random_rule_mask(rnd, toggle_probability):
+    """Flips each rule's enabled flag with the given probability."""
+    return [rule['enabled'] != (rnd.random() < toggle_probability) for rule in TransitionRules.rules]
+
+
+def verify_world(engine, rows, cols, days, seed, rule_mask, boundary='clamp', update_periods=None):
+    """
+    Steps a reference grid and a grid using engine for days, from the same random world.
+    Returns the first divergence (a dictionary) or None.
+    """
+    enabled = [rule['enabled'] for rule in TransitionRules.rules]
+    try:
+        for rule, rule_enabled in zip(TransitionRules.rules, rule_mask):
+            rule['enabled'] = rule_enabled
+        conditions = random_initial_conditions(rows, cols, seed)
+        reference = Grid(rows, cols, engine=REFERENCE_ENGINE, boundary=boundary,
+                         update_periods=update_periods)
+        tested = Grid(rows, cols, engine=engine, boundary=boundary, update_periods=update_periods)
+        reference.apply_initial_conditions_csv(initial_conditions=conditions)
+        # apply_initial_conditions_csv places the given cells in the grid, so each grid needs its own
+        tested.apply_initial_conditions_csv(
+            initial_conditions=random_initial_conditions(rows, cols, seed))
+        for day in range(1, days + 1):
+            reference.next_day()
+            tested.next_day()
+            divergence = first_divergence(
+                [cell.state for row in reference.grid for cell in row],
+                [cell.state for row in tested.grid for cell in row], cols)
+            if divergence is not None:
+                divergence.update({'engine': engine, 'day': day, 'seed': seed})
+                return divergence
+        return None
+    finally:
+        for rule, rule_enabled in zip(TransitionRules.rules, enabled):
+            rule['enabled'] = rule_enabled
+
+
+def verify_engine(engine, worlds=10, days=10, rows=12, cols=12, seed=0, toggle_probability=0.2,
+                  boundary='clamp', update_periods=None):
+    """
+    Verifies engine on worlds random worlds, each with a random rule mask.
+    Returns a list of (world seed, rule mask, divergence or None).
+    """
+    rnd = random.Random(seed)
+    results = []
+    for world in range(worlds):
+        world_seed = seed + world
+        # The first world keeps the rules as they are
+        rule_mask = [rule['enabled'] for rule in TransitionRules.rules] if world == 0 \
+            else random_rule_mask(rnd, toggle_probability)
+        results.append((world_seed, rule_mask,
+                        verify_world(engine, rows, cols, days, world_seed, rule_mask,
+                                     boundary, update_periods)))
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Verify an engine against the reference engine')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='fast')
+    parser.add_argument('--worlds', type=int, default=10)
+    parser.add_argument('--days', type=int, default=10)
+    parser.add_argument('--size', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--boundary', choices=BOUNDARIES, default='clamp')
+    parser.add_argument('--periods', nargs='*', type=parse_period, default=[], metavar='CATEGORY=DAYS',
+                        help='update period of rule categories, e.g. LAND=7 TEMP=2 (see scheduler.py)')
+    parser.add_argument('--toggle-probability', type=float, default=0.2,
+                        help='probability of flipping each rule in the random rule masks')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = verify_engine(args.engine, args.worlds, args.days, args.size, args.size,
+                            args.seed, args.toggle_probability, args.boundary,
+                            dict(args.periods))
+    failures = 0
+    for world_seed, rule_mask, divergence in results:
+        if divergence is None:
+            print(f'world {world_seed}: ok')
+            continue
+        failures += 1
+        disabled = [i for i, enabled in enumerate(rule_mask) if not enabled]
+        print(f"world {world_seed}: diverged on day {divergence['day']} at cell "
+              f"({divergence['row']}, {divergence['col']}): {divergence['attribute']} is "
+              f"{divergence['actual']}, expected {divergence['expected']} "
+              f"(disabled rules: {disabled})")
+    print(f'{args.engine}: {len(results) - failures}/{len(results)} worlds match the reference engine')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+"""
+This module holds the camera used to look at the world grid.
+The viewport maps grid cells to screen pixels (and back), so drawing and hover
+hit-testing share the same transform. Only the visible cells are drawn.
+
+When zoomed out so far that a cell is only a few pixels wide, the GUI draws
+blocks from a mipmap pyramid instead of single cells. Each level of the pyramid
+aggregates 2x2 blocks of the level below it: land type counts (for the majority
+land type), temperature sum and pollution sum (for the means).
+The pyramid is updated incrementally from the cells that changed in the last day.
+"""
+from state import State, Landscape, Temperature, AirQuality
+
+# Smallest size in pixels a drawn cell (or block) may have before we switch to
+# the next, coarser level of detail
+LOD_MIN_CELL_PIXELS = 8
+MAX_CELL_PIXELS = 400
+
+LAND_TYPES = list(Landscape)
+
+
+class Viewport:
+    """
+    Camera over the world grid.
+    The zoom is relative to the "fit" view, where the whole world fills the area
+    (which is what the GUI always showed before), so zoom 1 is the most zoomed out.
+    The offset is the (row, col) of the top-left visible point, in cell units.
+    """
+
+    def __init__(self, rows, cols, width, height, x=0, y=0):
+        self.rows = rows
+        self.cols = cols
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.base_cell_width = width / cols
+        self.base_cell_height = height / rows
+        self.max_zoom = max(1.0, MAX_CELL_PIXELS /
+                            min(self.base_cell_width, self.base_cell_height))
+        self.fit()
+
+    def fit(self):
+        self.zoom = 1.0
+        self.offset_row = 0.0
+        self.offset_col = 0.0
+
+    @property
+    def cell_width(self):
+        return self.base_cell_width * self.zoom
+
+    @property
+    def cell_height(self):
+        return self.base_cell_height * self.zoom
+
+    def contains(self, pos):
+        px, py = pos
+        return self.x <= px < self.x + self.width and self.y <= py < self.y + self.height
+
+    def cell_to_screen(self, row, col):
+        return (self.x + (col - self.offset_col) * self.cell_width,
+                self.y + (row - self.offset_row) * self.cell_height)
+
+    def screen_to_cell(self, pos):
+        """Returns the (row, col) of the cell under the given pixel, or None."""
+        if not self.contains(pos):
+            return None
+        px, py = pos
+        col = int(self.offset_col + (px - self.x) / self.cell_width)
+        row = int(self.offset_row + (py - self.y) / self.cell_height)
+        if 0 <= row < self.rows and 0 <= col < self.cols:
+            return row, col
+        return None
+
+    def visible_range(self, block=1):
+        """
+        Returns (first_row, last_row, first_col, last_col) of the visible cells,
+        last excluded. With block > 1 the range is in block units.
+        """
+        visible_rows = self.height / self.cell_height
+        visible_cols = self.width / self.cell_width
+        first_row = int(self.offset_row) // block
+        first_col = int(self.offset_col) // block
+        last_row = min(-(-min(self.rows, int(self.offset_row + visible_rows) + 1) // block),
+                       -(-self.rows // block))
+        last_col = min(-(-min(self.cols, int(self.offset_col + visible_cols) + 1) // block),
+                       -(-self.cols // block))
+        return first_row, last_row, first_col, last_col
+
+    def lod_level(self, max_level):
+        """The coarsest-needed level so a drawn block is at least LOD_MIN_CELL_PIXELS wide."""
+        size = min(self.cell_width, self.cell_height)
+        level = 0
+        while size < LOD_MIN_CELL_PIXELS and level < max_level:
+            size *= 2
+            level += 1
+        return level
+
+    def zoom_at(self, factor, pos):
+        """Zooms by factor, keeping the world point under pos in place."""
+        px, py = pos
+        anchor_col = self.offset_col + (px - self.x) / self.cell_width
+        anchor_row = self.offset_row + (py - self.y) / self.cell_height
+        self.zoom = min(max(self.zoom * factor, 1.0), self.max_zoom)
+        self.offset_col = anchor_col - (px - self.x) / self.cell_width
+        self.offset_row = anchor_row - (py - self.y) / self.cell_height
+        self.clamp()
+
+    def pan(self, dx, dy):
+        """Moves the camera by a number of pixels."""
+        self.offset_col -= dx / self.cell_width
+        self.offset_row -= dy / self.cell_height
+        self.clamp()
+
+    def clamp(self):
+        max_row = self.rows - self.height / self.cell_height
+        max_col = self.cols - self.width / self.cell_width
+        self.offset_row = min(max(self.offset_row, 0.0), max(max_row, 0.0))
+        self.offset_col = min(max(self.offset_col, 0.0), max(max_col, 0.0))
+
+
+class MipmapPyramid:
+    """
+    Level of detail pyramid over the grid.
+    Level 0 is the grid itself, level L holds blocks of 2^L x 2^L cells.
+    Each level is stored as flat lists (row major) so updates stay cheap.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.rebuild()
+
+    def rebuild(self):
+        rows, cols = self.world.rows, self.world.cols
+        self.levels = []
+        level_rows, level_cols = rows, cols
+        while level_rows > 1 or level_cols > 1:
+            level_rows, level_cols = -(-level_rows // 2), -(-level_cols // 2)
+            count = level_rows * level_cols
+            self.levels.append({
+                'rows': level_rows,
+                'cols': level_cols,
+                'land_counts': [0] * (count * len(LAND_TYPES)),
+                'temperature': [0] * count,
+                'pollution': [0] * count,
+                'cells': [0] * count,
+                'colors': [None] * count,
+            })
+        for index in range(self.levels[0]['rows'] * self.levels[0]['cols'] if self.levels else 0):
+            self.update_block(1, index)
+        for level in range(2, self.max_level + 1):
+            for index in range(self.levels[level - 1]['rows'] * self.levels[level - 1]['cols']):
+                self.update_block(level, index)
+
+    @property
+    def max_level(self):
+        return len(self.levels)
+
+    def update(self, changed_cells=None):
+        """
+        Updates the blocks covering the given flat cell indices (row * cols + col).
+        None means everything changed, and the pyramid is rebuilt.
+        """
+        if changed_cells is None:
+            self.rebuild()
+            return
+        cols = self.world.cols
+        dirty = set()
+        for index in changed_cells:
+            row, col = divmod(index, cols)
+            dirty.add((row >> 1, col >> 1))
+        for level in range(1, self.max_level + 1):
+            level_cols = self.levels[level - 1]['cols']
+            for block_row, block_col in dirty:
+                self.update_block(level, block_row * level_cols + block_col)
+            dirty = {(block_row >> 1, block_col >> 1) for block_row, block_col in dirty}
+
+    def update_block(self, level, index):
+        """Recomputes one block from its (up to) 4 children on the level below."""
+        data = self.levels[level - 1]
+        block_row, block_col = divmod(index, data['cols'])
+        num_land_types = len(LAND_TYPES)
+        land_counts = [0] * num_land_types
+        temperature = pollution = cells = 0
+        if level == 1:
+            grid = self.world.grid
+            for row in range(block_row * 2, min(block_row * 2 + 2, self.world.rows)):
+                for col in range(block_col * 2, min(block_col * 2 + 2, self.world.cols)):
+                    state = grid[row][col].state
+                    land_counts[LAND_TYPES.index(state.land_type)] += 1
+                    temperature += state.temperature.value
+                    pollution += state.air_pollution.value
+                    cells += 1
+        else:
+            child = self.levels[level - 2]
+            for row in range(block_row * 2, min(block_row * 2 + 2, child['rows'])):
+                for col in range(block_col * 2, min(block_col * 2 + 2, child['cols'])):
+                    child_index = row * child['cols'] + col
+                    offset = child_index * num_land_types
+                    for i in range(num_land_types):
+                        land_counts[i] += child['land_counts'][offset + i]
+                    temperature += child['temperature'][child_index]
+                    pollution += child['pollution'][child_index]
+                    cells += child['cells'][child_index]
+        data['land_counts'][index * num_land_types:(index + 1) * num_land_types] = land_counts
+        data['temperature'][index] = temperature
+        data['pollution'][index] = pollution
+        data['cells'][index] = cells
+        data['colors'][index] = None
+
+    def block_state(self, level, block_row, block_col):
+        """
+        Returns an aggregated State for the block:
+        majority land type, mean temperature and mean pollution.
+        """
+        data = self.levels[level - 1]
+        index = block_row * data['cols'] + block_col
+        num_land_types = len(LAND_TYPES)
+        counts = data['land_counts'][index * num_land_types:(index + 1) * num_land_types]
+        land_type = LAND_TYPES[counts.index(max(counts))]
+        cells = data['cells'][index]
+        return State(land_type,
+                     temperature=Temperature(round(data['temperature'][index] / cells)),
+                     air_pollution=AirQuality(round(data['pollution'][index] / cells)))
+
+    def block_color(self, level, block_row, block_col):
+        data = self.levels[level - 1]
+        index = block_row * data['cols'] + block_col
+        color = data['colors'][index]
+        if color is None:
+            color = self.block_state(level, block_row, block_col).get_state_color()
+            data['colors'][index] = color
+        return color